@@ -0,0 +1,143 @@
+# sightwire, Apache-2.0 license
+# Filename: benchmarks/run.py
+# Description: Benchmark the hot paths on a synthetic mission and report frames/s and peak RSS as JSON.
+# Run from the top of the repository, e.g.
+#   python -m benchmarks.run --num-images 5000 --nav-rate 10 --stereo --output bench.json
+import json
+import multiprocessing as mp
+import platform
+import resource
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from tempfile import TemporaryDirectory as tempdir
+
+import click
+
+from benchmarks.synthetic import Mission, create_mission
+from benchmarks.tator_stub import TatorStub
+
+BENCHMARKS = ['assign_nearest', 'gen_spec', 'create_media_bulk', 'parse_log', 'image_to_mp4']
+
+
+def images(mission: Mission) -> list:
+    from sightwire.loaders.discovery import ImageFiles, discover_images
+    return ImageFiles.concat([discover_images(d, manifest_path=None) for d in mission.image_dirs])
+
+
+def bench_assign_nearest(mission: Mission) -> int:
+    from sightwire.converters.time_utils import iter_assign_nearest
+    frames = 0
+    for df_chunk in iter_assign_nearest(mission.depth_log, mission.position_log, images(mission), max_images=-1,
+                                        use_cache=False):
+        frames += len(df_chunk)
+    return frames
+
+
+def bench_gen_spec(mission: Mission) -> int:
+    from sightwire.database.media import gen_spec
+    files = images(mission)
+    for path in files.paths:
+        gen_spec(file_loc=path, type_id=1, section='benchmark')
+    return len(files)
+
+
+def bench_create_media_bulk(mission: Mission) -> int:
+    import tator
+    from sightwire.converters.time_utils import assign_nearest
+    from sightwire.database.data_types import Camera, Platform, Side
+    from sightwire.loaders.image_utils import create_media_bulk
+    df = assign_nearest(mission.depth_log, mission.position_log, images(mission), max_images=-1, use_cache=False)
+    sides = [Side.LEFT, Side.RIGHT] if mission.stereo else [Side.UNKNOWN]
+    frames = 0
+    with TatorStub() as host:
+        api = tator.get_api(host, 'benchmark')
+        for side in sides:
+            frames += len(create_media_bulk(1, api, df, None, {}, 1, 'benchmark', side, Platform.MINI_ROV,
+                                            Camera.PROSILICA, 'benchmark'))
+    return frames
+
+
+def bench_parse_log(mission: Mission) -> int:
+    from sightwire.converters.lcm import parse_log
+    usbl_data, depth_data = parse_log(mission.lcm_log, 'USBL_LATLONG', 'DEPTH')
+    return len(usbl_data) + len(depth_data)
+
+
+def bench_image_to_mp4(mission: Mission) -> int:
+    from sightwire.converters.video_transcoders import image_to_mp4
+    with tempdir() as workdir:
+        timestamps = image_to_mp4(mission.image_dirs[0].as_posix(), f'{workdir}/benchmark.mp4')
+    return len(timestamps)
+
+
+def peak_rss_mb(who: int = resource.RUSAGE_SELF) -> float:
+    """
+    Peak resident set size of this process, or with RUSAGE_CHILDREN of the largest child process that has exited,
+    e.g. a decode worker or ffmpeg. ru_maxrss is in kilobytes on Linux and bytes on macOS
+    """
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+def run_one(name: str, mission: Mission, queue: mp.Queue):
+    """
+    Run one benchmark. Called in a fresh process so the peak RSS belongs to this benchmark alone
+    """
+    try:
+        start = time.perf_counter()
+        count = globals()[f'bench_{name}'](mission)
+        seconds = time.perf_counter() - start
+        queue.put({'name': name,
+                   'unit': 'events' if name == 'parse_log' else 'frames',
+                   'count': count,
+                   'seconds': round(seconds, 4),
+                   'per_second': round(count / seconds, 1) if seconds > 0 else None,
+                   'peak_rss_mb': round(peak_rss_mb(), 1),
+                   'children_peak_rss_mb': round(peak_rss_mb(resource.RUSAGE_CHILDREN), 1)})
+    except Exception as e:
+        queue.put({'name': name, 'error': repr(e)})
+
+
+@click.command('benchmarks', help='Benchmark the hot paths on a synthetic mission')
+@click.option('--num-images', type=int, default=2000, help='Number of images per camera')
+@click.option('--frame-rate', type=float, default=5., help='Camera frame rate in Hz')
+@click.option('--nav-rate', type=float, default=10., help='Depth sample rate in Hz')
+@click.option('--stereo/--mono', default=False, help='Create LEFT/RIGHT cameras or a single camera')
+@click.option('--only', type=click.Choice(BENCHMARKS), multiple=True, help='Benchmarks to run. Default is all')
+@click.option('--mission', 'mission_path', type=Path, help='Directory to keep the synthetic mission in. '
+                                                           'Default is a temporary directory')
+@click.option('--output', type=Path, help='JSON file to write the results to. Default is stdout')
+def run(num_images: int, frame_rate: float, nav_rate: float, stereo: bool, only: tuple, mission_path: Path,
+        output: Path):
+    with tempdir() as workdir:
+        root = mission_path or Path(workdir) / 'mission'
+        start = time.perf_counter()
+        mission = create_mission(root, num_images, frame_rate=frame_rate, nav_rate=nav_rate, stereo=stereo)
+        print(f'Created mission in {root} in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+
+        ctx = mp.get_context('spawn')
+        results = []
+        for name in only or BENCHMARKS:
+            queue = ctx.Queue()
+            process = ctx.Process(target=run_one, args=(name, mission, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            print(json.dumps(result), file=sys.stderr)
+            results.append(result)
+
+    report = {'created': datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(),
+              'machine': platform.machine(),
+              'mission': {'num_images': num_images, 'frame_rate': frame_rate, 'nav_rate': nav_rate, 'stereo': stereo},
+              'results': results}
+    if output:
+        output.write_text(json.dumps(report, indent=2))
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    run()
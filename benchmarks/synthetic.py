@@ -0,0 +1,102 @@
+# sightwire, Apache-2.0 license
+# Filename: benchmarks/synthetic.py
+# Description: Synthetic missions for the benchmarks: timestamped images, depth/USBL csv logs and an LCM log
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List
+
+import cv2
+import numpy as np
+from lcmlog import Event, Header
+from compas_lcmtypes.senlcm import gps_fix_t, depth_t
+
+from sightwire.converters.lcm import write_events
+
+START_US = 1699643598089218  # Start of the mission in microseconds, same epoch as oi_survey_1913
+USBL_RATE = 1 / 3.  # USBL fixes arrive every few seconds
+
+
+@dataclass
+class Mission:
+    root: Path
+    image_dirs: List[Path]
+    depth_log: Path
+    position_log: Path
+    lcm_log: Path
+    num_images: int
+    stereo: bool
+
+
+def write_images(image_dir: Path, timestamps_us: np.ndarray, width: int, height: int):
+    """
+    Write one small png per timestamp. The png is encoded once and copied, so large missions are quick to create
+    """
+    image_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(0)
+    ok, png = cv2.imencode('.png', rng.integers(0, 255, (height, width, 3), dtype=np.uint8))
+    data = png.tobytes()
+    for t in timestamps_us:
+        (image_dir / f'{t}.png').write_bytes(data)
+
+
+def create_mission(root: Path, num_images: int, frame_rate: float = 5., nav_rate: float = 10., stereo: bool = False,
+                   width: int = 64, height: int = 48) -> Mission:
+    """
+    Create a synthetic mission
+    :param root: Directory to create the mission in
+    :param num_images: Number of images per camera
+    :param frame_rate: Camera frame rate in Hz
+    :param nav_rate: Depth sample rate in Hz
+    :param stereo: True to create LEFT/RIGHT cameras
+    :param width: Image width
+    :param height: Image height
+    :return: The mission
+    """
+    root.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(1)
+    frame_us = np.int64(START_US) + (np.arange(num_images) * 1e6 / frame_rate).astype(np.int64)
+    duration_s = num_images / frame_rate + 10
+
+    if stereo:
+        image_dirs = [root / 'images' / 'PROSILICA_L_PNG', root / 'images' / 'PROSILICA_R_PNG']
+        write_images(image_dirs[0], frame_us, width, height)
+        write_images(image_dirs[1], frame_us + rng.integers(-5000, 5000, num_images), width, height)
+    else:
+        image_dirs = [root / 'images' / 'FLIR_PNG']
+        write_images(image_dirs[0], frame_us, width, height)
+
+    # Navigation starts a few seconds before the first image
+    depth_us = np.int64(START_US - 5_000_000) + (np.arange(int(duration_s * nav_rate)) * 1e6 / nav_rate).astype(np.int64)
+    usbl_us = np.int64(START_US - 5_000_000) + (np.arange(int(duration_s * USBL_RATE)) * 1e6 / USBL_RATE).astype(np.int64)
+    depth = 545 + np.cumsum(rng.normal(0, 0.01, len(depth_us)))
+    latitude = 36.75276 + np.cumsum(rng.normal(0, 1e-6, len(usbl_us)))
+    longitude = -122.05603 + np.cumsum(rng.normal(0, 1e-6, len(usbl_us)))
+
+    depth_log = root / 'DEPTH.csv'
+    with open(depth_log, 'w') as f:
+        f.write('lcm_timestamp,sensor_timestamp,depth,pressure\n')
+        f.writelines(f'{t},{t},{d},-1.0\n' for t, d in zip(depth_us, depth))
+
+    position_log = root / 'USBL_LATLONG.csv'
+    with open(position_log, 'w') as f:
+        f.write('lcm_timestamp,sensor_timestamp,latitude,longitude,altitude\n')
+        f.writelines(f'{t},{t},{lat},{lon},-544.0\n' for t, lat, lon in zip(usbl_us, latitude, longitude))
+
+    # The same navigation as an LCM log, time ordered
+    lcm_log = root / 'lcmlog.00'
+    events = []
+    for t, d in zip(depth_us, depth):
+        message = depth_t()
+        message.header.timestamp = int(t)
+        message.depth = float(d)
+        events.append((int(t), 'DEPTH', message.encode()))
+    for t, lat, lon in zip(usbl_us, latitude, longitude):
+        message = gps_fix_t()
+        message.header.timestamp = int(t)
+        message.latitude, message.longitud = float(lat), float(lon)
+        events.append((int(t), 'USBL_LATLONG', message.encode()))
+    write_events(lcm_log, (Event(Header(number, t, len(channel), len(data)), channel, data)
+                           for number, (t, channel, data) in enumerate(sorted(events, key=lambda e: e[0]))))
+
+    return Mission(root=root, image_dirs=image_dirs, depth_log=depth_log, position_log=position_log, lcm_log=lcm_log,
+                   num_images=num_images, stereo=stereo)
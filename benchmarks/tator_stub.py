@@ -0,0 +1,43 @@
+# sightwire, Apache-2.0 license
+# Filename: benchmarks/tator_stub.py
+# Description: Local stand-in for the Tator REST endpoints used by the loaders. Accepts media and state lists and
+# returns new ids, so uploads can be timed without a database
+import itertools
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class TatorStubHandler(BaseHTTPRequestHandler):
+    ids = itertools.count(1)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'[]')
+        specs = body if isinstance(body, list) else [body]
+        response = json.dumps({'message': f'Created {len(specs)}', 'id': [next(self.ids) for _ in specs]}).encode()
+        self.send_response(201)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TatorStub:
+    """
+    Run the stub server in a background thread, e.g.
+        with TatorStub() as host:
+            api = tator.get_api(host, 'token')
+    """
+
+    def __enter__(self) -> str:
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), TatorStubHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
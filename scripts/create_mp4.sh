@@ -10,14 +10,9 @@ COMPAS_DATA_ROOT=/Users/dcline/data
 
 cd $BASE_DIR
 
-python sightwire convert create-video \
-	--input $COMPAS_DATA_ROOT/DATA/RAW/MBARI/LASS/20231010d1/images/oi_survey_1648/color/PROSILICA_L_PNG \
-	--output $COMPAS_DATA_ROOT/DATA/RAW/MBARI/LASS/20231010d1/video/oi_survey_1648_color_PROSILICA_L_dm.mp4 \
-	--csv $COMPAS_DATA_ROOT/DATA/RAW/MBARI/LASS/20231010d1/video/ \
-	--num-images 100
-
-python sightwire convert create-video \
-	--input $COMPAS_DATA_ROOT/DATA/RAW/MBARI/LASS/20231010d1/images/oi_survey_1648/color/PROSILICA_R_PNG \
-	--output $COMPAS_DATA_ROOT/DATA/RAW/MBARI/LASS/20231010d1/video/oi_survey_1648_color_PROSILICA_R_dm.mp4 \
-	--csv $COMPAS_DATA_ROOT/DATA/RAW/MBARI/LASS/20231010d1/video/ \
+# Creates a video for every image folder under the survey, e.g. oi_survey_1648_color_PROSILICA_L_PNG.mp4, skipping
+# folders whose video is already up to date. Add --force to create them all again
+python sightwire convert create-videos \
+	--input $COMPAS_DATA_ROOT/DATA/RAW/MBARI/LASS/20231010d1/images/oi_survey_1648 \
+	--output $COMPAS_DATA_ROOT/DATA/RAW/MBARI/LASS/20231010d1/video/ \
 	--num-images 100
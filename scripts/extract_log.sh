@@ -1,5 +1,5 @@
 #!/usr/bin/env bash
-# Creates two csv files from a lcm log with depth and position data
+# Creates a csv file per channel from a lcm log, e.g. depth and position data
 # This is needed to create the metadata for the compas dataset for bulk loading into the database
 # Modify as needed for your specific use case
 # Run with ./extract_log.sh
@@ -12,16 +12,11 @@ COMPAS_DATA_ROOT=/Users/dcline/data
 
 cd $BASE_DIR
 
+# All channels are extracted in a single read of the log. Add a --channel NAME:TYPE for each other channel needed,
+# e.g. --channel LASS_CTD:ctd_t
 python sightwire convert extract-log \
 --log $COMPAS_DATA_ROOT/DATA/RAW/MBARI/LASS/20231010d1/images/oi_survey_1648/lcmlog.00 \
---usbl-channel LASS_USBL_LATLONG  \
---depth-channel LASS_DEPTH \
---output $BASE_DIR/data/logs \
---prefix oi_survey_1648
-
-python sightwire convert extract-log \
---log $COMPAS_DATA_ROOT/DATA/RAW/MBARI/LASS/20231010d1/images/oi_survey_1648/lcmlog.00 \
---usbl-channel LASS_USBL_LATLONG  \
---depth-channel LASS_DEPTH \
+--channel LASS_USBL_LATLONG:gps_fix_t  \
+--channel LASS_DEPTH:depth_t \
 --output $BASE_DIR/data/logs \
 --prefix oi_survey_1648
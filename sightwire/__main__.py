@@ -8,6 +8,7 @@ import click
 
 from sightwire.loaders.watchdog import run_watchdog, load_watchdog
 from sightwire.misc.capture_livestream import capture_livestream
+from sightwire.misc.replay_lcm import replay_lcm
 from sightwire.loaders.image import load_image
 from sightwire.loaders.video import load_video, create_stereo_view
 from sightwire.converters import commands as converters
@@ -53,7 +54,9 @@ def cli_convert():
 
 cli.add_command(cli_convert)
 cli_convert.add_command(converters.create_video)
+cli_convert.add_command(converters.create_videos)
 cli_convert.add_command(converters.extract_log)
+cli_convert.add_command(converters.filter_log)
 
 
 @click.group(name="load")
@@ -80,6 +83,7 @@ cli.add_command(cli_realtime)
 cli_realtime.add_command(capture_livestream)
 cli_realtime.add_command(run_watchdog)
 cli_realtime.add_command(load_watchdog)
+cli_realtime.add_command(replay_lcm)
 
 if __name__ == '__main__':
     try:
@@ -2,15 +2,24 @@
 # Filename: common_args.py
 # Description: Common arguments for processing commands
 import os
+from pathlib import Path
 
 import click
 
+from sightwire.database.ledger import DEFAULT_LEDGER_PATH
+
 # Common arguments for processing commands
 host = click.option("--host", type=str, default=os.getenv('TATOR_HOST', 'http://localhost:8080'), required=False)
 token = click.option("--token", type=str, default=os.environ['TATOR_TOKEN'], required=False)
 project = click.option("--project", default=os.getenv('TATOR_PROJECT', '902204-CoMPAS'), required=False)
 force = click.option("--force", is_flag=True, help='Force load and skip over check')
 base_url = click.option( "--base-url", '-u', type=str, help='base url to the images, e.g. http://localhost:8000/compas/')
+ledger = click.option("--ledger", type=Path, default=DEFAULT_LEDGER_PATH,
+                      help='SQLite ledger of loaded media. Media already in the ledger are skipped')
+thumbnail_size = click.option("--thumbnail-size", type=int, default=256,
+                              help='Longest side of the JPEG thumbnails in pixels')
+contact_sheet = click.option("--contact-sheet", is_flag=True,
+                             help='Make a contact sheet of frames spread over the whole sequence')
 vol_map = click.option( "--vol-map", '-v', type=str, help="mapping from the path outside docker to internal docker, e.g. --vol-map '/home/ops/data:/data,/mnt/raid:/raid'")
 
 
@@ -0,0 +1,67 @@
+# sightwire, Apache-2.0 license
+# Filename: convertors/columnar.py
+# Description: Columnar navigation tables (parquet or npz) with typed int64/float64 columns and lcm_timestamp in
+# nanoseconds, so they load without any text parsing
+import importlib.util
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+from sightwire.logger import err
+
+FORMATS = ['csv', 'parquet', 'npz']
+COLUMNAR_SUFFIXES = ['.parquet', '.npz']
+
+
+def check_format(fmt: str):
+    """
+    Check that the libraries to write a format are installed, before any data is read
+    :param fmt: One of FORMATS
+    :raise ImportError: If parquet is requested and pyarrow is not installed
+    """
+    if fmt == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+        raise ImportError('Writing parquet needs pyarrow, e.g. pip install pyarrow')
+
+
+def write_columns(output_path: Path, columns: Dict[str, np.ndarray]):
+    """
+    Write columns to a parquet or npz file, chosen by the file extension
+    :param output_path: Path to the output file, e.g. DEPTH.parquet
+    :param columns: Column name to values, in column order
+    """
+    output_path = Path(output_path)
+    if output_path.suffix == '.parquet':
+        try:
+            pd.DataFrame(columns).to_parquet(output_path, index=False)
+        except ImportError:
+            err('Writing parquet needs pyarrow, e.g. pip install pyarrow')
+            raise
+    else:
+        with open(output_path, 'wb') as f:
+            np.savez(f, **columns)
+
+
+def read_columns(input_path: Path) -> pd.DataFrame:
+    """
+    Read a parquet or npz file written by write_columns
+    :param input_path: Path to the file
+    :return: Dataframe with the columns in order
+    """
+    input_path = Path(input_path)
+    if input_path.suffix == '.parquet':
+        return pd.read_parquet(input_path)
+    with np.load(input_path) as data:
+        return pd.DataFrame({name: data[name] for name in data.files})
+
+
+def merge_columns(inputs: List[Path], output_path: Path):
+    """
+    Merge time ordered columnar files with the same columns by lcm_timestamp. Files without rows are skipped, so they
+    cannot change the column dtypes
+    """
+    frames = [read_columns(p) for p in inputs]
+    df = pd.concat([f for f in frames if len(f)] or frames[:1], ignore_index=True)
+    df = df.sort_values(by='lcm_timestamp', kind='stable')
+    write_columns(output_path, {name: df[name].values for name in df.columns})
@@ -1,23 +1,57 @@
 # sightwire, Apache-2.0 license
 # Filename: convertors/commands.py
 # Description:  Run data conversions for video, lcm logs, etc.
+import itertools
 import logging
+from typing import List
 
 import click
 from pathlib import Path
+import numpy as np
 import pandas as pd
 
-from sightwire.logger import info
-from .lcm import parse_log, write_usbl_csv, write_depth_csv
-from .video_transcoders import image_to_mp4
+from sightwire import common_args
+from sightwire.logger import info, err
+from sightwire.loaders.discovery import discover_images
+from .columnar import FORMATS, check_format
+from .decoders import parse_channels
+from .lcm import extract_segments, find_segments, iter_events, write_log
+from .previews import Previews
+from .time_utils import timestamps_to_datetime64, to_microseconds
+from .video_batch import find_video_jobs, run_video_jobs, write_summary
+from .video_hls import append_to_hls, state_file
+from .video_transcoders import ENCODER_PRESETS, ENCODERS, STEREO_LAYOUTS, image_to_mp4, stereo_to_mp4
 
 
 @click.command("create-video", help="Create mp4 video files from images")
-@click.option('--input', '-i', type=Path, required=True, help='Path to the images')
+@click.option('--input', '-i', type=Path, help='Path to the images')
+@click.option('--input-left', '-l', type=Path, help='Path to the left images, for a stereo video with --input-right')
+@click.option('--input-right', '-r', type=Path, help='Path to the right images, for a stereo video with --input-left')
+@click.option('--stereo-layout', type=click.Choice(STEREO_LAYOUTS), default='side-by-side',
+              help='Encode a stereo video side by side, or as separate _LEFT and _RIGHT videos with the same frames')
+@click.option('--tolerance', type=float, default=0.5,
+              help='Maximum time difference in seconds between a left and right image')
 @click.option('--num-images', type=int, default=30, required=False, help='(Optional) number of images to use in the mp4')
 @click.option('--output', '-o', type=Path, required=True,  help='Path to the save the mp4 file')
 @click.option('--csv', type=Path, required=True, help='Path to the save the csv file with timestamps')
-def create_video(input: Path, num_images: int, output: Path, csv: Path):
+@click.option('--workers', type=int, help='Number of processes to decode images. Default is the number of CPUs')
+@click.option('--segments', type=int, default=1, help='Number of segments to encode concurrently, then join into one mp4')
+@click.option('--encoder', type=click.Choice(ENCODERS), help='Video encoder. Default is ffmpeg if available, otherwise cv2')
+@click.option('--preset', type=click.Choice(list(ENCODER_PRESETS)), default='default',
+              help='Encoder preset: archive for the smallest files with a slow encode, preview for a fast, 480p encode')
+@click.option('--threads', type=int, help='Number of encoder threads. Default is the encoder default')
+@click.option('--proxy', 'proxy_heights', type=int, multiple=True,
+              help='Height in pixels of a downscaled proxy video, saved as <output>_<height>p.mp4. Repeat for more')
+@click.option('--thumbnails', is_flag=True, help='Save a JPEG thumbnail of each image in <output>_thumbnails')
+@common_args.thumbnail_size
+@common_args.contact_sheet
+@click.option('--incremental', is_flag=True,
+              help='Append only the images added since the last run to a fragmented MP4 HLS playlist, '
+                   'written next to --output with the .m3u8 extension')
+def create_video(input: Path, input_left: Path, input_right: Path, stereo_layout: str, tolerance: float,
+                 num_images: int, output: Path, csv: Path, workers: int, segments: int, proxy_heights: List[int],
+                 encoder: str, preset: str, threads: int, thumbnails: bool, thumbnail_size: int, contact_sheet: bool,
+                 incremental: bool):
     """
     Create mp4 files from images
     :return:
@@ -26,23 +60,76 @@ def create_video(input: Path, num_images: int, output: Path, csv: Path):
     mp4_path = output
     csv_path = csv
 
+    with_previews = proxy_heights or thumbnails or contact_sheet
+    if incremental and (input_left or input_right):
+        raise click.UsageError('--incremental does not support stereo videos')
+    if incremental and (with_previews or segments > 1):
+        raise click.UsageError('--incremental does not support --proxy, --thumbnails, --contact-sheet or --segments')
+    if incremental and encoder not in [None, 'ffmpeg']:
+        raise click.UsageError('--incremental writes HLS with the ffmpeg encoder')
+    if (input_left or input_right) and segments > 1:
+        raise click.UsageError('Stereo videos are encoded in one pass and do not support --segments')
+
+    if input_left or input_right:
+        # Stereo video from left and right images paired by timestamp
+        for p in [input_left, input_right]:
+            if not p or not p.exists():
+                err(f"Need existing --input-left and --input-right image paths, got {input_left} and {input_right}")
+                return
+        mp4_path.parent.mkdir(parents=True, exist_ok=True)
+        demosaic = 'bayer' in input_left.as_posix()
+        # Previews of each side, e.g. <output>_LEFT_480p.mp4 and <output>_RIGHT_thumbnails
+        previews = []
+        if with_previews:
+            previews = [Previews(mp4_path.parent, f'{mp4_path.stem}_{side}', proxy_heights,
+                                 thumbnail_size if thumbnails else 0, contact_sheet) for side in ['LEFT', 'RIGHT']]
+        data = stereo_to_mp4(input_left.as_posix(), input_right.as_posix(), mp4_path.as_posix(), demosaic=demosaic,
+                             num_images=num_images, workers=workers, layout=stereo_layout, tolerance=tolerance,
+                             encoder=encoder, preset=preset, threads=threads, previews=previews)
+        info(f"Created stereo video {mp4_path} from {len(data)} image pairs")
+        df = pd.DataFrame(data, columns=['timestamp', 'left', 'right'])
+        df.to_csv(f'{csv_path.parent}/{mp4_path.stem}.csv', index=False)
+        return
+
     # Some basic checks
-    if not image_path.exists():
+    if not image_path or not image_path.exists():
         info(f"Image path {image_path} does not exist")
         return
 
     mp4_path.parent.mkdir(parents=True, exist_ok=True)
 
+    # Proxies, thumbnails and the contact sheet are made from the frames decoded for the mp4
+    previews = None
+    if with_previews:
+        previews = Previews(mp4_path.parent, mp4_path.stem, proxy_heights, thumbnail_size if thumbnails else 0,
+                            contact_sheet)
+
+    if incremental:
+        # Append the new images to the playlist and their timestamps to the csv file
+        m3u8_path = mp4_path.with_suffix('.m3u8')
+        first_run = not state_file(m3u8_path).exists()
+        data = append_to_hls(image_path.as_posix(), m3u8_path.as_posix(), demosaic='bayer' in image_path.as_posix(),
+                             num_images=num_images, workers=workers, preset=preset, threads=threads)
+        info(f"Appended {len(data)} images from {image_path} to {m3u8_path}")
+        if data or first_run:
+            df = pd.DataFrame(data, columns=['timestamp', 'filename'])
+            df.to_csv(f'{csv_path.parent}/{mp4_path.stem}.csv', mode='w' if first_run else 'a', header=first_run,
+                      index=False)
+        return
+
     if 'bayer' in image_path.as_posix():
         info(f"Creating mp4 from bayer images {image_path}")
-        data = image_to_mp4(image_path.as_posix(), mp4_path.as_posix(), demosaic=True, num_images=num_images)
+        data = image_to_mp4(image_path.as_posix(), mp4_path.as_posix(), demosaic=True, num_images=num_images,
+                            workers=workers, segments=segments, previews=previews, encoder=encoder, preset=preset,
+                            threads=threads)
         if data:
             info(f"Created {mp4_path} found {len(data)} images for {image_path}")
         else:
             info(f"Unable to create mp4 from bayer images {image_path}")
     else:
         info(f"Creating mp4 from images {image_path}")
-        data = image_to_mp4(image_path.as_posix(), mp4_path.as_posix(), num_images=num_images)
+        data = image_to_mp4(image_path.as_posix(), mp4_path.as_posix(), num_images=num_images, workers=workers,
+                            segments=segments, previews=previews, encoder=encoder, preset=preset, threads=threads)
         if data:
             info(f"Created {mp4_path} found {len(data)} images for {image_path}")
         else:
@@ -53,38 +140,135 @@ def create_video(input: Path, num_images: int, output: Path, csv: Path):
     df.to_csv(f'{csv_path.parent}/{mp4_path.stem}.csv', index=False)
 
 
+@click.command("create-videos", help="Create mp4 video files from every image folder in a mission tree")
+@click.option('--input', '-i', type=Path, required=True, help='Mission root to search for image folders')
+@click.option('--output', '-o', type=Path, required=True, help='Directory to save the mp4 files to')
+@click.option('--csv', type=Path, help='Directory to save the csv files with timestamps to. Default is --output')
+@click.option('--num-images', type=int, default=0, help='(Optional) number of images to use in each mp4. 0 for all')
+@click.option('--max-encodes', type=int, help='Maximum number of folders to encode at a time. '
+                                              'Default is a quarter of the CPUs')
+@click.option('--cpus', type=int, help='Number of CPUs to use in total. Default is the number of CPUs')
+@click.option('--force', is_flag=True, help='Encode folders whose mp4 and csv are newer than the images')
+@click.option('--encoder', type=click.Choice(ENCODERS), help='Video encoder. Default is ffmpeg if available, otherwise cv2')
+@click.option('--preset', type=click.Choice(list(ENCODER_PRESETS)), default='default',
+              help='Encoder preset: archive for the smallest files with a slow encode, preview for a fast, 480p encode')
+@click.option('--summary', type=Path, help='Path to append the summary of frames/s per folder to. '
+                                           'Default is create_videos.csv in --output')
+def create_videos(input: Path, output: Path, csv: Path, num_images: int, max_encodes: int, cpus: int, force: bool,
+                  encoder: str, preset: str, summary: Path):
+    """
+    Create mp4 files for all the image folders under a mission root, skipping those already up to date
+    :return:
+    """
+    if not input.exists():
+        info(f"Image path {input} does not exist")
+        return
+
+    jobs = find_video_jobs(input, output, csv or output)
+    if not jobs:
+        err(f"Could not find any images in {input}")
+        return
+    info(f"Found {len(jobs)} image folders in {input}")
+
+    results = run_video_jobs(jobs, num_images=num_images, max_encodes=max_encodes, cpus=cpus, force=force,
+                             encoder=encoder, preset=preset)
+    output.mkdir(parents=True, exist_ok=True)
+    write_summary(results, summary or output / 'create_videos.csv')
+
+
 @click.command("extract-log", help="Extract timestamp, depth, position, etc. from lcm logs")
-@click.option("--log", type=Path,  required=True, help="LCM log file")
-@click.option('--usbl-channel', '-i', required=True, help='USBL channel name (gps_fix_t)')
-@click.option('--depth-channel', '-i', required=True, help='Depth channel name (depth_t)')
-@click.option('--output', '-o', required=True, help='Filtered output file of raw combined USBL and depth events')
+@click.option("--log", type=Path,  required=True,
+              help="LCM log file, a directory of lcmlog.* segments or a quoted glob, e.g. '/data/lcmlog.*'")
+@click.option('--channel', '-c', 'channels', multiple=True,
+              help='Channel to extract as NAME:TYPE with a compas_lcmtypes type, e.g. LASS_DEPTH:depth_t. '
+                   'Repeat for more channels')
+@click.option('--usbl-channel', help='USBL channel name (gps_fix_t). Same as --channel NAME:gps_fix_t')
+@click.option('--depth-channel', help='Depth channel name (depth_t). Same as --channel NAME:depth_t')
+@click.option('--output', '-o', required=True, help='Directory to save the output files to')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default='csv',
+              help='Output format. parquet and npz store typed columns with lcm_timestamp in nanoseconds '
+                   'and load without text parsing. parquet needs pyarrow')
 @click.option('--prefix', '-p', required=True, help='File prefix for output files')
-def extract_log(log: Path, usbl_channel: str, depth_channel: str, output: str, prefix: str):
+@click.option('--workers', type=int, help='Number of log segments to extract at a time. Default is the number of CPUs')
+@click.option('--start', help='(Optional) Start of the time window to extract as an epoch timestamp or ISO datetime (UTC)')
+@click.option('--end', help='(Optional) End of the time window to extract as an epoch timestamp or ISO datetime (UTC)')
+@click.option('--images', type=Path, help='(Optional) Extract the time window of the images in this directory, '
+                                          'e.g. 1699643617662483.png')
+@click.option('--pad', type=float, default=60., help='Seconds to pad the time window of the images by')
+def extract_log(log: Path, channels: tuple, usbl_channel: str, depth_channel: str, output: str, fmt: str,
+                prefix: str, workers: int, start: str, end: str, images: Path, pad: float):
     """
-    Extract navigation data (lat/lon, depth) from an LCM log using CoMPAS LCM types.
+    Extract data (lat/lon, depth, heading, CTD, etc.) from an LCM log using CoMPAS LCM types. All channels
+    are extracted in a single read of the log, one file per channel.
     """
+    channels = list(channels)
+    if usbl_channel:
+        channels.append(f'{usbl_channel}:gps_fix_t')
+    if depth_channel:
+        channels.append(f'{depth_channel}:depth_t')
+    if not channels:
+        raise click.UsageError('Need at least one --channel, --usbl-channel or --depth-channel')
+    try:
+        decoders = parse_channels(channels)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--channel')
+    try:
+        check_format(fmt)
+    except ImportError as e:
+        raise click.BadParameter(str(e), param_hint='--format')
 
-    # Check if the LCM log file exists
-    if not log.exists():
+    # Check if the LCM log files exist
+    segments = find_segments(log)
+    if not segments or not all(s.exists() for s in segments):
         logging.error(f"LCM log file {log} does not exist")
+        return
+
+    t_start = to_microseconds(start) if start else None
+    t_end = to_microseconds(end) if end else None
+    if images:
+        files = discover_images(images)
+        stems = files.stems[np.char.isdigit(files.stems)]
+        if len(stems) == 0:
+            raise click.BadParameter(f'No timestamped images found in {images}', param_hint='--images')
+        timestamps = timestamps_to_datetime64(stems).astype('datetime64[us]').astype(np.int64)
+        t_start = int(timestamps.min() - pad * 1e6) if t_start is None else t_start
+        t_end = int(timestamps.max() + pad * 1e6) if t_end is None else t_end
 
-    info(f"Parsing LCM log {log}")
+    info(f"Extracting {len(decoders)} channels from {len(segments)} LCM log segments {log}")
+    if t_start is not None or t_end is not None:
+        info(f"Using time window {t_start} to {t_end}")
 
-    # Parse the LCM log to extract USBL and depth data
-    usbl_data, depth_data = parse_log(log, usbl_channel, depth_channel)
+    # Decode the events as they are read and write them straight to a file per channel, merging the segments
+    Path(output).mkdir(parents=True, exist_ok=True)
+    paths = {channel: Path(output) / f"{prefix}_{channel}.{fmt}" for channel in decoders}
+    counts = extract_segments(segments, channels, paths, workers=workers, t_start=t_start, t_end=t_end)
 
-    info(f"Found {len(usbl_data)} USBL events")
-    info(f"Found {len(depth_data)} depth events")
+    for channel, count in counts.items():
+        info(f"Wrote {count} {decoders[channel].lcm_type.__name__} events to {paths[channel]}")
 
-    # Write USBL data to a CSV file
-    output_path = Path(output) / f"{prefix}_{usbl_channel}.csv"
-    write_usbl_csv(output_path.as_posix(), usbl_data)
-    info(f"Wrote USBL data to {output_path}")
 
-    # Write depth data to a CSV file
-    output_path = Path(output) / f"{prefix}_{depth_channel}.csv"
-    write_depth_csv(output_path.as_posix(), depth_data)
-    info(f"Wrote depth data to {output_path}")
+@click.command("filter-log", help="Write a time ordered LCM log with only the selected channels")
+@click.option("--log", type=Path, required=True,
+              help="LCM log file, a directory of lcmlog.* segments or a quoted glob, e.g. '/data/lcmlog.*'")
+@click.option('--channel', '-c', 'channels', multiple=True, help='Channel to keep. Repeat for more channels. '
+                                                                 'Default is all channels')
+@click.option('--output', '-o', type=Path, required=True, help='Path to save the filtered LCM log to')
+@click.option('--max-memory', type=int, default=256, help='Megabytes of events to sort in memory at a time')
+@click.option('--renumber', is_flag=True, help='Number the events from 0 in the filtered log')
+def filter_log(log: Path, channels: tuple, output: Path, max_memory: int, renumber: bool):
+    """
+    Filter and re-time-order LCM logs of any size with an external merge sort
+    """
+    segments = find_segments(log)
+    if not segments or not all(s.exists() for s in segments):
+        logging.error(f"LCM log file {log} does not exist")
+        return
+
+    info(f"Filtering {len(segments)} LCM log segments {log} to {output}")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    events = itertools.chain.from_iterable(iter_events(s, channels or None) for s in segments)
+    count = write_log(output, events, max_bytes=max_memory * 1024 * 1024, renumber=renumber)
+    info(f"Wrote {count} events to {output}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,257 @@
+# sightwire, Apache-2.0 license
+# Filename: convertors/decoders.py
+# Description: Registry of LCM message decoders keyed by compas_lcmtypes type. Each decoder turns an event into a
+# CSV row. The navigation types have hand written decoders, any other type is flattened from its LCM definition.
+# Fixed-layout messages are decoded in batches through a NumPy structured dtype derived from the LCM definition
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from lcmlog import Event
+from compas_lcmtypes import senlcm, navlcm, geolcm, stdlcm
+from compas_lcmtypes.senlcm import gps_fix_t, depth_t
+
+LCM_MODULES = [senlcm, navlcm, geolcm, stdlcm]
+LCM_PRIMITIVES = {'int8_t': 'i1', 'int16_t': '>i2', 'int32_t': '>i4', 'int64_t': '>i8', 'float': '>f4',
+                  'double': '>f8', 'boolean': '?', 'byte': 'u1'}
+FINGERPRINT = 'fingerprint'
+
+
+@dataclass
+class Decoder:
+    lcm_type: type
+    columns: List[str]  # Columns after lcm_timestamp
+    values: Callable[[object], tuple]  # Decoded message to the column values
+    paths: Optional[List[tuple]] = None  # Field path of each column for batch decoding, e.g. ('header', 'timestamp')
+
+    def header(self) -> str:
+        """
+        CSV header line, without the newline
+        """
+        return ','.join(['lcm_timestamp'] + self.columns)
+
+    def row(self, event: Event) -> str:
+        """
+        CSV line for an event
+        """
+        message = self.lcm_type.decode(event.data)
+        return ','.join(map(str, (event.header.timestamp, *self.values(message)))) + '\n'
+
+    def decode_batch(self, payloads: Sequence[bytes]) -> List[np.ndarray]:
+        """
+        Decode many payloads at once. Payloads are grouped by length, since the length fixes the size of any
+        string, e.g. header.frame_id. Each group with a fixed layout is viewed through a structured dtype in one
+        call, any other group is decoded one message at a time
+        :param payloads: Event payloads in order
+        :return: One array per column, in the order of the payloads
+        """
+        lengths = np.fromiter(map(len, payloads), dtype=np.int64, count=len(payloads))
+        unique = np.unique(lengths)
+        if len(unique) <= 1:
+            return self.decode_group(payloads, int(unique[0]) if len(unique) else 0)
+
+        parts, order = [], []
+        for length in unique:
+            idx = np.flatnonzero(lengths == length)
+            parts.append(self.decode_group([payloads[i] for i in idx], int(length)))
+            order.append(idx)
+        inverse = np.empty(len(payloads), dtype=np.int64)
+        inverse[np.concatenate(order)] = np.arange(len(payloads))
+        return [np.concatenate([p[c] for p in parts])[inverse] for c in range(len(self.columns))]
+
+    def decode_group(self, payloads: Sequence[bytes], length: int) -> List[np.ndarray]:
+        """
+        Decode payloads that all have the same length
+        """
+        structure = structured_dtype(self.lcm_type, length) if self.paths and payloads else None
+        if structure is not None:
+            dtype, string_lengths = structure
+            data = np.frombuffer(b''.join(payloads), dtype=dtype)
+            fingerprint = np.frombuffer(self.lcm_type._get_packed_fingerprint(), dtype='S8')[0]
+            if (data[FINGERPRINT] == fingerprint).all() and \
+                    all((field_path(data, p) == size).all() for p, size in string_lengths):
+                columns = [field_path(data, p) for p in self.paths]
+                return [c.astype(c.dtype.newbyteorder('=')) for c in columns]
+
+        rows = [self.values(self.lcm_type.decode(d)) for d in payloads]
+        if not rows:
+            return self.empty_columns()
+        return [np.asarray(values) for values in zip(*rows)]
+
+    def empty_columns(self) -> List[np.ndarray]:
+        """
+        Empty array per column with the dtype of its field, so files without events merge with the others
+        """
+        if not self.paths:
+            return [np.array([], dtype=np.float64) for _ in self.columns]
+        return [np.array([], dtype=field_dtype(self.lcm_type, p)) for p in self.paths]
+
+
+DECODERS: Dict[type, Decoder] = {}
+
+
+def register(lcm_type: type, columns: List[str], values: Callable[[object], tuple],
+             paths: Optional[List[tuple]] = None) -> Decoder:
+    """
+    Register a decoder for an LCM type, replacing any existing one
+    :param lcm_type: The compas_lcmtypes type, e.g. gps_fix_t
+    :param columns: Column names after lcm_timestamp
+    :param values: Function from the decoded message to the column values
+    :param paths: (optional) Field path of each column, e.g. ('header', 'timestamp'), to enable batch decoding
+    :return: The decoder
+    """
+    DECODERS[lcm_type] = Decoder(lcm_type, columns, values, paths)
+    return DECODERS[lcm_type]
+
+
+register(gps_fix_t, ['sensor_timestamp', 'latitude', 'longitude', 'altitude'],
+         lambda m: (m.header.timestamp, m.latitude, m.longitud, m.altitude),
+         [('header', 'timestamp'), ('latitude',), ('longitud',), ('altitude',)])
+register(depth_t, ['sensor_timestamp', 'depth', 'pressure'],
+         lambda m: (m.header.timestamp, m.depth, m.pressure),
+         [('header', 'timestamp'), ('depth',), ('pressure',)])
+
+
+def field_path(data: np.ndarray, path: tuple) -> np.ndarray:
+    """
+    Column of a structured array by field path, with integers indexing into array fields, e.g. ('rph', 0)
+    """
+    for p in path:
+        data = data[p] if isinstance(p, str) else data[:, p]
+    return data
+
+
+def field_dtype(lcm_type: type, path: tuple) -> np.dtype:
+    """
+    Native byte order dtype of a field of an LCM type by field path, e.g. ('header', 'timestamp') is int64
+    """
+    for p in path:
+        if not isinstance(p, str):
+            continue  # Index into an array field
+        type_name = lcm_type.__typenames__[lcm_type.__slots__.index(p)]
+        if type_name.startswith('compas_lcmtypes.'):
+            lcm_type = find_type(type_name[len('compas_lcmtypes.'):])
+        else:
+            return np.dtype(LCM_PRIMITIVES[type_name]).newbyteorder('=')
+    raise ValueError(f'{path} is not a primitive field of {lcm_type.__name__}')
+
+
+def layout(lcm_type: type, string_size: int, prefix: tuple = ()) -> Optional[Tuple[list, list]]:
+    """
+    Structured dtype fields of an LCM type encoding, without the fingerprint. Strings are encoded as a uint32
+    length followed by string_size bytes
+    :return: The dtype fields and the (path, size) of each string length field, or None for variable size arrays
+    """
+    fields, string_lengths = [], []
+    for name, type_name, dims in zip(lcm_type.__slots__, lcm_type.__typenames__, lcm_type.__dimensions__):
+        if dims is not None and not all(isinstance(d, int) for d in dims):
+            return None
+        shape = tuple(dims) if dims else ()
+        if type_name.startswith('compas_lcmtypes.'):
+            if shape:
+                return None
+            nested = layout(find_type(type_name[len('compas_lcmtypes.'):]), string_size, prefix + (name,))
+            if nested is None:
+                return None
+            fields.append((name, nested[0]))
+            string_lengths += nested[1]
+        elif type_name == 'string':
+            if shape:
+                return None
+            fields += [(f'{name}_len', '>u4'), (name, f'S{string_size}')]
+            string_lengths.append((prefix + (f'{name}_len',), string_size))
+        else:
+            fields.append((name, LCM_PRIMITIVES[type_name], shape) if shape else (name, LCM_PRIMITIVES[type_name]))
+    return fields, string_lengths
+
+
+def structured_dtype(lcm_type: type, length: int) -> Optional[Tuple[np.dtype, list]]:
+    """
+    Structured dtype of an encoded LCM message of a given length, including the fingerprint. The length sets the
+    size of a string if the type has one
+    :param lcm_type: The compas_lcmtypes type, e.g. depth_t
+    :param length: Payload length in bytes
+    :return: The dtype and the (path, size) of each string length field, or None if the layout is not fixed
+    """
+    probe = layout(lcm_type, 1)
+    if probe is None:
+        return None
+    num_strings = len(probe[1])
+    fixed = 8 + np.dtype(probe[0]).itemsize - num_strings
+    if num_strings == 0:
+        return (np.dtype([(FINGERPRINT, 'S8')] + probe[0]), []) if fixed == length else None
+    if num_strings > 1 or length - fixed < 1:
+        return None
+    fields, string_lengths = layout(lcm_type, length - fixed)
+    return np.dtype([(FINGERPRINT, 'S8')] + fields), string_lengths
+
+
+def flatten(lcm_type: type, prefix: str = '') -> List[Tuple[str, Callable[[object], object], tuple]]:
+    """
+    Columns of an LCM type: scalars as is, fixed size arrays as name_0, name_1, ... and nested types with their
+    field names as a prefix, e.g. name_0_value for an array of nested types. The header becomes sensor_timestamp.
+    Strings, bytes, variable size and multi-dimensional arrays are skipped
+    :return: (column name, getter, field path) for each column
+    """
+    fields = []
+    for name, type_name, dims in zip(lcm_type.__slots__, lcm_type.__typenames__, lcm_type.__dimensions__):
+        get = (lambda n: lambda m: getattr(m, n))(name)
+        if dims is not None and not (len(dims) == 1 and isinstance(dims[0], int)):
+            continue  # Variable size or multi-dimensional array
+        if type_name == 'compas_lcmtypes.stdlcm.header_t' and dims is None:
+            fields.append((f'{prefix}sensor_timestamp', (lambda g: lambda m: g(m).timestamp)(get), (name, 'timestamp')))
+        elif type_name.startswith('compas_lcmtypes.'):
+            nested = flatten(find_type(type_name[len('compas_lcmtypes.'):]))
+            if dims is None:
+                fields += [(f'{prefix}{name}_{column}', (lambda g, f: lambda m: f(g(m)))(get, nested_get),
+                            (name,) + path) for column, nested_get, path in nested]
+            else:
+                fields += [(f'{prefix}{name}_{i}_{column}', (lambda g, i, f: lambda m: f(g(m)[i]))(get, i, nested_get),
+                            (name, i) + path) for i in range(dims[0]) for column, nested_get, path in nested]
+        elif type_name in ('string', 'byte'):
+            continue
+        elif dims is None:
+            fields.append((f'{prefix}{name}', get, (name,)))
+        else:
+            fields += [(f'{prefix}{name}_{i}', (lambda g, i: lambda m: g(m)[i])(get, i), (name, i))
+                       for i in range(dims[0])]
+    return fields
+
+
+def find_type(type_name: str) -> type:
+    """
+    Find a compas_lcmtypes type by name, e.g. ctd_t or senlcm.ctd_t
+    """
+    module_name, _, name = type_name.rpartition('.')
+    for module in LCM_MODULES:
+        if module_name and not module.__name__.endswith(module_name):
+            continue
+        if hasattr(module, name):
+            return getattr(module, name)
+    raise ValueError(f'Unknown LCM type {type_name}')
+
+
+def get_decoder(type_name: str) -> Decoder:
+    """
+    Decoder for a compas_lcmtypes type name, e.g. gps_fix_t. Types without a registered decoder are flattened
+    """
+    lcm_type = find_type(type_name)
+    if lcm_type not in DECODERS:
+        fields = flatten(lcm_type)
+        register(lcm_type, [column for column, _, _ in fields], lambda m: tuple(get(m) for _, get, _ in fields),
+                 [path for _, _, path in fields])
+    return DECODERS[lcm_type]
+
+
+def parse_channels(channels: List[str]) -> Dict[str, Decoder]:
+    """
+    Parse NAME:TYPE channel mappings, e.g. LASS_DEPTH:depth_t
+    :return: Decoder for each channel name
+    """
+    decoders = {}
+    for channel in channels:
+        name, sep, type_name = channel.rpartition(':')
+        if not sep or not name:
+            raise ValueError(f'Expected NAME:TYPE, got {channel}')
+        decoders[name] = get_decoder(type_name)
+    return decoders
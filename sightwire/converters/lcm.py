@@ -1,21 +1,304 @@
 # sightwire, Apache-2.0 license
 # Filename: convertors/lcm.py
 # Description:  LCM logs conversion courtesy K. Barnard. Replaced argparse with click and restyled.
+import heapq
+from concurrent.futures import ProcessPoolExecutor
 from datetime import timedelta
+from tempfile import TemporaryDirectory as tempdir
 from pathlib import Path
-from typing import List, Tuple
- 
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
 from sightwire.logger import info
-from lcmlog import LogReader, LogWriter, Event
+from lcmlog import Event, Header, BadSyncError
+from lcmlog.event import LCM_SYNCWORD, STRING_ENCODING
 from compas_lcmtypes.senlcm import gps_fix_t, depth_t
- 
+from sightwire.converters.columnar import COLUMNAR_SUFFIXES, check_format, merge_columns, write_columns
+from sightwire.converters.decoders import DECODERS, Decoder, parse_channels
+from sightwire.converters.lcm_index import EVENT_HEADER, INDEX_SUFFIX, iter_window
+
+READ_BUFFER = 4 * 1024 * 1024
+WRITE_BUFFER = 1024 * 1024
+RUN_BYTES = 256 * 1024 * 1024  # Events to hold in memory at a time when sorting a log
+MERGE_FAN_IN = 64  # Sorted runs merged at a time, so open files and read buffers stay bounded
+MERGE_BUFFER = 64 * 1024  # Read buffer of each run being merged
+
+
+def iter_events(log_path: Path, channels: Optional[Sequence[str]] = None, t_start: Optional[int] = None,
+                t_end: Optional[int] = None, buffering: int = READ_BUFFER) -> Iterator[Event]:
+    """
+    Stream the events in an LCM log in file order. The payload of events on other channels is skipped without
+    being read, so memory stays constant and unwanted channels cost only a seek. With a time window, the log index
+    is used to read only the events in the window
+    :param log_path: Path to the LCM log file
+    :param channels: (optional) Channels to keep. None to keep all
+    :param t_start: (optional) Start time in microseconds
+    :param t_end: (optional) End time in microseconds
+    :param buffering: (optional) Read buffer size in bytes
+    :return: Iterator of events
+    """
+    if t_start is not None or t_end is not None:
+        yield from iter_window(log_path, channels, t_start, t_end)
+        return
+    channels = set(channels) if channels is not None else None
+    offset = 0
+    with open(log_path, 'rb', buffering=buffering) as f:
+        while True:
+            raw = f.read(EVENT_HEADER.size)
+            if len(raw) < EVENT_HEADER.size:
+                return
+            syncword, event_number, timestamp, channel_length, data_length = EVENT_HEADER.unpack(raw)
+            if syncword != LCM_SYNCWORD:
+                raise BadSyncError(syncword, offset)
+            channel = f.read(channel_length).decode(STRING_ENCODING)
+            if channels is None or channel in channels:
+                yield Event(Header(event_number, timestamp, channel_length, data_length), channel, f.read(data_length))
+            else:
+                f.seek(data_length, 1)
+            offset += EVENT_HEADER.size + channel_length + data_length
+
+
+class CsvSink:
+    """
+    Buffered CSV output. Events are decoded in batches of FLUSH_ROWS and written as rows
+    """
+    FLUSH_ROWS = 65536
+
+    def __init__(self, output_path: Path, decoder: Decoder):
+        """
+        :param output_path: Path to the output file
+        :param decoder: Decoder for the events, e.g. get_decoder('depth_t')
+        """
+        check_format(Path(output_path).suffix[1:])
+        self.output_path = output_path
+        self.decoder = decoder
+        self.count = 0
+        self.timestamps = []
+        self.payloads = []
+        self.f = open(output_path, "w", buffering=WRITE_BUFFER)
+        self.f.write(f"{decoder.header()}\n")
+
+    def write(self, event: Event):
+        self.timestamps.append(event.header.timestamp)
+        self.payloads.append(event.data)
+        self.count += 1
+        if len(self.payloads) >= self.FLUSH_ROWS:
+            self.flush()
+
+    def flush(self):
+        if not self.payloads:
+            return
+        columns = [c.tolist() for c in self.decoder.decode_batch(self.payloads)]
+        self.f.writelines(','.join(map(str, row)) + '\n' for row in zip(self.timestamps, *columns))
+        self.timestamps, self.payloads = [], []
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ColumnarSink:
+    """
+    Typed columnar output (parquet or npz, by the file extension). Events are decoded in batches of FLUSH_ROWS into
+    int64/float64 arrays and written on close, with lcm_timestamp in nanoseconds
+    """
+    FLUSH_ROWS = 65536
+
+    def __init__(self, output_path: Path, decoder: Decoder):
+        """
+        :param output_path: Path to the output file, e.g. DEPTH.parquet
+        :param decoder: Decoder for the events, e.g. get_decoder('depth_t')
+        """
+        self.output_path = output_path
+        self.decoder = decoder
+        self.count = 0
+        self.timestamps = []
+        self.payloads = []
+        self.chunks = []
+
+    def write(self, event: Event):
+        self.timestamps.append(event.header.timestamp)
+        self.payloads.append(event.data)
+        self.count += 1
+        if len(self.payloads) >= self.FLUSH_ROWS:
+            self.flush()
+
+    def flush(self):
+        if not self.payloads:
+            return
+        chunk = {'lcm_timestamp': np.array(self.timestamps, dtype=np.int64) * 1000}
+        chunk.update(zip(self.decoder.columns, self.decoder.decode_batch(self.payloads)))
+        self.chunks.append(chunk)
+        self.timestamps, self.payloads = [], []
+
+    def close(self):
+        self.flush()
+        if self.chunks:
+            columns = {name: np.concatenate([c[name] for c in self.chunks]) for name in self.chunks[0]}
+        else:
+            columns = {'lcm_timestamp': np.array([], dtype=np.int64)}
+            columns.update(zip(self.decoder.columns, self.decoder.empty_columns()))
+        write_columns(self.output_path, columns)
+        self.chunks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def make_sink(output_path: Path, decoder: Decoder) -> Union[CsvSink, ColumnarSink]:
+    """
+    Sink for an output file, csv or columnar by the file extension
+    """
+    if Path(output_path).suffix in COLUMNAR_SUFFIXES:
+        return ColumnarSink(output_path, decoder)
+    return CsvSink(output_path, decoder)
+
+
+def extract(log_path: Path, sinks: Dict[str, Union[CsvSink, ColumnarSink]], t_start: Optional[int] = None,
+            t_end: Optional[int] = None) -> Dict[str, int]:
+    """
+    Extract events from an LCM log into sinks in a single read of the log. Each event is routed to the sink for
+    its channel
+    :param log_path: Path to the LCM log file
+    :param sinks: Sink for each channel to extract
+    :param t_start: (optional) Start time in microseconds
+    :param t_end: (optional) End time in microseconds
+    :return: Number of events written for each channel
+    """
+    first_timestamp = None
+    try:
+        for idx, event in enumerate(iter_events(log_path, sinks.keys(), t_start, t_end), start=1):
+            timestamp = event.header.timestamp
+            if first_timestamp is None:
+                first_timestamp = timestamp
+
+            # Log the progress every 10000 events
+            if idx % 10000 == 0:
+                info(f"Processing event {idx} at {timedelta(microseconds=timestamp - first_timestamp)}")
+
+            sinks[event.channel].write(event)
+    finally:
+        for sink in sinks.values():
+            sink.close()
+    return {channel: sink.count for channel, sink in sinks.items()}
 
-def parse_log(log_path: Path, usbl_channel: str, depth_channel: str) -> Tuple[List[Event], List[Event]]:
+
+def find_segments(log_path: Path) -> List[Path]:
+    """
+    Find the segments of a log rolled into lcmlog.00, lcmlog.01, ...
+    :param log_path: A log file, a directory of lcmlog.* segments or a glob, e.g. /data/lcmlog.*
+    :return: Segment paths in order
+    """
+    log_path = Path(log_path)
+    if log_path.is_dir():
+        paths = log_path.glob('lcmlog*')
+    elif any(c in log_path.name for c in '*?['):
+        paths = log_path.parent.glob(log_path.name)
+    else:
+        return [log_path]
+    return sorted(p for p in paths if p.is_file() and not p.name.endswith(INDEX_SUFFIX))
+
+
+def iter_segments(segments: List[Path], channels: Optional[Sequence[str]] = None, t_start: Optional[int] = None,
+                  t_end: Optional[int] = None) -> Iterator[Event]:
+    """
+    Stream the events of several segments merged in timestamp order. Each segment must be in timestamp order,
+    as written by the LCM logger
+    """
+    if len(segments) == 1:
+        return iter_events(segments[0], channels, t_start, t_end)
+    return heapq.merge(*[iter_events(s, channels, t_start, t_end) for s in segments],
+                       key=lambda e: e.header.timestamp)
+
+
+def extract_segment(log_path: Path, channels: List[str], output_path: Path, t_start: Optional[int] = None,
+                    t_end: Optional[int] = None, suffix: str = '.csv') -> Dict[str, int]:
+    """
+    Extract the channels of one segment to a file per channel. Runs in a worker process, so the channels are
+    passed as NAME:TYPE strings and the decoders looked up here
+    """
+    decoders = parse_channels(channels)
+    return extract(log_path, {channel: make_sink(output_path / f'{channel}{suffix}', decoder)
+                              for channel, decoder in decoders.items()}, t_start, t_end)
+
+
+def lcm_timestamp(line: str) -> int:
+    return int(line[:line.index(',')])
+
+
+def merge_csv(inputs: List[Path], output_path: Path):
+    """
+    K-way merge of time ordered csv files with the same columns by their first column, the lcm_timestamp
+    """
+    files = [open(p, buffering=READ_BUFFER) for p in inputs]
+    try:
+        with open(output_path, 'w', buffering=WRITE_BUFFER) as out:
+            out.write(files[0].readline())
+            for f in files[1:]:
+                f.readline()
+            out.writelines(heapq.merge(*files, key=lcm_timestamp))
+    finally:
+        for f in files:
+            f.close()
+
+
+def extract_segments(segments: List[Path], channels: List[str], outputs: Dict[str, Path],
+                     workers: int = None, t_start: Optional[int] = None, t_end: Optional[int] = None) -> Dict[str, int]:
+    """
+    Extract channels from a log rolled into segments. Segments are extracted concurrently in a process pool and the
+    per-segment files merged by timestamp, so the time is close to that of the largest segment
+    :param segments: Segment paths, e.g. from find_segments
+    :param channels: Channels to extract as NAME:TYPE, e.g. LASS_DEPTH:depth_t
+    :param outputs: Output file for each channel name. The extension sets the format: .csv, .parquet or .npz
+    :param workers: (optional) Number of processes. Default is the number of CPUs
+    :param t_start: (optional) Start time in microseconds
+    :param t_end: (optional) End time in microseconds
+    :return: Number of events written for each channel
+    """
+    decoders = parse_channels(channels)
+    if len(segments) == 1:
+        return extract(segments[0], {channel: make_sink(outputs[channel], decoder)
+                                     for channel, decoder in decoders.items()}, t_start, t_end)
+
+    work_path = Path(next(iter(outputs.values()))).parent
+    suffix = Path(next(iter(outputs.values()))).suffix
+    with tempdir(dir=work_path) as workdir, ProcessPoolExecutor(max_workers=workers) as pool:
+        segment_paths = [Path(workdir) / f'{i:04d}' for i in range(len(segments))]
+        for p in segment_paths:
+            p.mkdir()
+        futures = [pool.submit(extract_segment, s, channels, p, t_start, t_end, suffix) for s, p in zip(segments, segment_paths)]
+        counts = {channel: 0 for channel in decoders}
+        for segment, future in zip(segments, futures):
+            segment_counts = future.result()
+            info(f"Extracted {sum(segment_counts.values())} events from {segment}")
+            for channel, count in segment_counts.items():
+                counts[channel] += count
+
+        for channel in decoders:
+            merge = merge_columns if suffix in COLUMNAR_SUFFIXES else merge_csv
+            merge([p / f'{channel}{suffix}' for p in segment_paths], outputs[channel])
+    return counts
+
+
+def parse_log(log_path: Path, usbl_channel: str, depth_channel: str, t_start: Optional[int] = None,
+              t_end: Optional[int] = None) -> Tuple[List[Event], List[Event]]:
     """
     Parse an LCM log and extract navigation data.
-    :param log_path: Path to the LCM log file.
+    :param log_path: Path to the LCM log file, a directory of segments or a glob, e.g. /data/lcmlog.*
     :param usbl_channel (str) USBL channel name.
     :param depth_channel (str) Depth channel name.
+    :param t_start: (optional) Start time in microseconds
+    :param t_end: (optional) End time in microseconds
     :returns:
         Tuple[List[Event], List[Event]]: A tuple containing two lists:
             - usbl_data: List of USBL events.
@@ -25,12 +308,9 @@ def parse_log(log_path: Path, usbl_channel: str, depth_channel: str) -> Tuple[Li
     usbl_data = []
     depth_data = []
 
-    # Create a LogReader object to read the LCM log file
-    reader = LogReader(str(log_path))
-
-    # Iterate over each event in the LCM log
+    # Iterate over the USBL and depth events in the LCM log
     first_timestamp = None
-    for idx, event in enumerate(reader, start=1):
+    for idx, event in enumerate(iter_segments(find_segments(log_path), [usbl_channel, depth_channel], t_start, t_end), start=1):
         # Calculate the time difference from the first event
         timestamp = event.header.timestamp
         if first_timestamp is None:
@@ -52,15 +332,98 @@ def parse_log(log_path: Path, usbl_channel: str, depth_channel: str) -> Tuple[Li
     return usbl_data, depth_data
 
 
-def write_log(log_path: Path, data: List[Event]):
+def event_timestamp(event: Event) -> int:
+    return event.header.timestamp
+
+
+def write_events(log_path: Path, events: Iterable[Event], renumber: bool = False) -> int:
+    """
+    Write events to an LCM log file in the order given
+    :param log_path: Path to LCM log file
+    :param events: Events to write
+    :param renumber: True to number the events from 0 in the order written
+    :return: Number of events written
+    """
+    count = 0
+    with open(log_path, 'wb', buffering=WRITE_BUFFER) as f:
+        for event in events:
+            if renumber:
+                event = Event(Header(count, event.header.timestamp, event.header.channel_length,
+                                     event.header.data_length), event.channel, event.data)
+            event.write_to(f)
+            count += 1
+    return count
+
+
+def merge_runs(runs: List[Path]) -> Iterator[Event]:
+    """
+    Merge sorted run files by timestamp. Equal timestamps keep the order of the runs
+    """
+    return heapq.merge(*[iter_events(r, buffering=MERGE_BUFFER) for r in runs], key=event_timestamp)
+
+
+def sort_events(events: Iterable[Event], max_bytes: int = RUN_BYTES, work_path: Optional[Path] = None,
+                fan_in: int = MERGE_FAN_IN) -> Iterator[Event]:
+    """
+    Sort events by timestamp in bounded memory. Events are gathered into runs of about max_bytes, each run is
+    sorted and written to a temporary log, and the runs are merged. With more than fan_in runs, groups of fan_in runs
+    are merged into longer runs first, so at most fan_in files are open at a time. Equal timestamps keep their input
+    order
+    :param events: Events in any order
+    :param max_bytes: Approximate size of the events to hold in memory at a time
+    :param work_path: (optional) Directory for the temporary run files. Default is the system temporary directory
+    :param fan_in: (optional) Maximum number of runs to merge at a time
+    :return: Iterator of the events in timestamp order
+    """
+    with tempdir(dir=work_path) as workdir:
+        runs = []
+        run = []
+        size = 0
+        for event in events:
+            run.append(event)
+            size += EVENT_HEADER.size + event.header.channel_length + event.header.data_length
+            if size >= max_bytes:
+                runs.append(Path(workdir) / f'run{len(runs):05d}')
+                write_events(runs[-1], sorted(run, key=event_timestamp))
+                run, size = [], 0
+
+        if not runs:
+            yield from sorted(run, key=event_timestamp)
+            return
+        if run:
+            runs.append(Path(workdir) / f'run{len(runs):05d}')
+            write_events(runs[-1], sorted(run, key=event_timestamp))
+        del run
+        merge_pass = 0
+        while len(runs) > fan_in:
+            info(f"Merging {len(runs)} sorted runs in groups of {fan_in}")
+            merged = []
+            for i in range(0, len(runs), fan_in):
+                merged.append(Path(workdir) / f'merge{merge_pass}_{len(merged):05d}')
+                write_events(merged[-1], merge_runs(runs[i:i + fan_in]))
+                for r in runs[i:i + fan_in]:
+                    r.unlink()
+            runs = merged
+            merge_pass += 1
+        info(f"Merging {len(runs)} sorted runs")
+        yield from merge_runs(runs)
+
+
+def write_log(log_path: Path, data: Union[List[Event], Iterable[Event]], max_bytes: int = RUN_BYTES,
+              renumber: bool = False) -> int:
     """
-    Write an LCM log file. Events will be sorted by timestamp
+    Write an LCM log file. Events will be sorted by timestamp. A list is sorted in memory, any other iterable,
+    e.g. from iter_events, with an external merge sort in bounded memory, so logs of any size can be written
     :log_path Path to LCM log file
-    :data List of events
+    :data List or iterator of events
+    :max_bytes Approximate size of the events to hold in memory at a time when sorting an iterator
+    :renumber True to number the events from 0 in the order written
+    :return Number of events written
     """
-    writer = LogWriter(str(log_path))
-    for event in sorted(data, key=lambda e: e.header.timestamp):  # Sort by event timestamp
-        writer.write(event)
+    log_path = Path(log_path)
+    if isinstance(data, list):
+        return write_events(log_path, sorted(data, key=event_timestamp), renumber)  # Sort by event timestamp
+    return write_events(log_path, sort_events(data, max_bytes, log_path.parent), renumber)
 
 
 def write_usbl_csv(output_path: Path, usbl_data: List[Event]):
@@ -69,13 +432,9 @@ def write_usbl_csv(output_path: Path, usbl_data: List[Event]):
     :output_path: Path to output file
     :usbl_data: List of USBL events
     """
-    with open(output_path, "w") as f:
-        f.write("lcm_timestamp,sensor_timestamp,latitude,longitude,altitude\n")
+    with CsvSink(output_path, DECODERS[gps_fix_t]) as sink:
         for event in usbl_data:
-            message = gps_fix_t.decode(event.data)
-            f.write(
-                f"{event.header.timestamp},{message.header.timestamp},{message.latitude},{message.longitud},{message.altitude}\n"
-            )
+            sink.write(event)
 
 
 def write_depth_csv(output_path: Path, depth_data: List[Event]):
@@ -84,8 +443,6 @@ def write_depth_csv(output_path: Path, depth_data: List[Event]):
     :output_path: Path to output file
     :depth_data: List of depth events
     """
-    with open(output_path, "w") as f:
-        f.write("lcm_timestamp,sensor_timestamp,depth,pressure\n")
+    with CsvSink(output_path, DECODERS[depth_t]) as sink:
         for event in depth_data:
-            message = depth_t.decode(event.data)
-            f.write(f"{event.header.timestamp},{message.header.timestamp},{message.depth},{message.pressure}\n")
+            sink.write(event)
@@ -0,0 +1,319 @@
+# sightwire, Apache-2.0 license
+# Filename: convertors/lcm_follow.py
+# Description: Live navigation from LCM. Follows a growing lcmlog file or a UDP LCM multicast and keeps a rolling,
+# time-indexed buffer of depth and position fixes with O(log n) nearest and interpolated lookup
+import abc
+import math
+import os
+import socket
+import struct
+import threading
+import time
+from bisect import bisect_left
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple
+from urllib.parse import urlparse
+
+from lcmlog import Event
+from lcmlog.event import LCM_SYNCWORD, STRING_ENCODING
+from compas_lcmtypes.senlcm import gps_fix_t, depth_t
+
+from sightwire.converters.decoders import DECODERS
+from sightwire.converters.lcm import find_segments
+from sightwire.converters.lcm_index import EVENT_HEADER
+from sightwire.logger import info, debug, err
+
+DEFAULT_LCM_URL = 'udpm://239.255.76.67:7667'
+LCM_SHORT_MAGIC = 0x4c433032  # LC02, a message in a single datagram
+LCM_SHORT_HEADER = struct.Struct('>II')  # magic, sequence number
+RECEIVE_BUFFER = 8 * 1024 * 1024  # Room for bursts, e.g. a replay at full speed
+NAV_COLUMNS = {'depth': ['depth'], 'position': ['latitude', 'longitude']}
+TRIM_SLACK = 0.1  # Fraction of max_age kept past it before trimming, so old samples are dropped in blocks
+
+
+class NavSeries:
+    """
+    Time ordered samples of one navigation source, trimmed to the last max_age seconds
+    """
+
+    def __init__(self, max_age: float = 3600.):
+        self.max_age_us = int(max_age * 1e6)
+        self.times = []
+        self.values = []
+
+    def add(self, t: int, values: tuple):
+        if not self.times or t >= self.times[-1]:
+            self.times.append(t)
+            self.values.append(values)
+        else:
+            i = bisect_left(self.times, t)
+            self.times.insert(i, t)
+            self.values.insert(i, values)
+
+        # Trim old samples in blocks of TRIM_SLACK * max_age so appends stay cheap
+        if self.times[-1] - self.times[0] > self.max_age_us * (1 + TRIM_SLACK):
+            cut = bisect_left(self.times, self.times[-1] - self.max_age_us)
+            del self.times[:cut]
+            del self.values[:cut]
+
+    def nearest(self, t: int, max_gap_us: Optional[int] = None) -> Optional[tuple]:
+        """
+        Values of the sample nearest to t, or None if there is none within max_gap_us
+        """
+        if not self.times:
+            return None
+        i = bisect_left(self.times, t)
+        candidates = [j for j in (i - 1, i) if 0 <= j < len(self.times)]
+        j = min(candidates, key=lambda k: abs(self.times[k] - t))
+        if max_gap_us is not None and abs(self.times[j] - t) > max_gap_us:
+            return None
+        return self.values[j]
+
+    def interp(self, t: int, max_gap_us: Optional[int] = None) -> Optional[tuple]:
+        """
+        Values linearly interpolated at t, or None if the nearest sample is more than max_gap_us away.
+        Outside the buffer the first or last sample is used, like np.interp
+        """
+        if self.nearest(t, max_gap_us) is None:
+            return None
+        i = bisect_left(self.times, t)
+        if i == 0:
+            return self.values[0]
+        if i == len(self.times):
+            return self.values[-1]
+        t0, t1 = self.times[i - 1], self.times[i]
+        if t1 == t0:
+            return self.values[i]
+        w = (t - t0) / (t1 - t0)
+        return tuple(v0 + w * (v1 - v0) for v0, v1 in zip(self.values[i - 1], self.values[i]))
+
+
+class NavBuffer:
+    """
+    Rolling buffer of depth and position fixes, safe to fill from a follower thread while images are loaded
+    """
+
+    def __init__(self, max_age: float = 3600.):
+        self.series = {name: NavSeries(max_age) for name in NAV_COLUMNS}
+        self.lock = threading.Lock()
+
+    def add(self, name: str, t: int, values: tuple):
+        """
+        Add a fix
+        :param name: depth or position
+        :param t: Timestamp in microseconds
+        :param values: (depth,) or (latitude, longitude)
+        """
+        with self.lock:
+            self.series[name].add(t, values)
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(s.times) for s in self.series.values())
+
+    def lookup(self, t: int, nav_mode: str = 'nearest', max_gap: Optional[float] = None) -> Dict[str, float]:
+        """
+        Depth, latitude and longitude at a time
+        :param t: Timestamp in microseconds
+        :param nav_mode: nearest or interp
+        :param max_gap: (optional) Maximum time in seconds to the nearest fix; values further away are NaN
+        :return: Dictionary of depth, latitude, longitude
+        """
+        max_gap_us = int(max_gap * 1e6) if max_gap else None
+        result = {}
+        with self.lock:
+            for name, columns in NAV_COLUMNS.items():
+                series = self.series[name]
+                values = series.interp(t, max_gap_us) if nav_mode == 'interp' else series.nearest(t, max_gap_us)
+                result.update(zip(columns, values if values is not None else [math.nan] * len(columns)))
+        return result
+
+
+class LcmFollower(abc.ABC):
+    """
+    Decodes USBL (gps_fix_t) and depth (depth_t) events into a NavBuffer on a background thread. Events are timestamped
+    with the time they were received, like lcm_timestamp in the logs, whatever the source
+    """
+
+    def __init__(self, nav: NavBuffer, usbl_channel: str, depth_channel: str):
+        self.nav = nav
+        gps, depth = DECODERS[gps_fix_t], DECODERS[depth_t]
+        self.routes = {
+            usbl_channel: ('position', gps, [gps.columns.index(c) for c in NAV_COLUMNS['position']]),
+            depth_channel: ('depth', depth, [depth.columns.index(c) for c in NAV_COLUMNS['depth']]),
+        }
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def handle(self, channel: str, timestamp: int, data: bytes):
+        """
+        Decode an event and add it to the buffer
+        """
+        name, decoder, index = self.routes[channel]
+        try:
+            values = decoder.values(decoder.lcm_type.decode(data))
+        except ValueError as e:
+            debug(f'Skipping {channel} event at {timestamp}: {e}')
+            return
+        self.nav.add(name, timestamp, tuple(values[i] for i in index))
+
+    def start(self) -> 'LcmFollower':
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+
+    @abc.abstractmethod
+    def run(self):
+        """
+        Read events and handle them until stopped
+        """
+
+
+class LogFollower(LcmFollower):
+    """
+    Tails a growing LCM log. A partly written event at the end of the log is read again once it is complete.
+    If the path is a directory, the latest lcmlog.* segment is followed and the next one picked up when it appears
+    """
+
+    def __init__(self, nav: NavBuffer, log_path: Path, usbl_channel: str, depth_channel: str, poll: float = 0.2):
+        super().__init__(nav, usbl_channel, depth_channel)
+        self.log_path = Path(log_path)
+        self.poll = poll
+
+    def current_segment(self) -> Optional[Path]:
+        segments = find_segments(self.log_path)
+        segments = [s for s in segments if s.exists()]
+        return segments[-1] if segments else None
+
+    def run(self):
+        path, f, pos = None, None, 0
+        info(f'Following LCM log {self.log_path}')
+        try:
+            while not self.stop_event.is_set():
+                latest = self.current_segment()
+                if latest is not None and latest != path:
+                    if f:
+                        self.follow(f, pos)  # Finish the previous segment
+                        f.close()
+                    path, f, pos = latest, open(latest, 'rb'), 0
+                    info(f'Following LCM log segment {path}')
+                if f:
+                    pos = self.follow(f, pos)
+                self.stop_event.wait(self.poll)
+        finally:
+            if f:
+                f.close()
+
+    def follow(self, f, pos: int) -> int:
+        """
+        Read the complete events from pos to the end of the log
+        :return: The position after the last complete event
+        """
+        size = os.fstat(f.fileno()).st_size
+        f.seek(pos)
+        while pos + EVENT_HEADER.size <= size:
+            syncword, _, timestamp, channel_length, data_length = EVENT_HEADER.unpack(f.read(EVENT_HEADER.size))
+            if syncword != LCM_SYNCWORD:
+                pos = self.resync(f, pos + 1, size)
+                continue
+            end = pos + EVENT_HEADER.size + channel_length + data_length
+            if end > size:
+                break  # Event still being written
+            channel = f.read(channel_length).decode(STRING_ENCODING, 'replace')
+            if channel in self.routes:
+                self.handle(channel, timestamp, f.read(data_length))
+            else:
+                f.seek(end)
+            pos = end
+        return pos
+
+    @staticmethod
+    def resync(f, pos: int, size: int) -> int:
+        """
+        Find the next syncword after a corrupt event
+        """
+        f.seek(pos)
+        data = f.read(size - pos)
+        found = data.find(LCM_SYNCWORD)
+        err(f'Bad syncword at byte {pos - 1}, skipping {found if found >= 0 else len(data)} bytes')
+        return pos + found if found >= 0 else size
+
+
+def parse_url(url: str) -> Tuple[str, int]:
+    """
+    Multicast group and port of an LCM URL, e.g. udpm://239.255.76.67:7667?ttl=0
+    """
+    parsed = urlparse(url)
+    return parsed.hostname, parsed.port or 7667
+
+
+class UdpFollower(LcmFollower):
+    """
+    Subscribes to LCM messages on a UDP multicast group. Messages are timestamped with the receive time, as the LCM
+    logger does. Fragmented (large) messages are ignored
+    """
+
+    def __init__(self, nav: NavBuffer, url: str, usbl_channel: str, depth_channel: str):
+        super().__init__(nav, usbl_channel, depth_channel)
+        self.url = url
+
+    def run(self):
+        group, port = parse_url(self.url)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+        sock.bind(('', port))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                        struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton('0.0.0.0')))
+        sock.settimeout(0.5)
+        info(f'Following LCM multicast {self.url}')
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    packet = sock.recv(65536)
+                except socket.timeout:
+                    continue
+                if len(packet) < LCM_SHORT_HEADER.size or LCM_SHORT_HEADER.unpack_from(packet)[0] != LCM_SHORT_MAGIC:
+                    continue
+                end = packet.find(b'\0', LCM_SHORT_HEADER.size)
+                if end < 0:
+                    continue
+                channel = packet[LCM_SHORT_HEADER.size:end].decode(STRING_ENCODING, 'replace')
+                if channel in self.routes:
+                    self.handle(channel, time.time_ns() // 1000, packet[end + 1:])
+        finally:
+            sock.close()
+
+
+def publish(events: Iterable[Event], url: str = DEFAULT_LCM_URL, speed: float = 1.):
+    """
+    Publish events on a UDP LCM multicast, e.g. to replay a log for testing. Packets are only sent on this host
+    :param events: Events in time order, e.g. from iter_events
+    :param url: LCM URL
+    :param speed: Replay speed, e.g. 2 for twice real time, 0 for as fast as possible
+    """
+    group, port = parse_url(url)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 0)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    start_wall, start_log = None, None
+    try:
+        for seq, event in enumerate(events):
+            if speed > 0:
+                if start_wall is None:
+                    start_wall, start_log = time.monotonic(), event.header.timestamp
+                delay = (event.header.timestamp - start_log) / 1e6 / speed - (time.monotonic() - start_wall)
+                if delay > 0:
+                    time.sleep(delay)
+            packet = LCM_SHORT_HEADER.pack(LCM_SHORT_MAGIC, seq & 0xffffffff) + \
+                event.channel.encode(STRING_ENCODING) + b'\0' + event.data
+            sock.sendto(packet, (group, port))
+    finally:
+        sock.close()
@@ -0,0 +1,150 @@
+# sightwire, Apache-2.0 license
+# Filename: convertors/lcm_index.py
+# Description: Sidecar timestamp index for LCM logs. Records the byte offset and timestamp of every Nth event, so a
+# time window can be read by seeking straight to it through a memory-mapped reader instead of scanning from the start
+import hashlib
+import mmap
+import os
+import struct
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, Optional, Sequence
+
+import numpy as np
+from lcmlog import Event, Header, BadSyncError
+from lcmlog.event import LCM_SYNCWORD, STRING_ENCODING
+
+from sightwire.logger import info, debug
+
+EVENT_HEADER = struct.Struct('>4sQQII')  # syncword, event number, timestamp, channel length, data length
+INDEX_EVERY = 1000  # Index every Nth event
+INDEX_SUFFIX = '.idx.npz'
+DEFAULT_INDEX_PATH = Path.home() / 'sightwire' / 'cache' / 'lcm_index'  # Used when the log directory is read-only
+
+
+@dataclass
+class LogIndex:
+    offsets: np.ndarray  # Byte offset of every Nth event
+    timestamps: np.ndarray  # Timestamp in microseconds of every Nth event, as a running maximum
+    first: int  # First event timestamp
+    last: int  # Last event timestamp
+
+    def seek(self, t_start: int) -> int:
+        """
+        Byte offset of an indexed event at or before t_start
+        """
+        i = np.searchsorted(self.timestamps, t_start, side='left') - 1
+        return int(self.offsets[max(i, 0)]) if len(self.offsets) else 0
+
+    def overlaps(self, t_start: Optional[int], t_end: Optional[int]) -> bool:
+        """
+        True if the log has events in [t_start, t_end]
+        """
+        return len(self.offsets) > 0 and (t_start is None or self.last >= t_start) and \
+            (t_end is None or self.first <= t_end)
+
+
+def index_files(log_path: Path) -> Sequence[Path]:
+    """
+    Candidate index files for a log: a sidecar next to the log, then one in the index cache
+    """
+    log_path = Path(log_path)
+    cache_name = f'{hashlib.sha1(log_path.resolve().as_posix().encode()).hexdigest()}{INDEX_SUFFIX}'
+    return [log_path.with_name(f'{log_path.name}{INDEX_SUFFIX}'), DEFAULT_INDEX_PATH / cache_name]
+
+
+def build_index(log_path: Path, every: int = INDEX_EVERY) -> LogIndex:
+    """
+    Build the index of a log by walking the event headers. Payloads are never read
+    :param log_path: Path to the LCM log file
+    :param every: Index every Nth event
+    :return: The index
+    """
+    offsets, timestamps = [], []
+    first = last = 0
+    size = os.path.getsize(log_path)
+    if size > 0:
+        with open(log_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = 0
+            n = 0
+            while pos + EVENT_HEADER.size <= size:
+                syncword, _, timestamp, channel_length, data_length = EVENT_HEADER.unpack_from(mm, pos)
+                if syncword != LCM_SYNCWORD:
+                    raise BadSyncError(syncword, pos)
+                if n % every == 0:
+                    offsets.append(pos)
+                    timestamps.append(timestamp)
+                if n == 0:
+                    first = timestamp
+                last = timestamp
+                pos += EVENT_HEADER.size + channel_length + data_length
+                n += 1
+    timestamps = np.maximum.accumulate(np.array(timestamps, dtype=np.int64)) if timestamps else np.array([], np.int64)
+    return LogIndex(offsets=np.array(offsets, dtype=np.int64), timestamps=timestamps, first=first, last=last)
+
+
+def get_index(log_path: Path, every: int = INDEX_EVERY) -> LogIndex:
+    """
+    Load the index of a log, building it once if it is missing or the log has changed
+    :param log_path: Path to the LCM log file
+    :param every: Index every Nth event
+    :return: The index
+    """
+    stat = os.stat(log_path)
+    for index_file in index_files(log_path):
+        if index_file.exists():
+            try:
+                with np.load(index_file) as data:
+                    if int(data['size']) == stat.st_size and int(data['mtime_ns']) == stat.st_mtime_ns:
+                        return LogIndex(offsets=data['offsets'], timestamps=data['timestamps'],
+                                        first=int(data['first']), last=int(data['last']))
+            except (OSError, ValueError, KeyError):
+                debug(f'Ignoring bad index {index_file}')
+
+    info(f'Indexing {log_path}')
+    index = build_index(log_path, every)
+    for index_file in index_files(log_path):
+        try:
+            index_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(index_file, 'wb') as f:
+                np.savez(f, offsets=index.offsets, timestamps=index.timestamps, first=index.first, last=index.last,
+                         size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            debug(f'Saved index {index_file}')
+            break
+        except OSError:
+            continue
+    return index
+
+
+def iter_window(log_path: Path, channels: Optional[Sequence[str]] = None, t_start: Optional[int] = None,
+                t_end: Optional[int] = None) -> Iterator[Event]:
+    """
+    Stream the events of a log in [t_start, t_end] through a memory-mapped reader, starting at the indexed event
+    before t_start and stopping at the first event after t_end
+    :param log_path: Path to the LCM log file
+    :param channels: (optional) Channels to keep. None to keep all
+    :param t_start: (optional) Start time in microseconds
+    :param t_end: (optional) End time in microseconds
+    :return: Iterator of events
+    """
+    index = get_index(log_path)
+    if not index.overlaps(t_start, t_end):
+        return
+    channels = {c.encode(STRING_ENCODING) for c in channels} if channels is not None else None
+    with open(log_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        size = len(mm)
+        pos = index.seek(t_start) if t_start is not None else 0
+        while pos + EVENT_HEADER.size <= size:
+            syncword, event_number, timestamp, channel_length, data_length = EVENT_HEADER.unpack_from(mm, pos)
+            if syncword != LCM_SYNCWORD:
+                raise BadSyncError(syncword, pos)
+            if t_end is not None and timestamp > t_end:
+                return
+            start = pos + EVENT_HEADER.size
+            pos = start + channel_length + data_length
+            if t_start is not None and timestamp < t_start:
+                continue
+            channel = mm[start:start + channel_length]
+            if channels is None or channel in channels:
+                yield Event(Header(event_number, timestamp, channel_length, data_length),
+                            channel.decode(STRING_ENCODING), mm[start + channel_length:pos])
@@ -0,0 +1,93 @@
+# sightwire, Apache-2.0 license
+# Filename: convertors/nav_cache.py
+# Description: Persistent cache of parsed navigation logs. Each log is parsed once, stored as one .npy per column
+# and memory-mapped on later runs.
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+from sightwire.logger import info, debug
+
+DEFAULT_CACHE_PATH = Path.home() / 'sightwire' / 'cache' / 'nav'
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3  # 2 GB
+
+
+def cache_key(log_path: Path) -> str:
+    """
+    Generate a cache key from the log path, size and modification time so a changed log is parsed again
+    :param log_path: Path to the log file
+    :return: The cache key
+    """
+    stat = log_path.stat()
+    key = f'{log_path.resolve().as_posix()}:{stat.st_size}:{stat.st_mtime_ns}'
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def entry_size(entry_path: Path) -> int:
+    """
+    Size of a cache entry in bytes
+    """
+    return sum(f.stat().st_size for f in entry_path.iterdir())
+
+
+def evict(cache_path: Path, max_bytes: int):
+    """
+    Remove the least recently used entries until the cache is under max_bytes
+    :param cache_path: Path to the cache
+    :param max_bytes: Maximum size of the cache in bytes
+    """
+    entries = [e for e in cache_path.iterdir() if e.is_dir()]
+    sizes = {e: entry_size(e) for e in entries}
+    total = sum(sizes.values())
+    for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+        if total <= max_bytes:
+            break
+        info(f'Evicting {entry} from the navigation cache')
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= sizes[entry]
+
+
+def read_cached(log_path: Path, parse: Callable[[Path], pd.DataFrame], cache_path: Path = DEFAULT_CACHE_PATH,
+                max_bytes: int = DEFAULT_MAX_BYTES) -> pd.DataFrame:
+    """
+    Read a navigation log through the cache. The first read parses the log and stores the columns;
+    later reads memory-map them
+    :param log_path: Path to the log file
+    :param parse: Function that parses the log into a dataframe of numeric columns
+    :param cache_path: Path to the cache
+    :param max_bytes: Maximum size of the cache in bytes
+    :return: The parsed dataframe
+    """
+    entry_path = cache_path / cache_key(log_path)
+    manifest = entry_path / 'columns.json'
+
+    if manifest.exists():
+        debug(f'Reading {log_path} from the navigation cache {entry_path}')
+        columns = json.loads(manifest.read_text())
+        os.utime(entry_path)  # Mark as recently used
+        return pd.DataFrame({c: np.load(entry_path / f'{i}.npy', mmap_mode='r') for i, c in enumerate(columns)},
+                            copy=False)
+
+    df = parse(log_path)
+
+    # Write to a temporary directory and rename, so an interrupted run never leaves a partial entry
+    cache_path.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path / f'{entry_path.name}.tmp{os.getpid()}'
+    tmp_path.mkdir(parents=True, exist_ok=True)
+    for i, c in enumerate(df.columns):
+        np.save(tmp_path / f'{i}.npy', df[c].values)
+    (tmp_path / 'columns.json').write_text(json.dumps(list(df.columns)))
+    try:
+        tmp_path.rename(entry_path)
+        info(f'Cached {log_path} in {entry_path}')
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)  # Another run cached it first
+
+    evict(cache_path, max_bytes)
+    return df
@@ -0,0 +1,137 @@
+# sightwire, Apache-2.0 license
+# Filename: convertors/previews.py
+# Description: Downscaled previews for browsing a mission: proxy videos, per-image JPEG thumbnails and a contact sheet.
+# They are made from frames that are already decoded, e.g. while encoding a video or loading images
+import math
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import cv2
+import numpy as np
+
+from sightwire.logger import info, err
+from sightwire.converters.video_transcoders import open_writer, to_frame
+
+THUMBNAIL_SIZE = 256  # Longest side of a thumbnail in pixels
+THUMBNAIL_QUALITY = 85  # JPEG quality of thumbnails and the contact sheet
+SHEET_COLUMNS = 10
+SHEET_TILES = 100  # Maximum number of frames in a contact sheet, spread over the whole sequence
+
+
+class Previews:
+    """
+    Builds previews from decoded frames, one frame at a time, so the images are never read a second time. Call start,
+    add for each frame in order, then close
+    """
+
+    def __init__(self, output_dir: Path, name: str, proxy_heights: Sequence[int] = (), thumbnail_size: int = 0,
+                 contact_sheet: bool = False):
+        """
+        :param output_dir: Directory to save the previews to
+        :param name: Name of the previews, e.g. the video name. Proxies are saved as <name>_<height>p.mp4, thumbnails
+        in <name>_thumbnails and the contact sheet as <name>_contact.jpg
+        :param proxy_heights: (optional) Height in pixels of each proxy video, e.g. [480, 240]
+        :param thumbnail_size: (optional) Longest side of the thumbnails in pixels. 0 for no thumbnails
+        :param contact_sheet: (optional) True to make a contact sheet
+        """
+        self.output_dir = Path(output_dir)
+        self.name = name
+        self.proxy_heights = sorted(set(proxy_heights), reverse=True)
+        self.thumbnail_size = thumbnail_size
+        self.contact_sheet = contact_sheet
+        self.fps = None
+        self.sheet_step = 1
+        self.count = 0
+        self.writers: Dict[int, object] = {}
+        self.tiles: List[np.ndarray] = []
+        self.thumbnail_path = self.output_dir / f'{name}_thumbnails'
+
+    def start(self, fps: Optional[float], num_frames: Optional[int]):
+        """
+        Set the frame rate of the proxy videos and the number of frames expected, to spread the contact sheet
+        :param fps: Frame rate. None for no proxy videos
+        :param num_frames: Number of frames that will be added, if known
+        """
+        self.fps = fps
+        self.sheet_step = max(1, math.ceil(num_frames / SHEET_TILES)) if num_frames else 1
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        if self.thumbnail_size:
+            self.thumbnail_path.mkdir(parents=True, exist_ok=True)
+
+    def add(self, frame: np.ndarray, image_path: str):
+        """
+        Add the next frame
+        :param frame: 8-bit BGR frame
+        :param image_path: Path to the image the frame was decoded from. Names the thumbnail
+        """
+        height, width = frame.shape[:2]
+        if self.fps:
+            for proxy_height in self.proxy_heights:
+                if proxy_height >= height:
+                    continue
+                size = (2 * round(width * proxy_height / height / 2), proxy_height)
+                if proxy_height not in self.writers:
+                    self.writers[proxy_height] = open_writer(self.proxy_file(proxy_height).as_posix(), self.fps, size)
+                self.writers[proxy_height].write(cv2.resize(frame, size, interpolation=cv2.INTER_AREA))
+
+        if self.thumbnail_size or (self.contact_sheet and self.count % self.sheet_step == 0):
+            scale = min(1., (self.thumbnail_size or THUMBNAIL_SIZE) / max(height, width))
+            thumbnail = cv2.resize(frame, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+            if self.thumbnail_size:
+                cv2.imwrite((self.thumbnail_path / f'{Path(image_path).stem}.jpg').as_posix(), thumbnail,
+                            [cv2.IMWRITE_JPEG_QUALITY, THUMBNAIL_QUALITY])
+            if self.contact_sheet and self.count % self.sheet_step == 0 and len(self.tiles) < SHEET_TILES:
+                self.tiles.append(thumbnail)
+        self.count += 1
+
+    def add_file(self, image_path: str, data: bytes = b''):
+        """
+        Add the next image from its file, decoding it from bytes already read, e.g. for the md5. Only the rest of the
+        file is read
+        :param image_path: Path to the image
+        :param data: (optional) The first part of the file
+        """
+        if len(data) < Path(image_path).stat().st_size:
+            with open(image_path, 'rb') as f:
+                f.seek(len(data))
+                data += f.read()
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        if image is None:
+            err(f'Could not decode {image_path} for previews')
+            return
+        self.add(to_frame(image), image_path)
+
+    def proxy_file(self, height: int) -> Path:
+        """
+        Proxy video of a height, e.g. dive_480p.mp4
+        """
+        return self.output_dir / f'{self.name}_{height}p.mp4'
+
+    def close(self):
+        """
+        Finish the proxy videos and write the contact sheet
+        """
+        for height, writer in self.writers.items():
+            writer.close()
+            info(f'Created proxy {self.proxy_file(height)}')
+        self.writers = {}
+
+        if self.tiles:
+            sheet_file = self.output_dir / f'{self.name}_contact.jpg'
+            cv2.imwrite(sheet_file.as_posix(), tile(self.tiles), [cv2.IMWRITE_JPEG_QUALITY, THUMBNAIL_QUALITY])
+            info(f'Created contact sheet {sheet_file} from {len(self.tiles)} of {self.count} frames')
+            self.tiles = []
+        if self.thumbnail_size:
+            info(f'Created {self.count} thumbnails in {self.thumbnail_path}')
+
+
+def tile(images: List[np.ndarray], columns: int = SHEET_COLUMNS) -> np.ndarray:
+    """
+    Arrange images in a grid, in rows of columns images. Images are resized to the size of the first
+    """
+    height, width = images[0].shape[:2]
+    images = [i if i.shape[:2] == (height, width) else cv2.resize(i, (width, height)) for i in images]
+    columns = min(columns, len(images))
+    rows = math.ceil(len(images) / columns)
+    images += [np.zeros_like(images[0])] * (rows * columns - len(images))
+    return np.vstack([np.hstack(images[r * columns:(r + 1) * columns]) for r in range(rows)])
@@ -0,0 +1,88 @@
+# sightwire, Apache-2.0 license
+# Filename: convertors/sync.py
+# Description: Time synchronization of N camera streams, e.g. LEFT/RIGHT PROSILICA, FLIR or an upward-looking camera
+from dataclasses import dataclass
+from typing import List, Sequence, Union
+
+import numpy as np
+
+
+@dataclass
+class SyncResult:
+    index: np.ndarray  # (frames, streams) index into each stream, -1 where a stream has no match
+    unmatched: List[int]  # Number of reference frames without a match in each stream
+    duplicates: List[int]  # Number of frames in each stream matched to more than one reference frame
+
+    def matched(self) -> np.ndarray:
+        """
+        Index table with only the rows where every stream has a match
+        """
+        return self.index[(self.index >= 0).all(axis=1)]
+
+
+def to_ns(timestamps) -> np.ndarray:
+    """
+    Convert datetime64 or integer nanosecond timestamps to an int64 nanosecond array
+    """
+    values = np.asarray(timestamps)
+    if values.dtype.kind == 'M':
+        return values.astype('datetime64[ns]').astype(np.int64)
+    return values.astype(np.int64)
+
+
+def align_streams(streams: Sequence[np.ndarray], tolerance: Union[float, Sequence[float]] = 0.5,
+                  reference: int = 0, unique: bool = False) -> SyncResult:
+    """
+    Align N timestamp streams to a reference stream. Every reference frame is matched to the nearest frame in each
+    other stream in a single sorted search per stream.
+    :param streams: Timestamps for each stream as datetime64 or int64 nanoseconds
+    :param tolerance: Maximum time difference in seconds to the reference, either one value or one per stream
+    :param reference: Index of the reference stream
+    :param unique: True to keep only the closest reference frame when a frame matches more than one
+    :return: The index table with one row per reference frame in time order, and the unmatched and duplicate counts
+    """
+    if np.isscalar(tolerance):
+        tolerance = [tolerance] * len(streams)
+    assert len(tolerance) == len(streams), f'Need one tolerance per stream, got {len(tolerance)} for {len(streams)}'
+
+    times = [to_ns(s) for s in streams]
+    ref_order = np.argsort(times[reference], kind='stable')
+    ref_t = times[reference][ref_order]
+
+    index = np.full((len(ref_t), len(streams)), -1, dtype=np.int32)
+    unmatched = [0] * len(streams)
+    duplicates = [0] * len(streams)
+    index[:, reference] = ref_order
+
+    for i, t in enumerate(times):
+        if i == reference or len(t) == 0:
+            unmatched[i] = len(ref_t) if i != reference else 0
+            continue
+        order = np.argsort(t, kind='stable')
+        t = t[order]
+
+        # Nearest neighbor is either the insertion point or the one before it
+        pos = np.searchsorted(t, ref_t)
+        before = np.clip(pos - 1, 0, len(t) - 1)
+        after = np.clip(pos, 0, len(t) - 1)
+        use_after = np.abs(t[after] - ref_t) < np.abs(ref_t - t[before])
+        nearest = np.where(use_after, after, before)
+        delta = np.abs(t[nearest] - ref_t)
+        match = delta <= tolerance[i] * 1e9
+
+        counts = np.bincount(nearest[match], minlength=len(t))
+        duplicates[i] = int((counts > 1).sum())
+
+        if unique and duplicates[i] > 0:
+            # Keep the closest reference frame for each matched frame
+            candidates = np.flatnonzero(match)
+            keep = np.lexsort((delta[candidates], nearest[candidates]))
+            sorted_nearest = nearest[candidates][keep]
+            first = np.ones(len(keep), dtype=bool)
+            first[1:] = sorted_nearest[1:] != sorted_nearest[:-1]
+            match[candidates[keep[~first]]] = False
+
+        index[match, i] = order[nearest[match]]
+        unmatched[i] = int((~match).sum())
+
+    return SyncResult(index=index, unmatched=unmatched, duplicates=duplicates)
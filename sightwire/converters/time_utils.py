@@ -1,134 +1,276 @@
 # sightwire, Apache-2.0 license
 # Filename: convertors/lcm.py
 # Description:  LCM logs conversion courtesy K. Barnard. Replaced argparse with click and restyled.
-from typing import List
+from typing import Iterator, List, Union
+import numpy as np
 import pandas as pd
 from pathlib import Path
 from datetime import datetime
 
+from sightwire.converters.columnar import COLUMNAR_SUFFIXES, read_columns
+from sightwire.converters.nav_cache import read_cached
+from sightwire.converters.sync import align_streams
+from sightwire.loaders.discovery import ImageFiles
 from sightwire.logger import info
 
 
+def timestamps_to_datetime64(timestamps) -> np.ndarray:
+    """
+    Convert epoch timestamps to UTC datetime64[ns] in one call. Accepts strings such as filename stems
+    "1699643617", "1699643617662483" or "1699643617.5", or a numeric column, e.g. lcm_timestamp. The units are detected
+    per value from the number of integer digits: 10 seconds, 13 milliseconds, 16 microseconds, 19 nanoseconds
+    :param timestamps: Sequence or array of timestamps
+    :return: datetime64[ns] array
+    :raise ValueError: If a timestamp is missing or not a number
+    """
+    values = np.asarray(timestamps)
+    if values.dtype.kind in 'OUS':
+        try:
+            values = values.astype(np.int64)
+        except ValueError:
+            # Fractional, e.g. 1699643617.662483
+            values = values.astype(np.float64)
+    if values.dtype.kind == 'f':
+        invalid = ~np.isfinite(values)
+        values = np.where(invalid, 0., values)
+        # Scale the whole and fractional parts apart, so integers in a fractional column stay exact
+        whole = np.floor(values)
+        scale = np.select([values < 1e11, values < 1e14, values < 1e17], [10**9, 10**6, 10**3], 1)
+        result = (whole.astype(np.int64) * scale + np.round((values - whole) * scale).astype(np.int64))
+        result = np.where(invalid, np.datetime64('NaT'), result.astype('datetime64[ns]'))
+    else:
+        values = values.astype(np.int64)
+        scale = np.select([values < 10**11, values < 10**14, values < 10**17], [10**9, 10**6, 10**3], 1)
+        result = (values * scale).astype('datetime64[ns]')
+    invalid = np.isnat(result)
+    if invalid.any():
+        raise ValueError(f'{invalid.sum()} of {len(result)} timestamps are not epoch times, '
+                         f'e.g. {np.asarray(timestamps)[invalid][0]!r}')
+    return result
+
+
+def to_microseconds(value: str) -> int:
+    """
+    Convert an epoch timestamp in any unit, e.g. 1699643617662483, or an ISO 8601 datetime, e.g. 2023-11-10T19:13:37,
+    to epoch microseconds. Datetimes without a timezone are UTC
+    """
+    try:
+        float(value)
+        return int(timestamps_to_datetime64([value])[0].astype('datetime64[us]').astype(np.int64))
+    except ValueError:
+        t = pd.Timestamp(value)
+        t = t.tz_localize('UTC') if t.tzinfo is None else t.tz_convert('UTC')
+        return t.value // 1000
+
+
 def convert_timestamp_to_datetime_10(timestamp: str) -> datetime:
     """
-    Convert a timestamp string, e.g. "1699643617" to a datetime object
+    Convert a timestamp string, e.g. "1699643617" to a UTC datetime object
     :param timestamp:
     :return:  datetime object
     """
-    return datetime.fromtimestamp(float(timestamp))
+    return pd.Timestamp(timestamps_to_datetime64([timestamp])[0]).to_pydatetime()
 
 
 def convert_timestamp_to_datetime_16(timestamp: str) -> datetime:
     """
-    Convert a timestamp string, e.g. "1699643617662483" to a datetime object
+    Convert a timestamp string, e.g. "1699643617662483" to a UTC datetime object
     :param timestamp:
     :return:  datetime object
     """
-    seconds = float(str(timestamp)[0:10]) + float(str(timestamp)[10:]) / 1e6
-    return datetime.fromtimestamp(seconds)
+    return pd.Timestamp(timestamps_to_datetime64([timestamp])[0]).to_pydatetime()
 
 
-def assign_nearest(depth_log: Path, position_log: Path, image_list: List[Path], max_images: int) -> pd.DataFrame:
+def parse_nav_log(log_path: Path) -> pd.DataFrame:
     """
-    Find the nearest depth and position for a given image or a pair of images
-    :param image_list: Path to the image list file
+    Parse a navigation log exported from the lcm logs, e.g. depth or USBL lat/lon, sorted by lcm_timestamp.
+    Parquet and npz logs from extract-log --format already have typed columns and nanosecond timestamps
+    :param log_path: Path to the log file, .csv, .parquet or .npz
+    :return: Dataframe with lcm_timestamp as datetime64[ns]
+    """
+    if log_path.suffix in COLUMNAR_SUFFIXES:
+        df = read_columns(log_path)
+        df['lcm_timestamp'] = df['lcm_timestamp'].values.astype('datetime64[ns]')
+    else:
+        df = pd.read_csv(log_path.as_posix())
+        df['lcm_timestamp'] = timestamps_to_datetime64(df['lcm_timestamp'].values)
+    if df['lcm_timestamp'].is_monotonic_increasing:
+        return df
+    return df.sort_values(by=['lcm_timestamp']).reset_index(drop=True)
+
+
+def read_nav_log(log_path: Path, use_cache: bool = True) -> pd.DataFrame:
+    """
+    Read a navigation log, from the cache in ~/sightwire/cache if it was parsed before. Parquet and npz logs are
+    read directly since they need no parsing
+    :param log_path: Path to the log file
+    :param use_cache: True to read and store the parsed log in the cache
+    :return: Dataframe with lcm_timestamp as datetime64[ns], sorted by lcm_timestamp
+    """
+    if use_cache and log_path.suffix not in COLUMNAR_SUFFIXES:
+        return read_cached(log_path, parse_nav_log)
+    return parse_nav_log(log_path)
+
+
+def nearest_join(df: pd.DataFrame, df_nav: pd.DataFrame, columns: List[str], max_gap: float = None) -> pd.DataFrame:
+    """
+    Join the nearest navigation sample to each row by timestamp. Both tables are sorted and searched once, so this
+    scales with the number of rows instead of rows x samples.
+    :param df: Dataframe with an iso_datetime column, sorted by iso_datetime
+    :param df_nav: Navigation dataframe with an lcm_timestamp column
+    :param columns: Navigation columns to copy to df, e.g. ['depth']
+    :param max_gap: (optional) Maximum time difference in seconds; rows without a sample this close get NaN
+    :return: df with the navigation columns added
+    """
+    df_nav = df_nav[['lcm_timestamp'] + columns]
+    if not df_nav['lcm_timestamp'].is_monotonic_increasing:
+        df_nav = df_nav.sort_values(by=['lcm_timestamp'])
+    df_nav = df_nav.rename(columns={'lcm_timestamp': 'iso_datetime'})
+    tolerance = pd.Timedelta(seconds=max_gap) if max_gap else None
+    df = df.drop(columns=columns, errors='ignore')
+    return pd.merge_asof(df, df_nav, on='iso_datetime', direction='nearest', tolerance=tolerance)
+
+
+def interpolate_join(df: pd.DataFrame, df_nav: pd.DataFrame, columns: List[str], max_gap: float = None) -> pd.DataFrame:
+    """
+    Linearly interpolate navigation samples at each row timestamp. All rows are computed at once with np.interp on
+    sorted int64 nanosecond times.
+    :param df: Dataframe with an iso_datetime column
+    :param df_nav: Navigation dataframe with an lcm_timestamp column
+    :param columns: Navigation columns to interpolate into df, e.g. ['latitude', 'longitude']
+    :param max_gap: (optional) Maximum time in seconds to the nearest sample; rows further away get NaN
+    :return: df with the navigation columns added
+    """
+    if not df_nav['lcm_timestamp'].is_monotonic_increasing:
+        df_nav = df_nav.sort_values(by=['lcm_timestamp'])
+    nav_t = df_nav['lcm_timestamp'].values.astype('datetime64[ns]').astype(np.int64)
+    t = df['iso_datetime'].values.astype('datetime64[ns]').astype(np.int64)
+
+    # Flag rows whose nearest navigation sample is more than max_gap away, including rows outside the log
+    gap = np.zeros(len(t), dtype=bool)
+    if max_gap and len(nav_t) > 0:
+        idx = np.searchsorted(nav_t, t)
+        before = np.abs(t - nav_t[np.clip(idx - 1, 0, len(nav_t) - 1)])
+        after = np.abs(nav_t[np.clip(idx, 0, len(nav_t) - 1)] - t)
+        gap = np.minimum(before, after) > max_gap * 1e9
+
+    df = df.copy()
+    for column in columns:
+        values = np.interp(t, nav_t, df_nav[column].values.astype(np.float64))
+        values[gap] = np.nan
+        df[column] = values
+    return df
+
+
+def nav_window(df_nav: pd.DataFrame, t_start: np.datetime64, t_end: np.datetime64) -> pd.DataFrame:
+    """
+    Slice a sorted navigation dataframe to the samples covering [t_start, t_end], plus one sample either side
+    :param df_nav: Navigation dataframe sorted by lcm_timestamp
+    :param t_start: Start time
+    :param t_end: End time
+    :return: The navigation samples in the window
+    """
+    t = df_nav['lcm_timestamp'].values
+    start = max(np.searchsorted(t, t_start) - 1, 0)
+    end = np.searchsorted(t, t_end, side='right') + 1
+    return df_nav.iloc[start:end]
+
+
+def iter_assign_nearest(depth_log: Path, position_log: Path, image_list: Union[List[Path], ImageFiles], max_images: int,
+                        max_gap: float = None, nav_mode: str = 'nearest', use_cache: bool = True,
+                        chunk_size: int = 500) -> Iterator[pd.DataFrame]:
+    """
+    Find the depth and position for images or pairs of images in time-sorted chunks. Only the file names and
+    timestamps are kept for the whole mission, so memory is bounded by the chunk size.
+    :param image_list: List of images, or the ImageFiles found by discover_images
     :param depth_log: Path to the depth log file
     :param position_log:  Path to the position log file
     :param max_images:  Maximum number of images to process
-    :return:
+    :param max_gap: (optional) Maximum time difference in seconds between an image and its depth/position sample
+    :param nav_mode: 'nearest' to use the closest depth/position sample, 'interp' to interpolate between samples
+    :param use_cache: True to read the depth and position logs through the navigation cache
+    :param chunk_size: Number of images or image pairs per chunk
+    :return: Iterator of dataframes with the depth, latitude, longitude and a nav_gap flag for images without navigation
     """
     if len(image_list) == 0:
         info(f'No images found in {image_list}')
         assert False
 
-    # Combine the images into a single dnataframe
-    left_images = [item for item in image_list if "_LEFT" in item.as_posix() or "_L" in item.as_posix()]
-    right_images = [item for item in image_list if "_RIGHT" in item.as_posix() or "_R" in item.as_posix()]
+    if isinstance(image_list, ImageFiles):
+        images, stems = image_list.paths, image_list.stems
+    else:
+        images = [Path(item).as_posix() for item in image_list]
+        stems = [Path(item).stem for item in images]
+    iso_datetime = timestamps_to_datetime64(stems)
+
+    # Split into left and right images
+    left = np.array(["_LEFT" in item or "_L" in item for item in images])
+    right = np.array(["_RIGHT" in item or "_R" in item for item in images])
 
     stereo = False
-    if len(left_images) > 0 and len(right_images) > 0:
-        info(f'Found {len(left_images)} left images and {len(right_images)} right images')
+    if left.any() and right.any():
+        info(f'Found {left.sum()} left images and {right.sum()} right images')
         stereo = True
-        # Assume the timestamp is in the filename, e.g. 1699643617662483 or 1699643617.662483
-        if len(left_images[0].stem) == 10:
-            df_left = pd.DataFrame({'left': left_images})
-            df_left['iso_datetime'] = df_left['left'].apply(lambda x: convert_timestamp_to_datetime_10(x.stem))
-            df_right = pd.DataFrame({'right': right_images})
-            df_right['iso_datetime'] = df_right['right'].apply(lambda x: convert_timestamp_to_datetime_10(x.stem))
-        else:
-            df_left = pd.DataFrame({'left': left_images})
-            df_left['iso_datetime'] = df_left['left'].apply(lambda x: convert_timestamp_to_datetime_16(x.stem))
-            df_right = pd.DataFrame({'right': right_images})
-            df_right['iso_datetime'] = df_right['right'].apply(lambda x: convert_timestamp_to_datetime_16(x.stem))
+        # Allow time difference tolerance (500 milliseconds) between the left and right images
+        left_idx, right_idx = np.flatnonzero(left), np.flatnonzero(right)
+        sync = align_streams([iso_datetime[left_idx], iso_datetime[right_idx]], tolerance=0.5)
+        info(f'{sync.unmatched[1]} left images without a right image, {sync.duplicates[1]} right images paired more '
+             f'than once')
+        # Drop any images without a pair
+        pairs = sync.matched()
+        df = pd.DataFrame({'left': left_idx[pairs[:, 0]], 'iso_datetime': iso_datetime[left_idx[pairs[:, 0]]],
+                           'right': right_idx[pairs[:, 1]]})
     else:
-        info(f'Found {len(image_list)} images')
-        if len(image_list[0].stem) == 10:
-            df = pd.DataFrame({'image': image_list})
-            df['iso_datetime'] = df['image'].apply(lambda x: convert_timestamp_to_datetime_10(x.stem))
-        else:
-            df = pd.DataFrame({'image': image_list})
-            df['iso_datetime'] = df['image'].apply(lambda x: convert_timestamp_to_datetime_16(x.stem))
-
-    if stereo:
-        # Allow time difference tolerance (500 milliseconds) for the nearest depth and position between the left and
-        # right images
-        tolerance = pd.Timedelta('500ms')
-        df = pd.merge_asof(df_left, df_right, on='iso_datetime', direction='nearest', tolerance=tolerance)
-        df.sort_values(by=['iso_datetime'], inplace=True)
-        df.reset_index(inplace=True)
-        # Drop any rows with NaN values
-        df.dropna(inplace=True)
+        info(f'Found {len(images)} images')
+        df = pd.DataFrame({'image': np.arange(len(images)), 'iso_datetime': iso_datetime})
+        df = df.sort_values(by=['iso_datetime'], kind='stable')
 
     # Limit the number of images to process
     if max_images and max_images > 0:
         df = df.head(max_images)
+    df = df.reset_index(drop=True)
 
-    # Add columns for depth and position
-    df['longitude'] = None
-    df['latitude'] = None
-    df['depth'] = None
+    df_depth = read_nav_log(depth_log, use_cache)
+    df_position = read_nav_log(position_log, use_cache)
+    join = interpolate_join if nav_mode == 'interp' else nearest_join
 
-    # Replace Path objects with strings
-    if stereo:
-        df['left'] = df['left'].apply(lambda x: x.as_posix())
-        df['right'] = df['right'].apply(lambda x: x.as_posix())
-    else:
-        df['image'] = df['image'].apply(lambda x: x.as_posix())
-
-    df_depth = pd.read_csv(depth_log.as_posix())
-    df_depth['lcm_timestamp'] = df_depth['lcm_timestamp'].apply(convert_timestamp_to_datetime_16)
-    df_depth.sort_index(inplace=True)
-
-    df_position = pd.read_csv(position_log.as_posix())
-    df_position['lcm_timestamp'] = df_position['lcm_timestamp'].apply(convert_timestamp_to_datetime_16)
-    df_position.sort_index(inplace=True)
-
-    # For each image or image pair, find the closest depth and position by timestamp
-    latitude = []
-    longitude = []
-    depth = []
-    for key, value in sorted(df.iterrows()):
-        depth_time_diff = abs(df_depth['lcm_timestamp'] - value.iso_datetime)
-        position_time_diff = abs(df_position['lcm_timestamp'] - value.iso_datetime)
-        closest_depth = df_depth.iloc[depth_time_diff.idxmin()]
-        closest_position = df_position.iloc[position_time_diff.idxmin()]
-
-        if stereo:
-            info(
-                f'image: {value.left} {value.right} lcm depth: {closest_depth.lcm_timestamp.timestamp()} {closest_depth.depth:.2f}')
-            info(
-                f'image: {value.left} {value.right} lcm position: {closest_position.lcm_timestamp.timestamp()} {closest_position.latitude:.2f} {closest_position.longitude:.2f}')
-        else:
-            info(f'image: {value.image} lcm depth: {closest_depth.lcm_timestamp.timestamp()} {closest_depth.depth:.2f}')
-            info(
-                f'image: {value.image} lcm position: {closest_position.lcm_timestamp.timestamp()} {closest_position.latitude:.2f} {closest_position.longitude:.2f}')
-
-        longitude.append(closest_position.longitude)
-        latitude.append(closest_position.latitude)
-        depth.append(closest_depth.depth)
-
-    df['longitude'] = longitude
-    df['latitude'] = latitude
-    df['depth'] = depth
+    num_depth = num_position = num_gap = 0
+    for start in range(0, len(df), chunk_size):
+        df_chunk = df.iloc[start:start + chunk_size].copy()
 
-    return df
+        # Replace image indexes with file names
+        for column in ['left', 'right'] if stereo else ['image']:
+            df_chunk[column] = [images[i] for i in df_chunk[column]]
+
+        # For each image or image pair, find the depth and position by timestamp in one sorted pass
+        t_start, t_end = df_chunk['iso_datetime'].values[[0, -1]]
+        df_chunk = join(df_chunk, nav_window(df_depth, t_start, t_end), ['depth'], max_gap)
+        df_chunk = join(df_chunk, nav_window(df_position, t_start, t_end), ['latitude', 'longitude'], max_gap)
+        df_chunk['nav_gap'] = df_chunk[['depth', 'latitude', 'longitude']].isna().any(axis=1)
+        df_chunk.index = range(start, start + len(df_chunk))
+
+        num_depth += df_chunk['depth'].notna().sum()
+        num_position += df_chunk['latitude'].notna().sum()
+        num_gap += df_chunk['nav_gap'].sum()
+        yield df_chunk
+
+    info(f'Assigned depth to {num_depth} of {len(df)} images')
+    info(f'Assigned position to {num_position} of {len(df)} images')
+    if num_gap > 0:
+        info(f'{num_gap} images have no depth/position within {max_gap} seconds')
+
+
+def assign_nearest(depth_log: Path, position_log: Path, image_list: Union[List[Path], ImageFiles], max_images: int,
+                   max_gap: float = None, nav_mode: str = 'nearest', use_cache: bool = True) -> pd.DataFrame:
+    """
+    Find the nearest depth and position for a given image or a pair of images
+    :param image_list: List of images
+    :param depth_log: Path to the depth log file
+    :param position_log:  Path to the position log file
+    :param max_images:  Maximum number of images to process
+    :param max_gap: (optional) Maximum time difference in seconds between an image and its depth/position sample
+    :param nav_mode: 'nearest' to use the closest depth/position sample, 'interp' to interpolate between samples
+    :param use_cache: True to read the depth and position logs through the navigation cache
+    :return: Dataframe with the depth, latitude, longitude and a nav_gap flag for images without navigation
+    """
+    return pd.concat(iter_assign_nearest(depth_log, position_log, image_list, max_images, max_gap, nav_mode, use_cache))
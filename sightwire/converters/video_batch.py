@@ -0,0 +1,154 @@
+# sightwire, Apache-2.0 license
+# Filename: convertors/video_batch.py
+# Description: Create the videos of every image folder in a mission tree. Folders are encoded concurrently in a
+# process pool within a global CPU budget, and folders whose video is newer than their images are skipped
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+
+import pandas as pd
+
+from sightwire.logger import info, err
+from sightwire.converters.video_transcoders import VIDEO_EXTENSIONS, image_to_mp4
+from sightwire.loaders.discovery import discover_images
+
+
+@dataclass
+class VideoJob:
+    image_path: str
+    mp4_path: str
+    csv_path: str
+    newest_image_ns: int  # Latest modification time of the folder or any of its images
+
+
+@dataclass
+class VideoResult:
+    image_path: str
+    mp4_path: str
+    status: str  # encoded, skipped or failed
+    frames: int = 0
+    seconds: float = 0.
+    frames_per_second: float = 0.
+
+
+def find_video_jobs(root: Path, output: Path, csv: Path) -> List[VideoJob]:
+    """
+    Find the image folders under a mission root. Each folder becomes a video named by the root and the path from the
+    root, e.g. images/dive1/color/PROSILICA_L_PNG under images/dive1 is dive1_color_PROSILICA_L_PNG.mp4
+    :param root: Mission root, e.g. the images directory
+    :param output: Directory to save the mp4 files to
+    :param csv: Directory to save the csv files with the timestamps to
+    :return: One job per folder with at least two images, in path order
+    """
+    root = Path(root)
+    files = discover_images(root, VIDEO_EXTENSIONS, recursive=True)
+    folders: Dict[str, List[str]] = defaultdict(list)
+    for path in files.paths:
+        folders[os.path.dirname(path)].append(path)
+
+    jobs = []
+    for folder in sorted(folders):
+        if len(folders[folder]) < 2:
+            info(f"Skipping {folder}, a video needs at least two images")
+            continue
+        relative = Path(folder).relative_to(root)
+        name = '_'.join((root.name,) + relative.parts)
+        newest = max([os.stat(folder).st_mtime_ns] + [os.stat(p).st_mtime_ns for p in folders[folder]])
+        jobs.append(VideoJob(image_path=folder, mp4_path=(Path(output) / f'{name}.mp4').as_posix(),
+                             csv_path=(Path(csv) / f'{name}.csv').as_posix(), newest_image_ns=newest))
+    return jobs
+
+
+def is_up_to_date(job: VideoJob) -> bool:
+    """
+    True if the mp4 and csv of a job are newer than its images
+    """
+    return all(os.path.exists(p) and os.stat(p).st_mtime_ns > job.newest_image_ns
+               for p in [job.mp4_path, job.csv_path])
+
+
+def run_video_job(job: VideoJob, num_images: int = None, workers: int = 1, threads: int = 1, encoder: str = None,
+                  preset: str = 'default') -> VideoResult:
+    """
+    Create the mp4 and csv of one image folder
+    :param job: The folder and its outputs
+    :param num_images: (optional) Maximum number of images to use
+    :param workers: (optional) Number of processes to decode images
+    :param threads: (optional) Number of encoder threads
+    :param encoder: (optional) ffmpeg, cv2 or moviepy. Default is ffmpeg if available, otherwise cv2
+    :param preset: (optional) Name of the encoder preset, e.g. archive or preview
+    :return: The number of frames and the encode rate
+    """
+    start = time.perf_counter()
+    data = image_to_mp4(job.image_path, job.mp4_path, demosaic='bayer' in job.image_path, num_images=num_images,
+                        workers=workers, encoder=encoder, preset=preset, threads=threads)
+    df = pd.DataFrame(data, columns=['timestamp', 'filename'])
+    df.to_csv(job.csv_path, index=False)
+    seconds = time.perf_counter() - start
+    return VideoResult(image_path=job.image_path, mp4_path=job.mp4_path, status='encoded', frames=len(data),
+                       seconds=round(seconds, 3), frames_per_second=round(len(data) / seconds, 2))
+
+
+def run_video_jobs(jobs: List[VideoJob], num_images: int = None, max_encodes: int = None, cpus: int = None,
+                   force: bool = False, encoder: str = None, preset: str = 'default') -> List[VideoResult]:
+    """
+    Run video jobs concurrently. At most max_encodes folders are encoded at a time, and the CPUs are shared between
+    them. Each share is split between the processes decoding the images and the encoder threads
+    :param jobs: Jobs, e.g. from find_video_jobs
+    :param num_images: (optional) Maximum number of images to use per folder
+    :param max_encodes: (optional) Maximum number of folders to encode at a time. Default is a quarter of the CPUs
+    :param cpus: (optional) Number of CPUs to use. Default is the number of CPUs
+    :param force: (optional) True to encode folders that are up to date
+    :param encoder: (optional) ffmpeg, cv2 or moviepy. Default is ffmpeg if available, otherwise cv2
+    :param preset: (optional) Name of the encoder preset, e.g. archive or preview
+    :return: One result per job, in job order
+    """
+    cpus = cpus or os.cpu_count() or 1
+    max_encodes = max(1, min(max_encodes or cpus // 4, cpus))
+    share = max(1, cpus // max_encodes)
+    workers = max(1, share // 2)
+    threads = max(1, share - workers)
+
+    results = {}
+    todo = []
+    for job in jobs:
+        if not force and is_up_to_date(job):
+            info(f"Skipping {job.image_path}, {job.mp4_path} is up to date")
+            results[job.image_path] = VideoResult(job.image_path, job.mp4_path, 'skipped')
+        else:
+            todo.append(job)
+
+    info(f"Encoding {len(todo)} folders, {max_encodes} at a time with {workers} decode processes and {threads} "
+         f"encoder threads each, "
+         f"{preset} preset")
+    for p in {Path(p).parent for job in todo for p in [job.mp4_path, job.csv_path]}:
+        p.mkdir(parents=True, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=max_encodes) as pool:
+        futures = {pool.submit(run_video_job, job, num_images, workers, threads, encoder, preset): job for job in todo}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                result = future.result()
+                info(f"Encoded {result.frames} images from {job.image_path} at {result.frames_per_second} frames/s")
+            except Exception as e:
+                err(f"Failed to create {job.mp4_path} from {job.image_path}: {e}")
+                result = VideoResult(job.image_path, job.mp4_path, 'failed')
+            results[job.image_path] = result
+    return [results[job.image_path] for job in jobs]
+
+
+def write_summary(results: List[VideoResult], summary_path: Path):
+    """
+    Append the results to a csv file, with the time of the run, and log them. Earlier runs are kept
+    """
+    df = pd.DataFrame([asdict(r) for r in results])
+    df.insert(0, 'run', datetime.now().isoformat(timespec='seconds'))
+    df.to_csv(summary_path, mode='a', header=not Path(summary_path).exists(), index=False)
+    for r in results:
+        info(f"{r.status:>8} {r.frames:>8} frames {r.frames_per_second:>8} frames/s {r.image_path}")
+    info(f"Saved summary of {len(results)} folders to {summary_path}")
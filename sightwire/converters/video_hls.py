@@ -0,0 +1,149 @@
+# sightwire, Apache-2.0 license
+# Filename: convertors/video_hls.py
+# Description: Incremental video of a growing image folder as fragmented MP4 HLS. A state file next to the playlist
+# records the last image encoded and the segments so far, so each run encodes only the new images into new segments
+import json
+import math
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from sightwire.logger import info, err
+from sightwire.converters.time_utils import timestamps_to_datetime64
+from sightwire.converters.video_transcoders import KEYFRAME_SECONDS, encode_frames, ffmpeg_exe, read_frame, \
+    video_images
+
+STATE_SUFFIX = '.state.json'
+
+
+@dataclass
+class HlsState:
+    last_stem: str = ''  # Stem of the last image encoded, e.g. 1699643617662483
+    num_frames: int = 0
+    fps: float = 0.
+    size: Optional[List[int]] = None  # Frame (width, height), fixed by the first run
+    runs: List[dict] = field(default_factory=list)  # Init segment and [segment, duration] list of each run
+
+
+def state_file(output_m3u8: Path) -> Path:
+    """
+    State file of a playlist, e.g. left.state.json for left.m3u8
+    """
+    return output_m3u8.with_name(f'{output_m3u8.stem}{STATE_SUFFIX}')
+
+
+def load_state(output_m3u8: Path) -> HlsState:
+    """
+    Load the state of a playlist, or an empty state if there is none
+    """
+    path = state_file(output_m3u8)
+    if path.exists():
+        return HlsState(**json.loads(path.read_text()))
+    return HlsState()
+
+
+def replace_text(path: Path, text: str):
+    """
+    Write a file through a temporary file so readers never see it half written
+    """
+    tmp = path.with_name(f'{path.name}.tmp')
+    tmp.write_text(text)
+    tmp.replace(path)
+
+
+def read_segments(run_m3u8: Path) -> List[Tuple[str, float]]:
+    """
+    Segments and their durations in seconds from a playlist written by ffmpeg
+    """
+    segments = []
+    duration = None
+    for line in run_m3u8.read_text().splitlines():
+        if line.startswith('#EXTINF:'):
+            duration = float(line[len('#EXTINF:'):].split(',')[0])
+        elif line and not line.startswith('#') and duration is not None:
+            segments.append((line, duration))
+            duration = None
+    return segments
+
+
+def write_playlist(output_m3u8: Path, state: HlsState):
+    """
+    Write the playlist of all runs. Each run has its own init segment, so runs are separated by a discontinuity
+    """
+    durations = [d for run in state.runs for _, d in run['segments']]
+    lines = ['#EXTM3U', '#EXT-X-VERSION:7', f'#EXT-X-TARGETDURATION:{math.ceil(max(durations, default=0))}',
+             '#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-PLAYLIST-TYPE:EVENT']
+    for i, run in enumerate(state.runs):
+        if i > 0:
+            lines.append('#EXT-X-DISCONTINUITY')
+        lines.append(f'#EXT-X-MAP:URI="{run["init"]}"')
+        for segment, duration in run['segments']:
+            lines += [f'#EXTINF:{duration:.6f},', segment]
+    lines.append('#EXT-X-ENDLIST')  # Complete until the next run rewrites it
+    replace_text(output_m3u8, '\n'.join(lines) + '\n')
+
+
+def append_to_hls(image_path: str, output_m3u8: str, demosaic: bool = False, num_images=None,
+                  workers: int = None, preset: str = 'default', threads: int = None) -> List[Tuple[datetime, str]]:
+    """
+    Append the images added to a folder since the last run to a fragmented MP4 HLS playlist. Only the new images are
+    decoded and encoded, into new segments
+    :param image_path: The path to the images
+    :param output_m3u8: The playlist to create or append to
+    :param demosaic: (optional) Whether to demosaic the image
+    :param num_images: (optional) Maximum number of new images to use
+    :param workers: (optional) Number of processes to decode images. Default is the number of CPUs
+    :param preset: (optional) Name of the encoder preset, one of ENCODER_PRESETS
+    :param threads: (optional) Number of encoder threads. Default is the encoder default
+    :return: Tuple with sorted timestamp in timestamp(datetime), filename of the images appended
+    """
+    output_m3u8 = Path(output_m3u8)
+    if not ffmpeg_exe():
+        err(f'ffmpeg is needed to write {output_m3u8}')
+        return []
+
+    state = load_state(output_m3u8)
+    files = video_images(Path(image_path))
+    if state.last_stem:
+        files = files.select(files.stems.astype(np.int64) > int(state.last_stem))
+    if num_images and num_images > 0:
+        files = files.select(slice(0, num_images))
+    if len(files) == 0:
+        info(f"No new images in {image_path} since {state.last_stem}")
+        return []
+
+    iso_datetimes = pd.DatetimeIndex(timestamps_to_datetime64(files.stems))
+    if not state.runs:
+        # Infer the frame rate from the first two images and fix the size for all runs
+        if len(files) < 2:
+            info(f"Not enough images found in {image_path}")
+            return []
+        state.fps = float(np.ceil(1 / (iso_datetimes[1] - iso_datetimes[0]).total_seconds()))
+        first = read_frame(files.paths[0], demosaic)
+        state.size = [first.shape[1], first.shape[0]]
+
+    prefix = f'{output_m3u8.stem}_{len(state.runs):04d}'
+    run_m3u8 = output_m3u8.with_name(f'{prefix}.m3u8')
+    init = f'{prefix}_init.mp4'
+    # Continue the timeline of the earlier runs. Without B-frames a run never decodes before the end of the last one
+    output_args = ['-output_ts_offset', f'{state.num_frames / state.fps:.6f}', '-bf', '0',
+                   '-f', 'hls', '-hls_time', str(KEYFRAME_SECONDS), '-hls_playlist_type', 'vod',
+                   '-hls_segment_type', 'fmp4', '-hls_segment_options', 'movflags=+frag_discont',
+                   '-hls_fmp4_init_filename', init,
+                   '-hls_segment_filename', output_m3u8.with_name(f'{prefix}_%05d.m4s').as_posix()]
+    info(f"Appending {len(files)} images to {output_m3u8} at {state.fps} fps...")
+    encode_frames(files.paths, run_m3u8.as_posix(), state.fps, demosaic, workers,
+                  int(KEYFRAME_SECONDS * state.fps), tuple(state.size), output_args, encoder='ffmpeg', preset=preset,
+                  threads=threads)
+
+    state.runs.append({'init': init, 'segments': read_segments(run_m3u8)})
+    run_m3u8.unlink()
+    state.last_stem = str(files.stems[-1])
+    state.num_frames += len(files)
+    write_playlist(output_m3u8, state)
+    replace_text(state_file(output_m3u8), json.dumps(asdict(state), indent=1))
+    return list(zip(iso_datetimes, files.paths))
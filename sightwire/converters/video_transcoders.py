@@ -1,95 +1,493 @@
 # sightwire, Apache-2.0 license
 # Filename: convertors/video.py
 # Description: Common video transcoding functions
-from typing import List, Tuple
+import os
+import shutil
+import subprocess
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Sequence, Tuple
 
 import cv2
 import numpy as np
-import shutil
+import pandas as pd
 
 from datetime import datetime
 from tempfile import TemporaryDirectory as tempdir
 from pathlib import Path
 
-from moviepy.editor import ImageSequenceClip
-
 from sightwire.logger import info
-from sightwire.converters.time_utils import convert_timestamp_to_datetime_16, convert_timestamp_to_datetime_10
+from sightwire.converters.sync import align_streams
+from sightwire.converters.time_utils import timestamps_to_datetime64
+from sightwire.loaders.discovery import ImageFiles, discover_images
+
+VIDEO_EXTENSIONS = ['.tif', '.png', '.jpg', '.jpeg']  # In order of preference when a folder has more than one
+BAYER_CODE = cv2.COLOR_BayerRG2BGR  # Bayer pattern of the raw PROSILICA images
+KEYFRAME_SECONDS = 10  # Keyframe interval. Segments of a segmented encode start on a keyframe
+STEREO_LAYOUTS = ['side-by-side', 'separate']
+
+
+def video_images(image_path: Path) -> ImageFiles:
+    """
+    Sorted images in a folder to make a video from. Only one kind of image is used if the folder has more than one,
+    e.g. .tif and .png of the same frames
+    """
+    files = discover_images(image_path, VIDEO_EXTENSIONS, recursive=False)
+    suffixes = files.suffixes()
+    for ext in VIDEO_EXTENSIONS:
+        if (suffixes == ext).any():
+            return files.select(suffixes == ext)
+    return files
+
+
+def ffmpeg_exe() -> Optional[str]:
+    """
+    Path to ffmpeg, from imageio-ffmpeg (installed with moviepy, honors IMAGEIO_FFMPEG_EXE) or the PATH
+    """
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except (ImportError, RuntimeError):
+        return shutil.which('ffmpeg')
+
+
+def to_frame(image: np.ndarray, demosaic: bool = False) -> np.ndarray:
+    """
+    Convert a decoded image to an 8-bit, 3 channel BGR frame ready to encode
+    :param image: Image as read with cv2.IMREAD_UNCHANGED
+    :param demosaic: (optional) True to convert a single channel Bayer image to color
+    :return: The frame
+    """
+    if demosaic and image.ndim == 2:
+        image = cv2.cvtColor(image, BAYER_CODE)  # Before scaling, to interpolate at the full bit depth
+    if image.dtype == np.uint16:
+        image = (image >> 8).astype(np.uint8)
+    if image.ndim == 2:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    elif image.shape[2] == 4:
+        image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+    return image
+
+
+def read_frame(image_path: str, demosaic: bool = False) -> np.ndarray:
+    """
+    Read an image as an 8-bit, 3 channel BGR frame ready to encode
+    :param image_path: Path to the image
+    :param demosaic: (optional) True to convert a single channel Bayer image to color
+    :return: The frame
+    """
+    image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise ValueError(f'Could not read {image_path}')
+    return to_frame(image, demosaic)
+
+
+def iter_frames(image_paths: Sequence[str], demosaic: bool = False, workers: int = None,
+                buffer: int = None) -> Iterator[np.ndarray]:
+    """
+    Decode images in a process pool and return the frames in order. At most buffer frames are decoded ahead of the
+    consumer, so memory stays bounded however slow the encoder is
+    :param image_paths: Paths to the images, in order
+    :param demosaic: (optional) True to convert single channel Bayer images to color
+    :param workers: (optional) Number of processes. Default is the number of CPUs. 1 to decode in this process
+    :param buffer: (optional) Maximum number of frames decoded ahead. Default is twice the number of workers
+    :return: Iterator of 8-bit BGR frames
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(image_paths) <= 1:
+        for path in image_paths:
+            yield read_frame(path, demosaic)
+        return
+
+    buffer = buffer or 2 * workers
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        paths = iter(image_paths)
+        pending = deque(pool.submit(read_frame, p, demosaic) for _, p in zip(range(buffer), paths))
+        while pending:
+            frame = pending.popleft().result()
+            path = next(paths, None)
+            if path is not None:
+                pending.append(pool.submit(read_frame, path, demosaic))
+            yield frame
+
+
+@dataclass(frozen=True)
+class EncoderPreset:
+    """
+    H.264 settings to trade encode speed against file size
+    """
+    crf: int = 23  # Constant rate factor, higher is smaller and lower quality
+    speed: str = 'medium'  # x264 preset, slower is smaller at the same quality
+    max_height: int = 0  # Taller frames are downscaled to this height. 0 to keep the size
+
+
+ENCODER_PRESETS = {
+    'default': EncoderPreset(),
+    'archive': EncoderPreset(crf=28, speed='slow'),  # Smallest files, slowest encode
+    'preview': EncoderPreset(crf=28, speed='veryfast', max_height=480),  # Fast, low resolution
+}
+ENCODERS = ['ffmpeg', 'cv2', 'moviepy']
+
+
+def encoded_size(size: Tuple[int, int], preset: EncoderPreset) -> Tuple[int, int]:
+    """
+    Frame (width, height) after the preset downscaling. Downscaled widths are rounded to even
+    """
+    width, height = size
+    if not preset.max_height or height <= preset.max_height:
+        return size
+    return 2 * round(width * preset.max_height / height / 2), preset.max_height
+
+
+class FfmpegWriter:
+    """
+    Writes raw BGR frames to an ffmpeg subprocess over a pipe, encoded as H.264
+    """
+
+    def __init__(self, output_mp4: str, fps: float, size: Tuple[int, int], gop: int = None,
+                 output_args: Sequence[str] = (), preset: EncoderPreset = EncoderPreset(), threads: int = None):
+        """
+        :param output_mp4: The movie file to write
+        :param fps: Frame rate
+        :param size: Frame (width, height)
+        :param gop: (optional) Keyframe interval in frames. Default is the encoder default
+        :param output_args: (optional) More ffmpeg output options, e.g. ['-f', 'hls']
+        :param preset: (optional) Quality, speed and size of the movie
+        :param threads: (optional) Number of encoder threads. Default is the encoder default
+        """
+        width, height = size
+        filters = ['pad=ceil(iw/2)*2:ceil(ih/2)*2']  # yuv420p needs even dimensions
+        if encoded_size(size, preset) != size:
+            filters.insert(0, 'scale=%d:%d:flags=area' % encoded_size(size, preset))
+        exe = ffmpeg_exe()
+        if exe is None:
+            raise RuntimeError('ffmpeg not found; install it or use --encoder cv2')
+        command = [exe, '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-',
+                   '-vf', ','.join(filters),
+                   '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-crf', str(preset.crf), '-preset', preset.speed]
+        if threads:
+            command += ['-threads', str(threads)]
+        if gop:
+            command += ['-g', str(gop), '-keyint_min', str(gop), '-sc_threshold', '0']
+        command += list(output_args) + [output_mp4]
+        self.output_mp4 = output_mp4
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, frame: np.ndarray):
+        self.process.stdin.write(np.ascontiguousarray(frame).data)
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError(f'ffmpeg failed with exit code {self.process.returncode} writing {self.output_mp4}')
+
+
+class Cv2Writer:
+    """
+    Writes BGR frames with cv2.VideoWriter as MPEG-4 part 2. Used when ffmpeg is not available. Only the preset
+    downscaling applies, the codec has no rate factor or speed and picks its own threads
+    """
+
+    def __init__(self, output_mp4: str, fps: float, size: Tuple[int, int], gop: int = None,
+                 preset: EncoderPreset = EncoderPreset(), threads: int = None):
+        self.output_mp4 = output_mp4
+        self.size = encoded_size(size, preset)
+        self.writer = cv2.VideoWriter(output_mp4, cv2.VideoWriter_fourcc(*'mp4v'), fps, self.size)
+        if not self.writer.isOpened():
+            raise RuntimeError(f'Could not open {output_mp4} for writing')
 
+    def write(self, frame: np.ndarray):
+        if (frame.shape[1], frame.shape[0]) != self.size:
+            frame = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        self.writer.write(frame)
 
-def image_to_mp4(image_path: str, output_mp4: str, demosaic: bool = False, num_images=None) -> List[Tuple[datetime, str]]:
+    def close(self):
+        self.writer.release()
+
+
+class MoviepyWriter:
+    """
+    Writes BGR frames with the moviepy ffmpeg writer, encoded as H.264
+    """
+
+    def __init__(self, output_mp4: str, fps: float, size: Tuple[int, int], gop: int = None,
+                 preset: EncoderPreset = EncoderPreset(), threads: int = None):
+        from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+        self.size = encoded_size(size, preset)
+        params = ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p', '-crf', str(preset.crf)]
+        if gop:
+            params += ['-g', str(gop), '-keyint_min', str(gop), '-sc_threshold', '0']
+        self.writer = FFMPEG_VideoWriter(output_mp4, self.size, fps, codec='libx264', preset=preset.speed,
+                                         threads=threads, ffmpeg_params=params)
+
+    def write(self, frame: np.ndarray):
+        if (frame.shape[1], frame.shape[0]) != self.size:
+            frame = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        self.writer.write_frame(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+    def close(self):
+        self.writer.close()
+
+
+def open_writer(output_mp4: str, fps: float, size: Tuple[int, int], gop: int = None,
+                output_args: Sequence[str] = (), encoder: str = None, preset: str = 'default', threads: int = None):
+    """
+    Open a frame writer
+    :param output_mp4: The movie file to write
+    :param fps: Frame rate
+    :param size: Frame (width, height) of the frames written
+    :param gop: (optional) Keyframe interval in frames
+    :param output_args: (optional) More ffmpeg output options, e.g. ['-f', 'hls']. Only for the ffmpeg encoder
+    :param encoder: (optional) ffmpeg, cv2 or moviepy. Default is ffmpeg if available, otherwise cv2
+    :param preset: (optional) Name of the encoder preset, one of ENCODER_PRESETS
+    :param threads: (optional) Number of encoder threads. Default is the encoder default
+    :return: Writer with write(frame) and close()
+    """
+    assert preset in ENCODER_PRESETS, f"Unknown encoder preset {preset}, expected one of {list(ENCODER_PRESETS)}"
+    if encoder is None:
+        encoder = 'ffmpeg' if ffmpeg_exe() else 'cv2'
+        if encoder == 'cv2':
+            info('ffmpeg not found, writing with cv2.VideoWriter')
+    assert encoder in ENCODERS, f"Unknown encoder {encoder}, expected one of {ENCODERS}"
+    if output_args and encoder != 'ffmpeg':
+        raise ValueError(f'ffmpeg output options need the ffmpeg encoder, not {encoder}')
+
+    if encoder == 'ffmpeg':
+        return FfmpegWriter(output_mp4, fps, size, gop, output_args, ENCODER_PRESETS[preset], threads)
+    if encoder == 'moviepy':
+        return MoviepyWriter(output_mp4, fps, size, gop, ENCODER_PRESETS[preset], threads)
+    return Cv2Writer(output_mp4, fps, size, gop, ENCODER_PRESETS[preset], threads)
+
+
+def encode_frames(image_paths: Sequence[str], output_mp4: str, fps: float, demosaic: bool = False,
+                  workers: int = None, gop: int = None, size: Tuple[int, int] = None,
+                  output_args: Sequence[str] = (), previews=None, encoder: str = None, preset: str = 'default',
+                  threads: int = None) -> int:
+    """
+    Encode images to a movie, decoding them in a process pool and streaming the frames to the encoder
+    :param image_paths: Paths to the images, in order
+    :param output_mp4: The movie file to write
+    :param fps: Frame rate
+    :param demosaic: (optional) Whether to demosaic the images
+    :param workers: (optional) Number of processes to decode images. Default is the number of CPUs
+    :param gop: (optional) Keyframe interval in frames
+    :param size: (optional) Frame (width, height). Default is the size of the first image. Others are resized to it
+    :param output_args: (optional) More ffmpeg output options, e.g. ['-f', 'hls']
+    :param previews: (optional) Previews to make from the same frames, e.g. proxy videos and thumbnails
+    :param encoder: (optional) ffmpeg, cv2 or moviepy. Default is ffmpeg if available, otherwise cv2
+    :param preset: (optional) Name of the encoder preset, one of ENCODER_PRESETS
+    :param threads: (optional) Number of encoder threads. Default is the encoder default
+    :return: Number of frames encoded
+    """
+    writer = None
+    cnt = 0
+    try:
+        for cnt, (path, frame) in enumerate(zip(image_paths, iter_frames(image_paths, demosaic, workers)), start=1):
+            if previews:
+                previews.add(frame, path)
+            if size is None:
+                size = (frame.shape[1], frame.shape[0])
+            if (frame.shape[1], frame.shape[0]) != size:
+                frame = cv2.resize(frame, size)
+            if writer is None:
+                writer = open_writer(output_mp4, fps, size, gop, output_args, encoder, preset, threads)
+            writer.write(frame)
+            if cnt % 100 == 1:
+                info(f"Encoded {cnt} images for {output_mp4}...")
+    finally:
+        if writer:
+            writer.close()
+        if previews:
+            previews.close()
+    return cnt
+
+
+def split_segments(num_frames: int, segments: int, gop: int) -> List[slice]:
     """
-    Creates a movie from a collection of images in sorted order
+    Split frames into about equal segments, each starting on a multiple of the keyframe interval
+    :param num_frames: Number of frames
+    :param segments: Number of segments
+    :param gop: Keyframe interval in frames
+    :return: Frame range of each segment. Fewer than segments if there are not enough keyframes
+    """
+    num_gops = -(-num_frames // gop)
+    bounds = [min(num_frames, round(i * num_gops / segments) * gop) for i in range(segments + 1)]
+    return [slice(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def concat_videos(input_mp4s: Sequence[str], output_mp4: str):
+    """
+    Join movies with the same encoding into one, without re-encoding, through the ffmpeg concat demuxer
+    :param input_mp4s: The movies, in order
+    :param output_mp4: The movie file to write
+    """
+    with tempdir() as workdir:
+        concat_list = Path(workdir) / 'concat.txt'
+        paths = [Path(p).resolve().as_posix().replace("'", "'\\''") for p in input_mp4s]
+        concat_list.write_text(''.join(f"file '{p}'\n" for p in paths))
+        subprocess.run([ffmpeg_exe(), '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+                        '-i', concat_list.as_posix(), '-c', 'copy', output_mp4], check=True)
+
+
+def image_to_mp4(image_path: str, output_mp4: str, demosaic: bool = False, num_images=None,
+                 workers: int = None, segments: int = 1, previews=None, encoder: str = None, preset: str = 'default',
+                 threads: int = None) -> List[Tuple[datetime, str]]:
+    """
+    Creates a movie from a collection of images in sorted order. Each image is decoded once, in a process pool, and
+    streamed to the encoder in order, with no temporary copies
     :param image_path: The path to the images
     :param output_mp4: The movie file to save the created movie to
     :param demosaic: (optional) Whether to demosaic the image
     :param num_images: (optional) Maximum number of images to use
+    :param workers: (optional) Number of processes to decode images. Default is the number of CPUs
+    :param segments: (optional) Number of segments to encode concurrently, then join into one movie
+    :param previews: (optional) Previews to make from the same frames, e.g. proxy videos, thumbnails and a contact
+    sheet. Made in a single segment, since the frames are only decoded once
+    :param encoder: (optional) ffmpeg, cv2 or moviepy. Default is ffmpeg if available, otherwise cv2
+    :param preset: (optional) Name of the encoder preset, one of ENCODER_PRESETS, e.g. archive or preview
+    :param threads: (optional) Number of encoder threads, shared between the segments. Default is the encoder default
     :return: Tuple with sorted timestamp in timestamp(datetime), filename  in order of the images stacked in the mp4
     """
     image_path = Path(image_path)
-    images = sorted(image_path.glob("*.tif"))
-    images += sorted(image_path.glob("*.png"))
-    images += sorted(image_path.glob("*.jpg"))
-    images += sorted(image_path.glob("*.jpeg"))
-    timestamps = []
-
-    acceptable_suffixes = ['.jpg', '.jpeg', '.png']
+    files = video_images(image_path)
+    if num_images and num_images > 0:
+        files = files.select(slice(0, num_images))
 
     # if there are no images, or not at least two then return
-    if len(images) == 0 or len(images) == 1:
+    if len(files) == 0 or len(files) == 1:
         assert False, f"Not enough images found in {image_path}"
         return []
 
-    # Working in a temporary directory, convert the images to  .jpg files
-    with tempdir() as workdir:
-        image_sequence = []
-        work_path = Path(workdir)
-        suffix = 'jpg'
-        for cnt, i in enumerate(images):
-            # Get the timestamp from the filename
-            if len(i.stem) == 16:
-                timestamps.append(convert_timestamp_to_datetime_16(i.stem))
-            elif len(i.stem) == 10:
-                timestamps.append(convert_timestamp_to_datetime_10(i.stem))
-            else:
-                timestamps.append(convert_timestamp_to_datetime_10(i.stem))
+    # Get the timestamps from the filenames, e.g. 1699643617662483.png and infer the frame rate from the first two
+    iso_datetimes = pd.DatetimeIndex(timestamps_to_datetime64(files.stems))
+    timestamps = list(zip(iso_datetimes, files.paths))
+    fps = np.ceil(1 / (iso_datetimes[1] - iso_datetimes[0]).total_seconds())
 
-            # if this is a JPG or PNG file, then we can just copy it over
-            if i.suffix.lower() in acceptable_suffixes and not demosaic:
-                image_out = work_path / f'{i.stem}.{i.suffix}'
-                shutil.copy(i.as_posix(), image_out.as_posix())
-                suffix = i.suffix
-            else:
-                image_out = work_path / f'{i.stem}.jpg'
+    assert fps > 0, "fps must be greater than 0"
+
+    # Create the video, streaming each frame to the encoder as it is decoded
+    info(f"Creating {output_mp4} from {len(timestamps)} images at {fps} fps...")
+    gop = int(KEYFRAME_SECONDS * fps)
+    ranges = split_segments(len(files), segments, gop) if segments > 1 else []
+    if len(ranges) > 1 and not ffmpeg_exe():
+        info('ffmpeg not found, encoding as a single segment')
+        ranges = []
+    if len(ranges) > 1 and previews:
+        info('Encoding as a single segment to make the previews from the same frames')
+        ranges = []
+
+    if len(ranges) <= 1:
+        if previews:
+            previews.start(fps, len(files))
+        encode_frames(files.paths, output_mp4, fps, demosaic, workers, gop, previews=previews, encoder=encoder,
+                      preset=preset, threads=threads)
+        return timestamps
+
+    # Encode the segments concurrently, sharing the decode processes between them, and join them without re-encoding.
+    # All segments use the size of the first image so they can be joined
+    first = read_frame(files.paths[0], demosaic)
+    size = (first.shape[1], first.shape[0])
+    segment_workers = max(1, (workers or os.cpu_count() or 1) // len(ranges))
+    segment_threads = max(1, threads // len(ranges)) if threads else None
+    with tempdir(dir=Path(output_mp4).parent) as workdir, ProcessPoolExecutor(max_workers=len(ranges)) as pool:
+        segment_mp4s = [f'{workdir}/{i:04d}.mp4' for i in range(len(ranges))]
+        futures = [pool.submit(encode_frames, files.paths[r], mp4, fps, demosaic, segment_workers, gop, size,
+                               encoder=encoder, preset=preset, threads=segment_threads)
+                   for r, mp4 in zip(ranges, segment_mp4s)]
+        for mp4, future in zip(segment_mp4s, futures):
+            info(f"Encoded {future.result()} images to segment {mp4}")
+        concat_videos(segment_mp4s, output_mp4)
+
+    return timestamps
 
-                raw_img = cv2.imread(i.as_posix(), cv2.IMREAD_UNCHANGED)
-                cv2.imwrite(image_out.as_posix(), raw_img)
 
-            image_sequence.append(image_out.as_posix())
+def stereo_to_mp4(left_path: str, right_path: str, output_mp4: str, demosaic: bool = False, num_images=None,
+                  workers: int = None, layout: str = 'side-by-side',
+                  tolerance: float = 0.5, encoder: str = None, preset: str = 'default', threads: int = None,
+                  previews: Sequence = ()) -> List[Tuple[datetime, str, str]]:
+    """
+    Creates a stereo movie from left and right images in one pass. Frames are paired by timestamp, both sides are
+    decoded in the same process pool and encoded either side by side into one movie, or into two synchronized movies
+    named with _LEFT and _RIGHT, e.g. dive_LEFT.mp4 and dive_RIGHT.mp4
+    :param left_path: The path to the left images
+    :param right_path: The path to the right images
+    :param output_mp4: The movie file to save the created movie to
+    :param demosaic: (optional) Whether to demosaic the images
+    :param num_images: (optional) Maximum number of image pairs to use
+    :param workers: (optional) Number of processes to decode images. Default is the number of CPUs
+    :param layout: (optional) side-by-side or separate
+    :param tolerance: (optional) Maximum time difference in seconds between a left and right image
+    :param encoder: (optional) ffmpeg, cv2 or moviepy. Default is ffmpeg if available, otherwise cv2
+    :param preset: (optional) Name of the encoder preset, one of ENCODER_PRESETS
+    :param threads: (optional) Number of threads of each encoder. Default is the encoder default
+    :param previews: (optional) Previews of the left and right frames, e.g. proxy videos and thumbnails of each side
+    :return: Tuple with sorted timestamp in timestamp(datetime), left and right filename in order of the frames in the
+    mp4
+    """
+    assert layout in STEREO_LAYOUTS, f"Unknown stereo layout {layout}, expected one of {STEREO_LAYOUTS}"
+    left = video_images(Path(left_path))
+    right = video_images(Path(right_path))
+    left_times = timestamps_to_datetime64(left.stems)
+    sync = align_streams([left_times, timestamps_to_datetime64(right.stems)], tolerance=tolerance, unique=True)
+    pairs = sync.matched()
+    info(f"Paired {len(pairs)} of {len(left)} left and {len(right)} right images, {sync.unmatched[1]} unmatched")
+    if num_images and num_images > 0:
+        pairs = pairs[:num_images]
+
+    # if there are no pairs, or not at least two then return
+    if len(pairs) < 2:
+        assert False, f"Not enough image pairs found in {left_path} and {right_path}"
+        return []
+
+    # Pair the timestamps with the images, using the left timestamp, and infer the frame rate from the first two
+    iso_datetimes = pd.DatetimeIndex(left_times[pairs[:, 0]])
+    timestamps = list(zip(iso_datetimes, left.paths[pairs[:, 0]], right.paths[pairs[:, 1]]))
+    fps = np.ceil(1 / (iso_datetimes[1] - iso_datetimes[0]).total_seconds())
+
+    assert fps > 0, "fps must be greater than 0"
+
+    output_mp4 = Path(output_mp4)
+    if layout == 'separate':
+        outputs = [output_mp4.with_name(f'{output_mp4.stem}_{side}{output_mp4.suffix}').as_posix()
+                   for side in ['LEFT', 'RIGHT']]
+    else:
+        outputs = [output_mp4.as_posix()]
+
+    # Decode the left and right images interleaved, so each pair comes out of the pool together
+    info(f"Creating {', '.join(outputs)} from {len(timestamps)} image pairs at {fps} fps...")
+    image_paths = np.column_stack([left.paths[pairs[:, 0]], right.paths[pairs[:, 1]]]).ravel()
+    frames = iter_frames(image_paths, demosaic, workers)
+    gop = int(KEYFRAME_SECONDS * fps)
+    writers = []
+    size = None
+    for p in previews:
+        p.start(fps, len(timestamps))
+    try:
+        for cnt, (frame_left, frame_right) in enumerate(zip(frames, frames)):
+            for p, frame, path in zip(previews, [frame_left, frame_right], timestamps[cnt][1:]):
+                p.add(frame, path)
+            if size is None:
+                size = (frame_left.shape[1], frame_left.shape[0])
+                frame_sizes = [(2 * size[0], size[1])] if layout == 'side-by-side' else [size, size]
+                writers = [open_writer(o, fps, s, gop, encoder=encoder, preset=preset, threads=threads)
+                           for o, s in zip(outputs, frame_sizes)]
+            if (frame_left.shape[1], frame_left.shape[0]) != size:
+                frame_left = cv2.resize(frame_left, size)
+            if (frame_right.shape[1], frame_right.shape[0]) != size:
+                frame_right = cv2.resize(frame_right, size)
+            if layout == 'side-by-side':
+                writers[0].write(np.hstack([frame_left, frame_right]))
+            else:
+                writers[0].write(frame_left)
+                writers[1].write(frame_right)
             if cnt % 100 == 0:
-                info(f"Preparing {cnt} images for {output_mp4}...")
-            if num_images and cnt > num_images > 0:
-                info(f"Stopping at {num_images} images")
-                break
-
-        # Create the video from the .jpg files - doesn't work with .tif files
-        l = sorted(work_path.glob(f'*.{suffix}'))
-        l = [i.as_posix() for i in l]
-
-        # Calculate the time stamp and infer the frame rate from the first two images
-        if len(images[0].stem) == 16:
-            timestamps = [(convert_timestamp_to_datetime_16(i.stem), i.as_posix()) for i in images]
-        elif len(images[0].stem) == 10:
-            timestamps = [(convert_timestamp_to_datetime_10(i.stem), i.as_posix()) for i in images]
-        t0 = timestamps[0][0]
-        t1 = timestamps[1][0]
-        fps = np.ceil(1/(t1 - t0).total_seconds())
-
-        assert fps > 0, "fps must be greater than 0"
-
-        # Create the video
-        info(f"Creating {output_mp4} from {len(timestamps)} images at {fps} fps...")
-        image_sequence = ImageSequenceClip(l, fps=fps, with_mask=False)
-        image_sequence.write_videofile(output_mp4)
+                info(f"Encoded {cnt} image pairs for {', '.join(outputs)}...")
+    finally:
+        for writer in writers:
+            writer.close()
+        for p in previews:
+            p.close()
 
-        return timestamps
+    return timestamps
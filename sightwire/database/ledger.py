@@ -0,0 +1,106 @@
+# sightwire, Apache-2.0 license
+# Filename: database/ledger.py
+# Description: Local SQLite ledger of the media created in Tator, so reruns skip work that is already done
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sightwire.logger import info
+
+DEFAULT_LEDGER_PATH = Path.home() / 'sightwire' / 'ledger.sqlite'
+
+
+class Ledger:
+    QUERY_PATHS = 500  # Paths looked up per query, below the SQLite limit on query parameters
+
+    def __init__(self, host: str, project_id: int, db_path: Path = DEFAULT_LEDGER_PATH):
+        """
+        Open the ledger for a Tator host and project, creating it if needed
+        :param host: Tator host, e.g. http://localhost:8080
+        :param project_id: Tator project ID
+        :param db_path: Path to the SQLite database
+        """
+        self.host = host
+        self.project_id = project_id
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(db_path.as_posix())
+        self.db.execute('''CREATE TABLE IF NOT EXISTS media (
+                               host TEXT NOT NULL,
+                               project INTEGER NOT NULL,
+                               path TEXT NOT NULL,
+                               md5 TEXT,
+                               size INTEGER,
+                               side TEXT,
+                               media_id INTEGER,
+                               state_id INTEGER,
+                               created TEXT,
+                               PRIMARY KEY (host, project, path))''')
+        self.db.commit()
+        info(f'Using ledger {db_path}')
+
+    def close(self):
+        self.db.close()
+
+    def loaded(self, paths: Iterable[str]) -> Dict[str, int]:
+        """
+        Media already created in this project, looked up for some paths only so memory stays bounded
+        :param paths: Local paths, e.g. the images of one chunk
+        :return: Dictionary of path to media ID, for the paths in the ledger
+        """
+        return dict(self._select('media_id', paths))
+
+    def find(self, path: str) -> Optional[int]:
+        """
+        Media ID of a path already created in this project, or None
+        """
+        row = self.db.execute('SELECT media_id FROM media WHERE host = ? AND project = ? AND path = ?',
+                              (self.host, self.project_id, path)).fetchone()
+        return row[0] if row else None
+
+    def paired(self, paths: Iterable[str]) -> set:
+        """
+        Paths of the media already in a stereo state in this project, looked up for some paths only
+        :param paths: Local paths, e.g. the images of one chunk
+        :return: The paths in a stereo state
+        """
+        return {path for path, _ in self._select('state_id', paths)}
+
+    def _select(self, column: str, paths: Iterable[str]) -> List[Tuple[str, int]]:
+        """
+        Path and column of the paths in the ledger where the column is set
+        """
+        paths = list(paths)
+        rows = []
+        for i in range(0, len(paths), self.QUERY_PATHS):
+            chunk = paths[i:i + self.QUERY_PATHS]
+            rows += self.db.execute(f'SELECT path, {column} FROM media WHERE host = ? AND project = ? '
+                                    f'AND {column} IS NOT NULL AND path IN ({", ".join("?" * len(chunk))})',
+                                    (self.host, self.project_id, *chunk)).fetchall()
+        return rows
+
+    def record(self, specs: Iterable[dict], paths: Iterable[str], media_ids: Iterable[int], side: str):
+        """
+        Record created media
+        :param specs: The media specs from gen_spec
+        :param paths: Local path of each media
+        :param media_ids: Tator media ID of each media
+        :param side: Side of the media, e.g. LEFT
+        """
+        now = datetime.utcnow().isoformat()
+        self.db.executemany('INSERT OR REPLACE INTO media (host, project, path, md5, size, side, media_id, created) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            [(self.host, self.project_id, path, spec.get('md5'), spec.get('size'), side, media_id, now)
+                             for spec, path, media_id in zip(specs, paths, media_ids) if media_id is not None])
+        self.db.commit()
+
+    def record_state(self, paths: Iterable[str], state_ids: Iterable[int]):
+        """
+        Record the stereo state each media belongs to
+        :param paths: Local path of each media
+        :param state_ids: Tator state ID of each media
+        """
+        self.db.executemany('UPDATE media SET state_id = ? WHERE host = ? AND project = ? AND path = ?',
+                            [(state_id, self.host, self.project_id, path)
+                             for path, state_id in zip(paths, state_ids) if state_id is not None])
+        self.db.commit()
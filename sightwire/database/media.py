@@ -3,8 +3,10 @@
 # Description:  Database operations related to media
 from dataclasses import asdict
 import hashlib
+import math
 import time
 from pathlib import Path
+from typing import Tuple
 from uuid import uuid1
 import tator
 from tator.openapi.tator_openapi import TatorApi, CreateListResponse
@@ -12,26 +14,27 @@ from sightwire.database.data_types import PLATFORM_LIST, CAMERA_LIST, SIDE_LIST,
 from sightwire.logger import err, info, debug
 
 
-def local_md5_partial(fname, max_chunks=5):
-    """ Computes md5sum-based fingerprint of the first part of a local file.
+def read_md5_partial(fname, max_chunks=5) -> Tuple[str, bytes]:
+    """ Computes md5sum-based fingerprint of the first part of a local file, and returns the bytes read for it.
 
     :param fname: Path to the local file.
     :param max_chunks: Maximum number of chunks to download.
-    :returns: md5 sum of the first part of the file.
+    :returns: md5 sum of the first part of the file, and the first part of the file.
     """
     CHUNK_SIZE = 2 * 1024 * 1024
-    chunk_count = 0
-    md5 = hashlib.md5()
-
     with open(fname, 'rb') as f:
-        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
-            if chunk:
-                chunk_count += 1
-                md5.update(chunk)
-            if chunk_count >= max_chunks:
-                break
+        data = f.read(CHUNK_SIZE * max_chunks)
+    return hashlib.md5(data).hexdigest(), data
+
 
-    return md5.hexdigest()
+def local_md5_partial(fname, max_chunks=5):
+    """ Computes md5sum-based fingerprint of the first part of a local file.
+
+    :param fname: Path to the local file.
+    :param max_chunks: Maximum number of chunks to download.
+    :returns: md5 sum of the first part of the file.
+    """
+    return read_md5_partial(fname, max_chunks)[0]
 
 
 def gen_spec(file_loc: str, type_id: int, section: str, **kwargs) -> dict:
@@ -47,8 +50,13 @@ def gen_spec(file_loc: str, type_id: int, section: str, **kwargs) -> dict:
     data = kwargs.get('data')
     base_url = kwargs.get('base_url')  # The base URL to the file if hosted. If None, the file will be uploaded.
     vol_map = kwargs.get('vol_map') # Docker volume mount maps. key:value pairs that specify the external/internal mapping for creating a url
+    previews = kwargs.get('previews')  # Previews, e.g. thumbnails, to make from the same read as the md5
+    md5, head = read_md5_partial(file_loc)
+    if previews:
+        previews.add_file(file_loc, head)
     if data:
-        attributes = asdict(data)
+        # Drop missing values, e.g. no depth/position within the max gap, so Tator keeps them unset
+        attributes = {k: v for k, v in asdict(data).items() if not (isinstance(v, float) and math.isnan(v))}
 
     if base_url:
         file_url = None
@@ -67,7 +75,7 @@ def gen_spec(file_loc: str, type_id: int, section: str, **kwargs) -> dict:
             'url': file_url,
             'name': file_load_path.name,
             'section': section,
-            'md5': local_md5_partial(file_loc),
+            'md5': md5,
             'size': file_load_path.stat().st_size,
             'attributes': attributes,
             'gid': str(uuid1()),
@@ -80,7 +88,7 @@ def gen_spec(file_loc: str, type_id: int, section: str, **kwargs) -> dict:
             'type': type_id,
             'path': file_loc,
             'section': section,
-            'md5': local_md5_partial(file_loc),
+            'md5': md5,
             'size': file_load_path.stat().st_size,
             'attributes': attributes,
             'gid': str(uuid1()),
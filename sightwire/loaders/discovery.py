@@ -0,0 +1,174 @@
+# sightwire, Apache-2.0 license
+# Filename: loaders/discovery.py
+# Description: Fast image discovery. Walks directories in parallel with os.scandir and caches a manifest per directory,
+# keyed by the directory modification time, so repeat runs skip the walk. Manifests are evicted least recently used
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from sightwire.logger import info, debug
+
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.tif', '.tiff']
+DEFAULT_MANIFEST_PATH = Path.home() / 'sightwire' / 'cache' / 'manifests'
+DEFAULT_MAX_BYTES = 256 * 1024 ** 2  # 256 MB of manifests
+MTIME_RESOLUTION_NS = 2 * 10 ** 9  # Coarsest directory mtime resolution, e.g. FAT. A newer mtime may miss changes
+
+
+@dataclass
+class ImageFiles:
+    paths: np.ndarray  # Full paths, sorted
+    stems: np.ndarray  # File names without the extension, e.g. 1699643617662483
+
+    def __len__(self):
+        return len(self.paths)
+
+    @classmethod
+    def concat(cls, files: Sequence['ImageFiles']) -> 'ImageFiles':
+        """
+        Combine image lists, e.g. the left and right images
+        """
+        if len(files) == 0:
+            return cls(paths=np.array([], dtype=object), stems=np.array([], dtype=str))
+        return cls(paths=np.concatenate([f.paths for f in files]), stems=np.concatenate([f.stems for f in files]))
+
+    def suffixes(self) -> np.ndarray:
+        """
+        Lower case file extensions, e.g. .png
+        """
+        return np.array([os.path.splitext(p)[1].lower() for p in self.paths])
+
+    def select(self, mask: np.ndarray) -> 'ImageFiles':
+        """
+        Subset of the images by a boolean mask or index array
+        """
+        return ImageFiles(paths=self.paths[mask], stems=self.stems[mask])
+
+
+def manifest_file(directory: str, manifest_path: Path) -> Path:
+    """
+    Manifest file for a directory, named by the hash of the directory path
+    """
+    return manifest_path / f'{hashlib.sha1(os.path.abspath(directory).encode()).hexdigest()}.json'
+
+
+def scan_directory(directory: str, manifest_path: Path = None) -> Tuple[List[str], List[str]]:
+    """
+    List the files and subdirectories in a directory, from its manifest if the directory has not changed
+    :param directory: Directory to scan
+    :param manifest_path: (optional) Path to store the manifests. None to always scan
+    :return: File names and subdirectory paths
+    """
+    scanned_ns = time.time_ns()
+    mtime_ns = os.stat(directory).st_mtime_ns
+    manifest = manifest_file(directory, manifest_path) if manifest_path else None
+    if manifest and manifest.exists():
+        try:
+            data = json.loads(manifest.read_text())
+            # A directory changed within the mtime resolution of the last scan, e.g. a growing image folder, may have
+            # new files with the same mtime, so it is only trusted once the scan is at least that much newer
+            if data['mtime_ns'] == mtime_ns and data['scanned_ns'] - mtime_ns >= MTIME_RESOLUTION_NS:
+                os.utime(manifest)  # Mark as recently used
+                return data['files'], data['dirs']
+        except (ValueError, KeyError):
+            debug(f'Ignoring bad manifest {manifest}')
+
+    files, dirs = [], []
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.path)
+            elif entry.is_file():
+                files.append(entry.name)
+
+    if manifest:
+        manifest_path.mkdir(parents=True, exist_ok=True)
+        tmp = manifest.with_suffix(f'.tmp{os.getpid()}')
+        tmp.write_text(json.dumps({'directory': directory, 'mtime_ns': mtime_ns, 'scanned_ns': scanned_ns,
+                                   'files': files, 'dirs': dirs}))
+        tmp.replace(manifest)
+    return files, dirs
+
+
+def evict(manifest_path: Path, max_bytes: int):
+    """
+    Remove the least recently used manifests until they take less than max_bytes
+    :param manifest_path: Path to the manifests
+    :param max_bytes: Maximum size of the manifests in bytes
+    """
+    with os.scandir(manifest_path) as it:
+        entries = [(e.path, e.stat()) for e in it if e.name.endswith('.json')]
+    total = sum(stat.st_size for _, stat in entries)
+    if total <= max_bytes:
+        return
+    removed = 0
+    for path, stat in sorted(entries, key=lambda e: e[1].st_mtime_ns):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # Evicted by another run
+        total -= stat.st_size
+        removed += 1
+    info(f'Evicted {removed} manifests from {manifest_path}')
+
+
+def discover_images(root: Path, extensions: Sequence[str] = IMAGE_EXTENSIONS, recursive: bool = True,
+                    workers: int = 8, manifest_path: Path = DEFAULT_MANIFEST_PATH,
+                    max_bytes: int = DEFAULT_MAX_BYTES) -> ImageFiles:
+    """
+    Find images in a directory. Subdirectories are scanned in parallel and filtered by extension in the same pass
+    :param root: Directory to search
+    :param extensions: Extensions to keep, e.g. ['.png', '.jpg']
+    :param recursive: True to search subdirectories
+    :param workers: Number of directories to scan at a time
+    :param manifest_path: (optional) Path to store the per-directory manifests. None to always scan
+    :param max_bytes: (optional) Maximum size of the manifests in bytes
+    :return: Sorted image paths and stems
+    """
+    extensions = tuple(e.lower() for e in extensions)
+    paths = []
+    frontier = [Path(root).as_posix()]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while frontier:
+            next_frontier = []
+            for directory, (files, dirs) in zip(frontier, pool.map(lambda d: scan_directory(d, manifest_path), frontier)):
+                paths.extend(f'{directory}/{f}' for f in files if f.lower().endswith(extensions))
+                if recursive:
+                    next_frontier.extend(dirs)
+            frontier = next_frontier
+    if manifest_path and manifest_path.exists():
+        evict(manifest_path, max_bytes)
+
+    paths.sort()
+    stems = [os.path.splitext(os.path.basename(p))[0] for p in paths]
+    info(f'Found {len(paths)} images in {root}')
+    return ImageFiles(paths=np.array(paths, dtype=object), stems=np.array(stems, dtype=str))
+
+
+def find_images(path: Path, extensions: Sequence[str] = IMAGE_EXTENSIONS) -> ImageFiles:
+    """
+    Find the images to load in a directory or a single image file. For a directory, only the images with the first
+    extension in extensions that has any matches are returned
+    :param path: Path to the image directory or a single image file
+    :param extensions: Extensions in order of preference
+    :return: Sorted image paths and stems
+    """
+    if path.is_dir():
+        files = discover_images(path, extensions)
+        suffixes = files.suffixes()
+        for ext in extensions:
+            mask = suffixes == ext
+            if mask.any():
+                info(f'Found {mask.sum()} images to load in {path} with extension {ext}')
+                return files.select(mask)
+    elif path.suffix.lower() in extensions and path.exists():
+        return ImageFiles(paths=np.array([path.as_posix()], dtype=object), stems=np.array([path.stem]))
+    return ImageFiles.concat([])
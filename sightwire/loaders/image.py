@@ -9,9 +9,12 @@ import click
 
 from common_args import parse_vol_map
 from sightwire import common_args
-from sightwire.converters.time_utils import assign_nearest
+from sightwire.converters.previews import Previews
+from sightwire.converters.time_utils import iter_assign_nearest
 from sightwire.database.common import init_api_project, find_media_type, find_state_type
 from sightwire.database.data_types import Platform, Camera, Side, StereoImageData
+from sightwire.database.ledger import Ledger
+from sightwire.loaders.discovery import ImageFiles, find_images
 from sightwire.loaders.image_utils import create_state_bulk, create_media_bulk, create_media
 from sightwire.logger import err, info
 
@@ -23,22 +26,34 @@ from sightwire.logger import err, info
 @common_args.force
 @common_args.base_url
 @common_args.vol_map
+@common_args.ledger
 @click.option("--input", '-i', type=Path, help='path to the image directory or a single image file')
 @click.option("--input-left", '-l', type=Path, help='path to the left image directory')
 @click.option("--input-right", '-r', type=Path, help='path to the right image directory')
 @click.option("--log-depth", type=Path, required=True,
-              help='path to the log with exported compass datetime/depth from the lcm logs')
+              help='path to the log with exported compass datetime/depth from the lcm logs (.csv, .parquet or .npz)')
 @click.option("--log-position", type=Path, required=True,
-              help='path to the log with exported USBL datetime/lat/lon from the lcm logs')
+              help='path to the log with exported USBL datetime/lat/lon from the lcm logs (.csv, .parquet or .npz)')
 @click.option("--platform-type", type=Platform, default=Platform.MINI_ROV, required=True)
 @click.option("--camera-type", type=Camera, default=Camera.FLIR, required=True)
 @click.option("--mission-name", type=str, required=True)
-@click.option("--bulk", is_flag=True, help="Bulk load. CAUTION: this does not verify if the images are already loaded")
+@click.option("--bulk", is_flag=True, help="Bulk load. Do not use this for real-time loading")
 @click.option("--max-images", required=False, type=int, help="Max number of images to load")
+@click.option("--max-gap", required=False, type=float,
+              help="Max time difference in seconds between an image and its depth/position. Images outside this are "
+                   "loaded without depth/position")
+@click.option("--nav-mode", type=click.Choice(['nearest', 'interp']), default='nearest',
+              help="Use the nearest depth/position sample or interpolate between samples at each image time")
+@click.option("--no-cache", is_flag=True, help="Parse the depth/position logs again instead of using the cache in ~/sightwire/cache")
+@click.option("--thumbnails", type=Path,
+              help="Directory to save a JPEG thumbnail of each image loaded, made from the same read as the md5")
+@common_args.thumbnail_size
+@common_args.contact_sheet
 def load_image(base_url: str, vol_map:str, input: Path, input_left: Path, input_right: Path, log_depth: Path, log_position: Path,
                host: str, token: str, project: str,
                platform_type: Platform, camera_type: Camera, mission_name: str, bulk: bool,
-               force: bool, max_images: int):
+               force: bool, max_images: int, max_gap: float, nav_mode: str,
+               no_cache: bool, ledger: Path, thumbnails: Path, thumbnail_size: int, contact_sheet: bool):
     """
     Load image(s) from a local file system to the database
     :param base_url: Base url to the images, e.g. http://localhost/compas/
@@ -55,8 +70,17 @@ def load_image(base_url: str, vol_map:str, input: Path, input_left: Path, input_
     :param bulk: True to bulk load images. Do not use this for real-time loading
     :param force: True to force load and skip over check
     :param max_images: Maximum number of images to load
+    :param max_gap: Maximum time difference in seconds between an image and its depth/position
+    :param nav_mode: 'nearest' or 'interp' to interpolate the depth/position at each image time
+    :param no_cache: True to parse the depth/position logs without the navigation cache
+    :param ledger: Path to the SQLite ledger of loaded media, used to skip images that are already loaded
+    :param thumbnails: Directory to save thumbnails of the images loaded, and the contact sheet
+    :param thumbnail_size: Longest side of the thumbnails in pixels
+    :param contact_sheet: True to also make a contact sheet of the images loaded, per side, in the thumbnails directory
     :return:
     """
+    if contact_sheet and not thumbnails:
+        raise click.UsageError('--contact-sheet needs --thumbnails DIR to save the contact sheet to')
     image_path = input
     image_path_left = input_left
     image_path_right = input_right
@@ -90,43 +114,11 @@ def load_image(base_url: str, vol_map:str, input: Path, input_left: Path, input_
     ste_state_type = find_state_type(api, project.id, "Stereo")
     assert ste_state_type is not None, f'Could not find type Stereo in project {project.name}'
 
-    acceptable_extensions = ['.png', '.jpg', '.png', '.jpeg', 'tif']
-    images_to_load = []
-    if image_path_left:
-        if image_path_left.is_dir():
-            for ext in acceptable_extensions:
-                new_images = sorted(image_path_left.rglob(f"*{ext}"))
-                if len(new_images) > 0:
-                    images_to_load.extend(new_images)
-                    info(f'Found {len(new_images)} left images to load in {image_path_left} with extension {ext}')
-                    break
-        else:
-            if image_path_left.suffix in acceptable_extensions and image_path_left.exists():
-                images_to_load.append(image_path_left)
-
-    if image_path_right:
-        if image_path_right.is_dir():
-            for ext in acceptable_extensions:
-                new_images = sorted(image_path_right.rglob(f"*{ext}"))
-                if len(new_images) > 0:
-                    images_to_load.extend(new_images)
-                    info(f'Found {len(new_images)} right images to load in {image_path_right} with extension {ext}')
-                    break
-        else:
-            if image_path_right.suffix in acceptable_extensions and image_path_right.exists():
-                images_to_load.append(image_path_right)
-
-    if image_path:
-        if image_path.is_dir():
-            for ext in acceptable_extensions:
-                new_images = sorted(image_path.rglob(f"*{ext}"))
-                if len(new_images) > 0:
-                    images_to_load.extend(new_images)
-                    info(f'Found {len(new_images)} left images to load in {image_path} with extension {ext}')
-                    break
-        else:
-            if image_path.suffix in acceptable_extensions and image_path.exists():
-                images_to_load.append(image_path)
+    acceptable_extensions = ['.png', '.jpg', '.jpeg', '.tif']
+    found = {side: find_images(p, acceptable_extensions)
+             for side, p in [(Side.LEFT, image_path_left), (Side.RIGHT, image_path_right), (Side.UNKNOWN, image_path)]
+             if p}
+    images_to_load = ImageFiles.concat(list(found.values()))
 
     if len(images_to_load) == 0:
         err(f'Could not find any images')
@@ -139,49 +131,97 @@ def load_image(base_url: str, vol_map:str, input: Path, input_left: Path, input_
                               'You may want to check the database first to see if it is are already '
                               'loaded. Add --force to load anyway.'):
 
-        # Search for the depth and lat/lon from the log files that is nearest to the image timestamp
-        df = assign_nearest(log_depth, log_position, images_to_load, max_images)
-
-        if df is None or len(df) == 0:
-            err(f'Could not find depth and lat/lon for the images in {log_depth} and {log_position}')
-            return
-
         section = f'{platform_type.name}/{camera_type.name}/{mission_name}'
 
-        if bulk:
+        # Search for the depth and lat/lon from the log files that is nearest to the image timestamp. This is done in
+        # time-sorted chunks that are loaded one at a time to bound memory for large missions
+        chunks = iter_assign_nearest(log_depth, log_position, images_to_load, max_images, max_gap, nav_mode,
+                                     not no_cache)
+
+        # Skip images already loaded, e.g. when resuming an interrupted run
+        _ledger = Ledger(host, project.id, ledger)
+
+        # Thumbnails and contact sheets of each side, made from the images as they are read for the md5
+        _previews = {}
+        if thumbnails:
+            for side, files in found.items():
+                _previews[side] = Previews(thumbnails, f'{mission_name}_{side.name}', thumbnail_size=thumbnail_size,
+                                           contact_sheet=contact_sheet)
+                _previews[side].start(None, min(len(files), max_images or len(files)))
+
+        def media_ids(df, column: str, side: Side) -> list:
+            """ Media IDs for a side, creating the media that are not in the ledger yet """
+            ids = df[column].map(loaded)
+            missing = ids.isna()
+            if missing.any():
+                ids[missing] = create_media_bulk(project.id, api, df[missing], base_url, _vol_map, image_type.id,
+                                                 section, side, platform_type, camera_type, mission_name, _ledger,
+                                                 _previews.get(side))
+            return ids.astype(int).tolist()
+
+        num_found = num_skipped = 0
+        for df in chunks:
+            num_found += len(df)
+            # Look up only the images of this chunk in the ledger
+            loaded = _ledger.loaded(df[['left', 'right']].values.ravel() if stereo else df['image'])
             if stereo:
-                left_ids = create_media_bulk(project.id, api, df, base_url, _vol_map, image_type.id, section, Side.LEFT,
-                                             platform_type, camera_type, mission_name)
-                right_ids = create_media_bulk(project.id, api, df, base_url, _vol_map, image_type.id, section, Side.RIGHT,
-                                              platform_type, camera_type, mission_name)
-                iso_datetime = df['iso_datetime'].tolist()
-                create_state_bulk(project.id, api, iso_datetime, left_ids, right_ids, ste_state_type.id, platform_type,
-                                  camera_type, mission_name)
+                paired = _ledger.paired(loaded)
+                done = df['left'].isin(paired) & df['right'].isin(paired)
             else:
-                create_media_bulk(project.id, api, df, base_url, _vol_map, image_type.id, section, Side.UNKNOWN, platform_type,
-                                  camera_type, mission_name)
-        else:
-            for index, row in df.iterrows():
+                done = df['image'].isin(loaded)
+            num_skipped += done.sum()
+            df = df[~done]
+            if len(df) == 0:
+                continue
+
+            if bulk:
                 if stereo:
-                    left_id = create_media(project.id, api, row, base_url, _vol_map, image_type.id, section, Side.LEFT,
-                                           platform_type, camera_type, mission_name)
-                    right_id = create_media(project.id, api, row, base_url, _vol_map, image_type.id, section, Side.RIGHT,
-                                            platform_type, camera_type, mission_name)
-
-                    # Add the left and right images to a stereo state
-                    response = api.create_state_list(
-                        project=project.id,
-                        body={
-                            "type": ste_state_type.id,
-                            "media_ids": [left_id, right_id],
-                            "frame": 0,
-                            "attributes": asdict(StereoImageData(
-                                platform=platform_type.value,
-                                camera=camera_type.value,
-                                mission=mission_name,
-                                iso_datetime=row.iso_datetime))
-                        })
-                    info(f'Created stereo state {response.id} for media LEFT {left_id} and RIGHT {right_id}')
+                    left_ids = media_ids(df, 'left', Side.LEFT)
+                    right_ids = media_ids(df, 'right', Side.RIGHT)
+                    iso_datetime = df['iso_datetime'].tolist()
+                    state_ids = create_state_bulk(project.id, api, iso_datetime, left_ids, right_ids, ste_state_type.id,
+                                                  platform_type, camera_type, mission_name)
+                    _ledger.record_state(df['left'].tolist() + df['right'].tolist(), state_ids + state_ids)
                 else:
-                    create_media(project.id, api, row, base_url, _vol_map, image_type.id, section, Side.UNKNOWN, platform_type,
-                                 camera_type, mission_name)
+                    create_media_bulk(project.id, api, df, base_url, _vol_map, image_type.id, section, Side.UNKNOWN, platform_type,
+                                      camera_type, mission_name, _ledger, _previews.get(Side.UNKNOWN))
+            else:
+                for index, row in df.iterrows():
+                    if stereo:
+                        left_id = loaded.get(row.left) or \
+                                  create_media(project.id, api, row, base_url, _vol_map, image_type.id, section, Side.LEFT,
+                                               platform_type, camera_type, mission_name, _ledger,
+                                               _previews.get(Side.LEFT))
+                        right_id = loaded.get(row.right) or \
+                                   create_media(project.id, api, row, base_url, _vol_map, image_type.id, section, Side.RIGHT,
+                                                platform_type, camera_type, mission_name, _ledger,
+                                                _previews.get(Side.RIGHT))
+
+                        # Add the left and right images to a stereo state
+                        response = api.create_state_list(
+                            project=project.id,
+                            body={
+                                "type": ste_state_type.id,
+                                "media_ids": [left_id, right_id],
+                                "frame": 0,
+                                "attributes": asdict(StereoImageData(
+                                    platform=platform_type.value,
+                                    camera=camera_type.value,
+                                    mission=mission_name,
+                                    iso_datetime=row.iso_datetime))
+                            })
+                        state_id = response.id[0] if isinstance(response.id, list) else response.id
+                        info(f'Created stereo state {state_id} for media LEFT {left_id} and RIGHT {right_id}')
+                        _ledger.record_state([row.left, row.right], [state_id, state_id])
+                    else:
+                        create_media(project.id, api, row, base_url, _vol_map, image_type.id, section, Side.UNKNOWN, platform_type,
+                                     camera_type, mission_name, _ledger, _previews.get(Side.UNKNOWN))
+
+        _ledger.close()
+        for previews in _previews.values():
+            previews.close()
+        if num_skipped > 0:
+            info(f'Skipped {num_skipped} images already loaded')
+        if num_found == 0:
+            err(f'Could not find depth and lat/lon for the images in {log_depth} and {log_position}')
+            return
@@ -5,13 +5,15 @@ import pandas as pd
 import tator
 
 from sightwire.database.data_types import Platform, Camera, StereoImageData, enum_to_string, Side, ImageData
+from sightwire.database.ledger import Ledger
+from sightwire.converters.previews import Previews
 from sightwire.database.media import gen_spec
 from sightwire.logger import info, err, debug
 
 
 def create_state_bulk(project_id: int, api: tator.api, iso_datetime: list, ids_left: list, ids_right: list,
                       state_type_id: int, platform: Platform, camera: Camera,
-                      mission_name: str):
+                      mission_name: str) -> List[int]:
     """
     Create stereo states in bulk. This is used to create associations between left and right images
     that can be queried by e.g. time, mission, platform, camera, etc.
@@ -34,7 +36,7 @@ def create_state_bulk(project_id: int, api: tator.api, iso_datetime: list, ids_l
                 camera=camera.value,
                 mission=mission_name,
                 iso_datetime=dt))}
-            for dt, left, right in zip(iso_datetime, left_chunk, right_chunk)]
+            for dt, left, right in zip(iso_datetime[start_idx:end_idx], left_chunk, right_chunk)]
         assert specs is not None, f'Could not create specs for stereo state'
         info(f'Creating {len(specs)} stereo states')
         state_ids += [
@@ -45,10 +47,17 @@ def create_state_bulk(project_id: int, api: tator.api, iso_datetime: list, ids_l
             for new_id in response.id
         ]
         info(f"Created {len(state_ids)} stereo states")
+    return state_ids
 
 
 def create_media_bulk(project_id: int, api: tator.api, df: pd.DataFrame, base_url: str, vol_map:dict, image_type_id: int,
-                      section: str,side: Side, platform: Platform, camera: Camera, mission_name: str) -> List[int]:
+                      section: str,side: Side, platform: Platform, camera: Camera, mission_name: str,
+                      ledger: Ledger = None, previews: Previews = None) -> List[int]:
+    """
+    Create media in bulk from one chunk of images, e.g. as yielded by iter_assign_nearest.
+    If a ledger is given, the created media are recorded in it. If previews are given, e.g. thumbnails, the images
+    are added to them as they are read for the md5
+    """
     chunk_size = 500  # Number of images to load at a time
     num_chunks = len(df) // chunk_size + (len(df) % chunk_size > 0)
     media_ids = []
@@ -71,7 +80,7 @@ def create_media_bulk(project_id: int, api: tator.api, df: pd.DataFrame, base_ur
                     latitude=row.latitude,
                     longitude=row.longitude,
                     depth=row.depth),
-                base_url=base_url, vol_map=vol_map) for key, row in df_chunk.iterrows()]
+                base_url=base_url, vol_map=vol_map, previews=previews) for row in df_chunk.itertuples()]
         if side == Side.RIGHT:
             specs = [gen_spec(
                 file_loc=row.right,
@@ -86,7 +95,7 @@ def create_media_bulk(project_id: int, api: tator.api, df: pd.DataFrame, base_ur
                     latitude=row.latitude,
                     longitude=row.longitude,
                     depth=row.depth),
-                base_url=base_url, vol_map=vol_map) for key, row in df_chunk.iterrows()]
+                base_url=base_url, vol_map=vol_map, previews=previews) for row in df_chunk.itertuples()]
         if side == Side.UNKNOWN:
             specs = [gen_spec(
                 file_loc=row.image,
@@ -101,22 +110,31 @@ def create_media_bulk(project_id: int, api: tator.api, df: pd.DataFrame, base_ur
                     latitude=row.latitude,
                     longitude=row.longitude,
                     depth=row.depth),
-                base_url=base_url, vol_map=vol_map) for key, row in df_chunk.iterrows()]
+                base_url=base_url, vol_map=vol_map, previews=previews) for row in df_chunk.itertuples()]
         assert specs is not None, f'Could not create specs for {side} images'
-        media_ids += [
+        new_ids = [
             new_id
             for response in tator.util.chunked_create(
                 api.create_media_list, project_id, chunk_size=chunk_size, body=specs
             )
             for new_id in response.id
         ]
+        if ledger:
+            column = {Side.LEFT: 'left', Side.RIGHT: 'right'}.get(side, 'image')
+            ledger.record(specs, df_chunk[column], new_ids, side.value)
+        media_ids += new_ids
         info(f"Created {len(media_ids)} {side} medias")
     info(f"Created {len(media_ids)} {side} medias!")
     return media_ids
 
 
 def create_media(project_id: int, api: tator.api, row: pd.Series, base_url: str, vol_map: dict, image_type_id: int, section: str,
-                 side: Side, platform: Platform, camera: Camera, mission_name: str) -> int:
+                 side: Side, platform: Platform, camera: Camera, mission_name: str, ledger: Ledger = None,
+                 previews: Previews = None) -> int:
+    """
+    Create a single media. If a ledger is given, the created media is recorded in it. If previews are given, the
+    image is added to them as it is read for the md5
+    """
     image = None
     try:
         image_data = ImageData(
@@ -136,7 +154,8 @@ def create_media(project_id: int, api: tator.api, row: pd.Series, base_url: str,
                             section=section,
                             data=image_data,
                             base_url=base_url,
-                            vol_map=vol_map)
+                            vol_map=vol_map,
+                            previews=previews)
         if side == Side.RIGHT:
             image = row.right
             spec = gen_spec(file_loc=row.right,
@@ -144,7 +163,8 @@ def create_media(project_id: int, api: tator.api, row: pd.Series, base_url: str,
                             section=section,
                             data=image_data,
                             base_url=base_url,
-                            vol_map=vol_map)
+                            vol_map=vol_map,
+                            previews=previews)
         if side == Side.UNKNOWN:
             image = row.image
             spec = gen_spec(file_loc=row.image,
@@ -152,10 +172,14 @@ def create_media(project_id: int, api: tator.api, row: pd.Series, base_url: str,
                             section=section,
                             data=image_data,
                             base_url=base_url,
-                            vol_map=vol_map)
+                            vol_map=vol_map,
+                            previews=previews)
         assert spec is not None, f'Could not create spec for {side} image'
         response = api.create_media_list(project_id, body=spec, async_req=False)
-        return response.id
+        media_id = response.id[0] if isinstance(response.id, list) else response.id
+        if ledger:
+            ledger.record([spec], [image], [media_id], side.value)
+        return media_id
     except Exception as e:
         if 'ApplyResult' in str(e):
             info(f'Image {image} uploaded')
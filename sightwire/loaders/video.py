@@ -2,6 +2,7 @@
 # Filename: loaders/load_video.py
 # Description: Load video into the database
 
+from dataclasses import asdict
 from datetime import datetime
 from pathlib import Path
 
@@ -9,9 +10,10 @@ import click
 from tator.util import make_multi_stream
 
 from sightwire import common_args
-from sightwire.converters.commands import create_video
 from sightwire.database.common import init_api_project, find_media_type
-from sightwire.database.data_types import Platform, Camera, VideoData
+from sightwire.database.data_types import Platform, Camera, Side, VideoData
+from sightwire.database.ledger import Ledger
+from sightwire.database.media import upload, local_md5_partial
 from sightwire.logger import info, err
 
 
@@ -20,12 +22,13 @@ from sightwire.logger import info, err
 @common_args.token
 @common_args.project
 @common_args.force
+@common_args.ledger
 @click.option("--input", '-i', type=str, help='path to the video directory, or a single video file')
 @click.option("--platform-type", type=Platform, default=Platform.MINI_ROV, required=True)
 @click.option("--mission-name", type=str, required=True)
 @click.option("--camera-type", type=Camera, default=Camera.FLIR, required=True)
 def load_video(input: str, host: str, token: str, project: str, platform_type: Platform, mission_name: str,
-               camera_type: Camera, force: bool):
+               camera_type: Camera, force: bool, ledger: Path):
     """
     Load video from a local file system to the database
     :param input: Absolute path to the video to load
@@ -35,6 +38,7 @@ def load_video(input: str, host: str, token: str, project: str, platform_type: P
     :param platform_type: Platform type
     :param camera_type: Camera type
     :param force: True to force load and skip over check
+    :param ledger: Path to the SQLite ledger of loaded media, used to skip videos that are already loaded
     :param start_time: Start time of the video in ISO format, e.g. 2021-01-01T00:00:00
     :param end_time: End time of the video in ISO format, e.g. 2021-01-01T00:00:00
     :return:
@@ -55,7 +59,13 @@ def load_video(input: str, host: str, token: str, project: str, platform_type: P
     if force or click.confirm('Are you sure you want to load this media file?'
                               'You may want to check the database first to see if it is are already '
                               'loaded. Add --force to load anyway.'):
+        _ledger = Ledger(host, tator_project.id, ledger)
         for f in video_to_load:
+            media_id = _ledger.find(f.as_posix())
+            if media_id:
+                info(f'Skipping {f}, already loaded as media {media_id}')
+                continue
+
             info(f'Uploading {f}')
 
             section = f'VID/{platform_type.name}/{camera_type.name}/{mission_name}'
@@ -84,9 +94,13 @@ def load_video(input: str, host: str, token: str, project: str, platform_type: P
                                    iso_end_datetime=end_time,
                                    platform=platform_type.name,
                                    camera=camera_type.name,
+                                   side=Side.UNKNOWN.name,
                                    mission=mission_name)
             info(f'Uploading {f}, start time {start_time}, end time {end_time}')
-            create_video(tator_project.id, api, media_data, f.as_posix(), media_type.id, section)
+            media_id = upload(tator_project.id, api, media_type.id, f, section=section, attributes=asdict(media_data))
+            _ledger.record([{'md5': local_md5_partial(f.as_posix()), 'size': f.stat().st_size}], [f.as_posix()],
+                           [media_id], Side.UNKNOWN.value)
+        _ledger.close()
 
 
 @click.command("stereo-view",
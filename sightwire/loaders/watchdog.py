@@ -16,9 +16,11 @@ from sightwire import common_args
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
-from sightwire.converters.time_utils import convert_timestamp_to_datetime_16
+from sightwire.converters.lcm_follow import DEFAULT_LCM_URL, LogFollower, NavBuffer, UdpFollower
+from sightwire.converters.time_utils import timestamps_to_datetime64
 from sightwire.database.common import init_api_project, find_media_type, find_state_type
 from sightwire.database.data_types import Platform, Camera, Side, StereoImageData
+from sightwire.database.ledger import Ledger
 from sightwire.loaders.image_utils import create_media
 from sightwire.logger import info, debug, err
 
@@ -31,19 +33,45 @@ count = 0
 @common_args.project
 @common_args.base_url
 @common_args.vol_map
+@common_args.ledger
 @click.option("--platform-type", type=Platform, default=Platform.MINI_ROV, required=True)
 @click.option("--camera-type", type=Camera, default=Camera.FLIR, required=True)
 @click.option("--mission-name", type=str, required=True)
 @click.option("--input", '-l', type=Path, help='base path to the directory to watch')
+@click.option("--nav-log", type=Path, help='LCM log file, or directory of lcmlog.* segments, to follow for live '
+                                           'depth and position')
+@click.option("--nav-udp", type=str, help=f'LCM UDP multicast to follow for live depth and position, '
+                                          f'e.g. {DEFAULT_LCM_URL}')
+@click.option('--usbl-channel', help='USBL channel name (gps_fix_t), e.g. LASS_USBL_LATLONG')
+@click.option('--depth-channel', help='Depth channel name (depth_t), e.g. LASS_DEPTH')
+@click.option("--max-gap", type=float, default=10., help="Maximum time in seconds between an image and the nearest "
+                                                         "depth/position fix. Images further away get no value")
+@click.option("--nav-mode", type=click.Choice(['nearest', 'interp']), default='nearest',
+              help="Use the nearest depth/position fix or interpolate between fixes")
 def load_watchdog(base_url: str, vol_map: str, host: str, token: str, project: str, input: Path,
-                  platform_type: Platform, camera_type: Camera, mission_name: str):
+                  platform_type: Platform, camera_type: Camera, mission_name: str, ledger: Path, nav_log: Path,
+                  nav_udp: str, usbl_channel: str, depth_channel: str, max_gap: float, nav_mode: str):
     info(f'Consuming Redis TimeSeries queue for project {project} on host {host}')
 
     _vol_map = parse_vol_map(vol_map)
 
+    # Follow the live navigation so images get real positions. Without it, positions are stored as zeros
+    nav = None
+    if nav_log or nav_udp:
+        if not usbl_channel or not depth_channel:
+            raise click.UsageError('Need --usbl-channel and --depth-channel to follow live navigation')
+        nav = NavBuffer()
+        if nav_log:
+            LogFollower(nav, nav_log, usbl_channel, depth_channel).start()
+        else:
+            UdpFollower(nav, nav_udp, usbl_channel, depth_channel).start()
+
     # Initialize the Tator API
     api, project = init_api_project(host, token, project)
 
+    # Record loaded pairs so a pair still at the head of the queue, or loaded before a restart, is not loaded twice
+    _ledger = Ledger(host, project.id, ledger)
+
     # Create a Redis connection
     r = redis.Redis(port=6380)
 
@@ -78,20 +106,31 @@ def load_watchdog(base_url: str, vol_map: str, host: str, token: str, project: s
         Load an image pair into the database
         """
 
+        image_left, image_right = parse_dict(path_left[0]), parse_dict(path_right[0])
+        if len(_ledger.paired([image_left, image_right])) == 2:
+            debug(f'Skipping pair {image_left} {image_right} already loaded')
+            return
+
         # Convert the timestamp to a datetime
-        iso_datetime_left = convert_timestamp_to_datetime_16(timestamp_left)
-        iso_datetime_right = convert_timestamp_to_datetime_16(timestamp_right)
+        iso_datetime_left, iso_datetime_right = pd.DatetimeIndex(timestamps_to_datetime64([timestamp_left, timestamp_right]))
+
+        if nav:
+            nav_left = nav.lookup(iso_datetime_left.value // 1000, nav_mode, max_gap)
+            nav_right = nav.lookup(iso_datetime_right.value // 1000, nav_mode, max_gap)
+            debug(f'Navigation for {image_left}: {nav_left}')
+        else:
+            nav_left = nav_right = {'latitude': 0, 'longitude': 0, 'depth': 0}
 
-        row_l = pd.Series(
-            {'left': parse_dict(path_left[0]), 'iso_datetime': iso_datetime_left, 'latitude': 0, 'longitude': 0, 'depth': 0})
-        row_r = pd.Series(
-            {'right': parse_dict(path_right[0]), 'iso_datetime': iso_datetime_right, 'latitude': 0, 'longitude': 0, 'depth': 0})
+        row_l = pd.Series({'left': image_left, 'iso_datetime': iso_datetime_left, **nav_left})
+        row_r = pd.Series({'right': image_right, 'iso_datetime': iso_datetime_right, **nav_right})
 
         # Create a media for the left/right
-        left_id = create_media(project.id, api, row_l, base_url, _vol_map, image_type.id, section, Side.LEFT,
-                               platform_type, camera_type, mission_name)
-        right_id = create_media(project.id, api, row_r, base_url, _vol_map, image_type.id, section, Side.RIGHT,
-                                platform_type, camera_type, mission_name)
+        left_id = _ledger.find(image_left) or \
+                  create_media(project.id, api, row_l, base_url, _vol_map, image_type.id, section, Side.LEFT,
+                               platform_type, camera_type, mission_name, _ledger)
+        right_id = _ledger.find(image_right) or \
+                   create_media(project.id, api, row_r, base_url, _vol_map, image_type.id, section, Side.RIGHT,
+                                platform_type, camera_type, mission_name, _ledger)
 
         # Create a state to link the left and right
         # # Add the left and right images to a stereo state using the left media timestamp
@@ -107,7 +146,9 @@ def load_watchdog(base_url: str, vol_map: str, host: str, token: str, project: s
                     mission=mission_name,
                     iso_datetime=row_l.iso_datetime))
             })
-        info(f'Created stereo state {response.id} for media LEFT {left_id} and RIGHT {right_id}')
+        state_id = response.id[0] if isinstance(response.id, list) else response.id
+        info(f'Created stereo state {state_id} for media LEFT {left_id} and RIGHT {right_id}')
+        _ledger.record_state([image_left, image_right], [state_id, state_id])
 
     # Loop through the jobs in the Redis TimeSeries queue every 1 second
     while True:  # Loop forever
@@ -127,9 +168,10 @@ def load_watchdog(base_url: str, vol_map: str, host: str, token: str, project: s
                 # Check if the time difference between the right and left is less than 500 milliseconds
                 right_timestamp = right_job[0][queue_name_r][1]
                 left_timestamp = left_job[0][queue_name_l][1]
-                time_diff = abs(right_timestamp - left_timestamp) / 1e6
-                debug(f'Time difference: {time_diff}')
-                if time_diff < 500:
+                t_left, t_right = pd.DatetimeIndex(timestamps_to_datetime64([left_timestamp, right_timestamp]))
+                time_diff = abs(t_left - t_right).total_seconds()
+                debug(f'Time difference: {time_diff} seconds')
+                if time_diff <= 0.5:
                     debug(f'Loading pair: {right_job} and {left_job}')
                     load_pair(left_job, right_job, left_timestamp, right_timestamp)
         except Exception as ex:
@@ -185,7 +227,7 @@ def run_watchdog(input: Path):
         global count
         # Get the timestamp of the event from the file, e.g. 1708033240797775.png is 1708033240797775
         timestamp_int = int(Path(event.src_path).stem)
-        timestamp = convert_timestamp_to_datetime_16(int(Path(event.src_path).stem))
+        timestamp = timestamps_to_datetime64([timestamp_int])[0]
         if '_L_' in path:
             info(f'Enqueueing job for {path} at {timestamp}')
             # Enqueue the job on the left side of the queue
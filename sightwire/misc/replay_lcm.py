@@ -0,0 +1,24 @@
+# sightwire, Apache-2.0 license
+# Filename: misc/replay_lcm.py
+# Description: Replays an LCM log on a local UDP multicast to simulate live navigation, e.g. for testing the
+# realtime loader with --nav-udp
+from pathlib import Path
+
+import click
+
+from sightwire.converters.lcm import find_segments, iter_segments
+from sightwire.converters.lcm_follow import DEFAULT_LCM_URL, publish
+from sightwire.logger import info
+
+
+@click.command("replay-lcm", help="Replay an LCM log on a local UDP multicast to simulate live navigation")
+@click.option("--log", type=Path, required=True,
+              help="LCM log file, a directory of lcmlog.* segments or a quoted glob, e.g. '/data/lcmlog.*'")
+@click.option('--channel', '-c', 'channels', multiple=True, help='Channel to replay. Repeat for more channels. '
+                                                                 'Default is all channels')
+@click.option('--url', default=DEFAULT_LCM_URL, help='LCM multicast URL')
+@click.option('--speed', type=float, default=1., help='Replay speed, e.g. 2 for twice real time, 0 for as fast as possible')
+def replay_lcm(log: Path, channels: tuple, url: str, speed: float):
+    info(f'Replaying {log} on {url} at {speed}x')
+    publish(iter_segments(find_segments(log), channels or None), url, speed)
+    info(f'Finished replaying {log}')
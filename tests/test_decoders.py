@@ -0,0 +1,39 @@
+# sightwire, Apache-2.0 license
+# Filename: tests/test_decoders.py
+# Description: Tests of the LCM message decoders flattened from the type definitions
+from compas_lcmtypes.stdlcm import integer_entry_t, msg_t
+from lcmlog import Event, Header
+
+from sightwire.converters.decoders import flatten, get_decoder
+
+
+def test_variable_array_of_structs_is_skipped():
+    message = msg_t()
+    message.header.timestamp = 1699643617662483
+    message.l_int = [integer_entry_t() for _ in range(3)]
+    message.n_ints = len(message.l_int)
+    data = message.encode()
+
+    decoder = get_decoder('msg_t')
+    assert not any(c.startswith('l_') for c in decoder.columns)
+    row = decoder.row(Event(Header(0, 1, 5, len(data)), 'STATE', data)).strip().split(',')
+    assert dict(zip(['lcm_timestamp'] + decoder.columns, row))['n_ints'] == '3'
+    columns = dict(zip(decoder.columns, decoder.decode_batch([data, data])))
+    assert columns['sensor_timestamp'].tolist() == [1699643617662483] * 2
+
+
+class pair_t:
+    """ Fixed size array of a nested type, which compas_lcmtypes does not have yet """
+    __slots__ = ['entries']
+    __typenames__ = ['compas_lcmtypes.stdlcm.integer_entry_t']
+    __dimensions__ = [[2]]
+
+
+def test_fixed_array_of_structs_is_expanded():
+    fields = flatten(pair_t)
+    assert [(c, p) for c, _, p in fields] == [('entries_0_value', ('entries', 0, 'value')),
+                                              ('entries_1_value', ('entries', 1, 'value'))]
+    message = pair_t.__new__(pair_t)
+    message.entries = [integer_entry_t(), integer_entry_t()]
+    message.entries[0].value, message.entries[1].value = 4, 5
+    assert [get(message) for _, get, _ in fields] == [4, 5]
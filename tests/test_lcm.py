@@ -0,0 +1,63 @@
+# sightwire, Apache-2.0 license
+# Filename: tests/test_lcm.py
+# Description: Tests of LCM log sorting and extraction
+import resource
+from pathlib import Path
+
+import numpy as np
+from compas_lcmtypes.senlcm import depth_t
+from lcmlog import Event, Header
+
+from sightwire.converters.columnar import read_columns
+from sightwire.converters.lcm import MERGE_FAN_IN, extract_segments, iter_events, sort_events, write_events, write_log
+
+
+def make_events(timestamps) -> list:
+    """
+    Events on one channel with the event number as payload, to check the order of equal timestamps
+    """
+    return [Event(Header(i, int(t), 4, 4), 'TEST', int(i).to_bytes(4, 'big')) for i, t in enumerate(timestamps)]
+
+
+def test_sort_events_more_runs_than_fan_in(tmp_path: Path):
+    timestamps = np.random.default_rng(0).integers(0, 50, 3 * MERGE_FAN_IN + 5)
+    events = make_events(timestamps)
+    # One event per run, so the runs are merged in more than one pass
+    sorted_events = list(sort_events(iter(events), max_bytes=1, work_path=tmp_path))
+    expected = sorted(events, key=lambda e: e.header.timestamp)
+    assert [e.data for e in sorted_events] == [e.data for e in expected]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_write_log_with_few_open_files(tmp_path: Path):
+    events = make_events(np.arange(400)[::-1])
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(soft, 128), hard))
+    try:
+        count = write_log(tmp_path / 'sorted.lcm', iter(events), max_bytes=1)
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    assert count == 400
+    assert [e.header.timestamp for e in iter_events(tmp_path / 'sorted.lcm')] == list(range(400))
+
+
+def depth_event(number: int, t: int) -> Event:
+    message = depth_t()
+    message.header.timestamp = t
+    message.depth = 100. + number
+    data = message.encode()
+    return Event(Header(number, t, len('DEPTH'), len(data)), 'DEPTH', data)
+
+
+def test_extract_segments_keeps_dtypes_with_empty_segment(tmp_path: Path):
+    segments = [tmp_path / 'lcmlog.00', tmp_path / 'lcmlog.01']
+    write_events(segments[0], [depth_event(i, 1_000_000 + i) for i in range(10)])
+    write_events(segments[1], make_events([2_000_000]))  # No DEPTH events
+    output = tmp_path / 'DEPTH.npz'
+    counts = extract_segments(segments, ['DEPTH:depth_t'], {'DEPTH': output}, workers=2)
+    assert counts == {'DEPTH': 10}
+    df = read_columns(output)
+    assert df['lcm_timestamp'].dtype == np.int64
+    assert df['sensor_timestamp'].dtype == np.int64
+    assert df['depth'].dtype == np.float64
+    assert df['sensor_timestamp'].tolist() == list(range(1_000_000, 1_000_010))